@@ -0,0 +1,78 @@
+import numpy as np
+
+
+class ClusterIndex():
+
+    """
+    Groups spikes by cluster ID, in compressed sparse row (CSR) style
+
+    The index is built once with a stable argsort of spike_clusters plus an
+    array of offsets into the sorted order. The spikes for cluster i are then
+    order[offsets[i]:offsets[i+1]], so fetching one unit is O(1) and never
+    touches the full spike array. Because the sort is stable, spikes within
+    each cluster keep their original (time) order.
+
+    Per-spike arrays (times, amplitudes, templates...) are put in cluster order
+    once with sort(), after which unit() returns views into that copy.
+
+    """
+
+    def __init__(self, spike_clusters, total_units=None):
+
+        """
+        spike_clusters : numpy.ndarray (num_spikes x 0)
+            Cluster IDs for each spike
+        total_units : int (optional)
+            Number of cluster IDs to index; defaults to max(spike_clusters) + 1
+        """
+
+        spike_clusters = np.squeeze(spike_clusters)
+
+        if total_units is None:
+            total_units = np.max(spike_clusters) + 1 if spike_clusters.size > 0 else 0
+
+        self.total_units = int(total_units)
+        self.num_spikes = spike_clusters.size
+
+        self.order = np.argsort(spike_clusters, kind='stable')
+        self.counts = np.bincount(spike_clusters, minlength=self.total_units)[:self.total_units]
+        self.offsets = np.zeros((self.total_units + 1,), dtype='int64')
+        np.cumsum(self.counts, out=self.offsets[1:])
+
+        # equivalent to np.unique(spike_clusters)
+        self.cluster_ids = np.flatnonzero(self.counts)
+
+    def indices(self, cluster_id):
+
+        """ Indices (into the original spike arrays) of the spikes for one cluster
+
+        Returned in ascending order, so spike_array[indices] matches
+        spike_array[spike_clusters == cluster_id]
+
+        """
+
+        return self.order[self.offsets[cluster_id]:self.offsets[cluster_id + 1]]
+
+    def sort(self, values):
+
+        """ Reorder a per-spike array into cluster order (one O(N) gather) """
+
+        return np.asarray(values)[self.order]
+
+    def unit(self, sorted_values, cluster_id):
+
+        """ View of one cluster's entries in an array returned by sort() """
+
+        return sorted_values[self.offsets[cluster_id]:self.offsets[cluster_id + 1]]
+
+    def labels(self):
+
+        """ Cluster ID of each entry in cluster order (sorted spike_clusters) """
+
+        return np.repeat(np.arange(self.total_units), self.counts)
+
+    def take(self, cluster_id, values):
+
+        """ One cluster's entries of an unsorted per-spike array """
+
+        return np.asarray(values)[self.indices(cluster_id)]
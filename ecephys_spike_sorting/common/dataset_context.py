@@ -0,0 +1,134 @@
+"""
+Kilosort datasets shared by the modules of one in-process pipeline run
+
+Modules get their Kilosort outputs from kilosort_dataset(). Without an active
+DatasetContext this returns a new KilosortDataset, as when each module runs
+in its own process. Inside a context, all modules asking for the same
+directory get the same dataset, so arrays loaded by one module (e.g. the
+spike times, templates and PC features read by kilosort_postprocessing) are
+reused by the next ones:
+
+    with DatasetContext() as context:
+        for module in modules:
+            context.refresh()
+            run(module)
+
+refresh() drops cached data read from files that have changed on disk since,
+e.g. when a module that does not use the dataset rewrites the outputs.
+Modules that rewrite files they read should do it with KilosortDataset.save,
+which keeps the dataset up to date without reading the files back.
+
+"""
+
+import os
+import threading
+
+from .utils import KilosortDataset
+
+_local = threading.local()
+
+
+class DatasetContext():
+
+    """ Shares one KilosortDataset per directory between modules
+
+    Use as a context manager: entering makes this the active context of the
+    thread, leaving releases all datasets.
+
+    """
+
+    def __init__(self):
+
+        self.datasets = {}
+        self._previous = None
+
+    def __enter__(self):
+
+        self._previous = getattr(_local, 'context', None)
+        _local.context = self
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.datasets.clear()
+
+        _local.context = self._previous
+        self._previous = None
+
+        return False
+
+    def dataset(self, folder, sample_rate=None, use_master_clock=False,
+                template_zero_padding=21, mmap_mode=None,
+                unwhitened_dtype='float64', cache_unwhitened=True):
+
+        """ The shared dataset for these settings, created on first use
+
+        Datasets are shared between requests with the same directory, sample
+        rate, spike times and template settings. If mmap_mode differs from
+        that of the shared dataset, its PC and template features are read
+        again with the new mode.
+
+        """
+
+        key = (os.path.abspath(folder), sample_rate, use_master_clock,
+               unwhitened_dtype, cache_unwhitened)
+
+        dataset = self.datasets.get(key)
+
+        if dataset is None:
+            dataset = KilosortDataset(folder, sample_rate, use_master_clock,
+                                      template_zero_padding, mmap_mode,
+                                      unwhitened_dtype, cache_unwhitened)
+            self.datasets[key] = dataset
+
+        elif dataset.mmap_mode != mmap_mode:
+            dataset.mmap_mode = mmap_mode
+            dataset.invalidate('pc_features.npy')
+            dataset.invalidate('template_features.npy')
+
+        return dataset
+
+    def refresh(self):
+
+        """ Drop cached data of all datasets whose files changed on disk """
+
+        for dataset in self.datasets.values():
+            dataset.refresh()
+
+    def invalidate(self, folder=None):
+
+        """ Drop all cached data (of the datasets for one directory, if given) """
+
+        for key, dataset in self.datasets.items():
+            if folder is None or key[0] == os.path.abspath(folder):
+                dataset.invalidate()
+
+
+def get_context():
+
+    """ The active DatasetContext of this thread, or None """
+
+    return getattr(_local, 'context', None)
+
+
+def kilosort_dataset(folder, sample_rate=None, use_master_clock=False,
+                     template_zero_padding=21, mmap_mode=None,
+                     unwhitened_dtype='float64', cache_unwhitened=True):
+
+    """ A KilosortDataset, shared with other modules if a DatasetContext is active
+
+    Takes the same arguments as KilosortDataset.
+
+    """
+
+    context = get_context()
+
+    if context is None:
+        return KilosortDataset(folder, sample_rate, use_master_clock,
+                               template_zero_padding, mmap_mode,
+                               unwhitened_dtype, cache_unwhitened)
+
+    return context.dataset(folder, sample_rate, use_master_clock,
+                           template_zero_padding, mmap_mode,
+                           unwhitened_dtype, cache_unwhitened)
@@ -48,6 +48,38 @@ class Epoch():
 
 
 
+def get_sliding_windows(start_time, end_time, window_length, step):
+
+    """ Epochs of window_length seconds, starting every step seconds
+
+    Windows start at start_time and continue while the start is before
+    end_time; the last window may extend past end_time.
+
+    Input:
+    ------
+    start_time : float
+        Start of the first window in seconds
+    end_time : float
+        End of the time range in seconds
+    window_length : float
+        Length of each window in seconds
+    step : float
+        Time between window starts in seconds (less than window_length for
+        overlapping windows)
+
+    Output:
+    -------
+    windows : list of Epoch objects
+        Named 'window_0', 'window_1', ...
+
+    """
+
+    window_starts = np.arange(start_time, end_time, step)
+
+    return [Epoch('window_' + repr(idx), window_start, window_start + window_length)
+            for idx, window_start in enumerate(window_starts)]
+
+
 def get_epochs_from_nwb_file(filename):
 
     nwb = h5.File(filename)
@@ -0,0 +1,385 @@
+"""
+Nested timing and memory spans for pipeline stages
+
+A Tracer records a tree of named spans. Code marks its stages with the
+module-level span() context manager, which adds a child to the innermost open
+span of the active tracer, and does nothing when no tracer is active:
+
+    with Tracer('quality_metrics') as tracer:
+        with span('load_kilosort_data'):
+            ...
+        with span('calculate_metrics'):
+            with span('silhouette_score'):
+                ...
+
+    output['spans'] = tracer.to_dict()
+    tracer.write_chrome_trace('trace.json')
+
+Module run functions are wrapped with the trace_module decorator, which does
+this for them.
+
+For each span the tracer records the wall-clock duration, the resident set
+size (RSS) at start and end, the rise in the process peak RSS, and the bytes
+read from and written to storage by the process. Peak RSS and I/O counters
+are process-wide, so the numbers of a span include those of its children.
+
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+import psutil
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_local = threading.local()
+
+
+class Span():
+
+    """ One timed stage, with its child stages """
+
+    def __init__(self, name, attributes=None):
+
+        self.name = name
+        self.attributes = dict(attributes) if attributes else {}
+        self.children = []
+
+        self.start_time = None
+        self.end_time = None
+        self._perf_start = None
+
+        self.rss_start = None
+        self.rss_end = None
+        self.peak_rss_start = None
+        self.peak_rss_end = None
+
+        self.read_bytes_start = None
+        self.read_bytes_end = None
+        self.write_bytes_start = None
+        self.write_bytes_end = None
+
+    @property
+    def duration(self):
+
+        if self.start_time is None or self.end_time is None:
+            return None
+
+        return self.end_time - self.start_time
+
+    def to_dict(self, t0=None):
+
+        """ The span and its children as JSON-serializable nested dicts
+
+        Times are in seconds, relative to t0 (default: the start of this span);
+        memory and I/O are in bytes, None where the platform does not report them.
+
+        """
+
+        if t0 is None:
+            t0 = self.start_time
+
+        out = OrderedDict()
+        out['name'] = self.name
+        out['start'] = self.start_time - t0
+        out['duration'] = self.duration
+        out['rss'] = self.rss_end
+        out['rss_delta'] = _delta(self.rss_start, self.rss_end)
+        out['peak_rss_delta'] = _delta(self.peak_rss_start, self.peak_rss_end)
+        out['read_bytes'] = _delta(self.read_bytes_start, self.read_bytes_end)
+        out['write_bytes'] = _delta(self.write_bytes_start, self.write_bytes_end)
+
+        if self.attributes:
+            out['attributes'] = self.attributes
+
+        out['children'] = [child.to_dict(t0) for child in self.children]
+
+        return out
+
+
+class Tracer():
+
+    """ Records a tree of spans under one root span
+
+    Inputs:
+    -------
+    name : str
+        Name of the root span, normally the module name
+    attributes : dict (optional)
+        Extra values stored with the root span
+
+    Use as a context manager: entering starts the root span and makes this
+    the active tracer of the thread, leaving ends it.
+
+    """
+
+    def __init__(self, name, attributes=None):
+
+        self.root = Span(name, attributes)
+        self._stack = []
+        self._previous = None
+        self._process = psutil.Process()
+
+    def __enter__(self):
+
+        self._previous = getattr(_local, 'tracer', None)
+        _local.tracer = self
+
+        self._start(self.root)
+        self._stack.append(self.root)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        while self._stack:
+            self._end(self._stack.pop())
+
+        _local.tracer = self._previous
+        self._previous = None
+
+        return False
+
+    @contextmanager
+    def span(self, name, **attributes):
+
+        """ Child span of the innermost open span """
+
+        child = Span(name, attributes)
+
+        if self._stack:
+            self._stack[-1].children.append(child)
+
+        self._start(child)
+        self._stack.append(child)
+
+        try:
+            yield child
+        finally:
+            # pop up to and including this span, in case a child was left open
+            while self._stack:
+                top = self._stack.pop()
+                self._end(top)
+                if top is child:
+                    break
+
+    def to_dict(self):
+
+        return self.root.to_dict()
+
+    def chrome_trace_events(self):
+
+        """ Spans as Chrome trace 'complete' events (chrome://tracing, Perfetto)
+
+        Timestamps are microseconds since the epoch, so events from modules
+        run one after another line up on a common time axis.
+
+        """
+
+        events = []
+        pid = os.getpid()
+        tid = threading.get_ident()
+
+        def add(node):
+
+            args = OrderedDict()
+            args['rss_delta'] = _delta(node.rss_start, node.rss_end)
+            args['peak_rss_delta'] = _delta(node.peak_rss_start, node.peak_rss_end)
+            args['read_bytes'] = _delta(node.read_bytes_start, node.read_bytes_end)
+            args['write_bytes'] = _delta(node.write_bytes_start, node.write_bytes_end)
+            args.update(node.attributes)
+
+            events.append({'name': node.name,
+                           'cat': self.root.name,
+                           'ph': 'X',
+                           'ts': node.start_time * 1e6,
+                           'dur': (node.duration or 0) * 1e6,
+                           'pid': pid,
+                           'tid': tid,
+                           'args': args})
+
+            for child in node.children:
+                add(child)
+
+        add(self.root)
+
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                       'args': {'name': self.root.name}})
+
+        return events
+
+    def write_chrome_trace(self, filename, append=True):
+
+        """ Write the spans to a Chrome trace JSON file
+
+        With append = True, events already in the file (e.g. from earlier
+        modules of the same pipeline run) are kept.
+
+        """
+
+        events = []
+
+        if append and os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    existing = json.load(f)
+                events = existing['traceEvents'] if isinstance(existing, dict) else existing
+            except (ValueError, KeyError):
+                print("Could not read existing trace file " + filename + "; overwriting")
+                events = []
+
+        events = events + self.chrome_trace_events()
+
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=_to_builtin)
+
+    def _start(self, span):
+
+        span.rss_start = self._rss()
+        span.peak_rss_start = _peak_rss(self._process)
+        span.read_bytes_start, span.write_bytes_start = self._io()
+        span.start_time = time.time()
+        span._perf_start = time.perf_counter()
+
+    def _end(self, span):
+
+        # duration from the monotonic clock; start time from the wall clock
+        span.end_time = span.start_time + (time.perf_counter() - span._perf_start)
+        span.rss_end = self._rss()
+        span.peak_rss_end = _peak_rss(self._process)
+        span.read_bytes_end, span.write_bytes_end = self._io()
+
+    def _rss(self):
+
+        return self._process.memory_info().rss
+
+    def _io(self):
+
+        try:
+            counters = self._process.io_counters()
+        except (AttributeError, psutil.Error, NotImplementedError):  # not on macOS
+            return None, None
+
+        return counters.read_bytes, counters.write_bytes
+
+
+def get_tracer():
+
+    """ The active tracer of this thread, or None """
+
+    return getattr(_local, 'tracer', None)
+
+
+@contextmanager
+def span(name, **attributes):
+
+    """ Time a stage under the active tracer; does nothing without one
+
+    Inputs:
+    -------
+    name : str
+        Name of the stage
+    attributes : keyword arguments
+        Extra values stored with the span (e.g. number of units)
+
+    """
+
+    tracer = get_tracer()
+
+    if tracer is None:
+        yield None
+    else:
+        with tracer.span(name, **attributes) as current:
+            yield current
+
+
+def trace_module(name):
+
+    """ Decorator for the run function of a module
+
+    The function (taking the module's input args and returning its output
+    manifest) runs under a Tracer; the span tree is added to the manifest as
+    'spans', and appended to args['instrumentation_params']['chrome_trace_file']
+    if that is set.
+
+    """
+
+    def decorator(run):
+
+        @wraps(run)
+        def wrapper(args, *positional, **keywords):
+
+            with Tracer(name) as tracer:
+                output = run(args, *positional, **keywords)
+
+            output['spans'] = tracer.to_dict()
+
+            trace_file = (args.get('instrumentation_params') or {}).get('chrome_trace_file')
+
+            if trace_file:
+                tracer.write_chrome_trace(trace_file)
+
+            return output
+
+        return wrapper
+
+    return decorator
+
+
+def flatten_spans(spans, prefix=''):
+
+    """ Rows (path, span dict) for a span tree, depth first
+
+    The path joins the names from the root, e.g. 'quality_metrics/calculate_metrics/pc_metrics'
+
+    """
+
+    path = prefix + spans['name']
+
+    rows = [(path, spans)]
+
+    for child in spans['children']:
+        rows.extend(flatten_spans(child, path + '/'))
+
+    return rows
+
+
+def _peak_rss(process):
+
+    # high-water mark of the resident set size, in bytes
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    info = process.memory_info()
+
+    return getattr(info, 'peak_wset', info.rss)
+
+
+def _delta(start, end):
+
+    if start is None or end is None:
+        return None
+
+    return end - start
+
+
+def _to_builtin(obj):
+
+    # numpy scalars in span attributes
+    if hasattr(obj, 'item'):
+        return obj.item()
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+
+    raise TypeError(repr(obj) + " is not JSON serializable")
@@ -0,0 +1,204 @@
+import os
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+# file extension for each metrics output format; parquet and feather need
+# pyarrow (or fastparquet for parquet) to be installed
+METRICS_FORMATS = {'csv': '.csv',
+                   'parquet': '.parquet',
+                   'feather': '.feather'}
+
+
+def metrics_path(filename, metrics_format='csv'):
+
+    """ filename with the extension of metrics_format
+
+    The metrics files are configured as CSV paths (e.g. metrics.csv); the
+    columnar formats are written next to them (metrics.parquet).
+
+    """
+
+    path = pathlib.Path(filename)
+
+    return os.path.join(path.parent, path.stem + METRICS_FORMATS[metrics_format])
+
+
+def file_metrics_format(filename):
+
+    """ Format of a metrics file, from its extension ('csv' if not known) """
+
+    extension = pathlib.Path(filename).suffix
+
+    for metrics_format, format_extension in METRICS_FORMATS.items():
+        if extension == format_extension:
+            return metrics_format
+
+    return 'csv'
+
+
+def versioned_path(filename, version):
+
+    """ Name of a versioned metrics file, as made by getFileVersion
+
+    Version 0 is the file itself; version N adds _N to the stem.
+
+    """
+
+    if version == 0:
+        return filename
+
+    path = pathlib.Path(filename)
+
+    return os.path.join(path.parent, path.stem + '_' + repr(version) + path.suffix)
+
+
+def find_metrics_file(filename, metrics_format='csv'):
+
+    """ Existing metrics file for filename, in metrics_format if there is one
+
+    Other formats are tried if metrics_format is not found, so a module can
+    read the output of another module run with a different format.
+
+    Outputs:
+    --------
+    path : str or None
+        None if no metrics file exists in any format
+
+    """
+
+    formats = [metrics_format] + [fmt for fmt in METRICS_FORMATS if fmt != metrics_format]
+
+    for fmt in formats:
+        path = metrics_path(filename, fmt)
+        if os.path.exists(path):
+            return path
+
+    return None
+
+
+def read_metrics(filename):
+
+    """ Read a metrics table written by write_metrics
+
+    The format is taken from the file extension. cluster_id is read as int64
+    and epoch_name (and its suffixed versions after a merge) as str, whatever
+    the format.
+
+    """
+
+    metrics_format = file_metrics_format(filename)
+
+    if metrics_format == 'parquet':
+        metrics = pd.read_parquet(filename)
+    elif metrics_format == 'feather':
+        metrics = pd.read_feather(filename)
+    else:
+        header = pd.read_csv(filename, nrows=0)
+        # round_trip reads back exactly the values written, so rows that are
+        # copied to a new file do not change
+        metrics = pd.read_csv(filename, dtype={name: str for name in _epoch_name_columns(header)},
+                              float_precision='round_trip')
+        # metrics files of older versions were written with the index
+        metrics = metrics.drop(columns=[name for name in metrics.columns if name.startswith('Unnamed: ')])
+
+    return _fix_key_dtypes(metrics)
+
+
+def write_metrics(metrics, filename, metrics_format='csv'):
+
+    """ Write a metrics table in one of METRICS_FORMATS
+
+    Inputs:
+    -------
+    metrics : pandas.DataFrame
+    filename : str
+        Configured (CSV) path; the extension is replaced to match metrics_format
+    metrics_format : str
+        'csv' (default), 'parquet' or 'feather'
+
+    Outputs:
+    --------
+    path : str
+        The file written
+
+    """
+
+    path = metrics_path(filename, metrics_format)
+    metrics = _fix_key_dtypes(metrics.reset_index(drop=True))
+
+    if metrics_format == 'parquet':
+        metrics.to_parquet(path, index=False)
+    elif metrics_format == 'feather':
+        metrics.to_feather(path)
+    else:
+        metrics.to_csv(path, index=False)
+
+    return path
+
+
+def merge_metrics(metrics, other_metrics, suffixes):
+
+    """ Join two metrics tables on cluster_id
+
+    Columns present in both tables (other than cluster_id) get the suffixes,
+    as in pandas.merge. Rows are matched on the cluster_id values, so the
+    tables do not have to be in the same order or cover the same units; only
+    units present in both are kept.
+
+    """
+
+    if other_metrics.index.name == 'cluster_id':
+        other_metrics = other_metrics.reset_index()
+
+    return _fix_key_dtypes(metrics).merge(_fix_key_dtypes(other_metrics),
+                                          on='cluster_id',
+                                          suffixes=suffixes)
+
+
+def replace_metrics_rows(metrics, new_metrics, cluster_ids):
+
+    """ metrics with the rows of cluster_ids replaced by those of new_metrics
+
+    Used when only some units are recalculated: the rows of the other units are
+    kept, and all rows of cluster_ids are dropped (even if new_metrics has none
+    for a unit, e.g. one left without spikes). Rows are ordered by epoch, in
+    order of first appearance, then by cluster_id, as in a full run.
+
+    """
+
+    metrics = _fix_key_dtypes(metrics)
+    new_metrics = _fix_key_dtypes(new_metrics)
+
+    kept = metrics[~metrics['cluster_id'].isin(np.asarray(cluster_ids, dtype=np.int64))]
+    combined = pd.concat((kept, new_metrics), ignore_index=True)
+
+    sort_keys = ['cluster_id']
+
+    if 'epoch_name' in combined.columns:
+        epoch_order = {name: idx for idx, name in enumerate(pd.unique(combined['epoch_name']))}
+        combined['_epoch_order'] = combined['epoch_name'].map(epoch_order)
+        sort_keys = ['_epoch_order', 'cluster_id']
+
+    combined = combined.sort_values(sort_keys, kind='stable').reset_index(drop=True)
+
+    return combined.drop(columns=['_epoch_order'], errors='ignore')
+
+
+def _epoch_name_columns(metrics):
+
+    return [name for name in metrics.columns if name.startswith('epoch_name')]
+
+
+def _fix_key_dtypes(metrics):
+
+    metrics = metrics.copy(deep=False)
+
+    if 'cluster_id' in metrics.columns:
+        metrics['cluster_id'] = metrics['cluster_id'].astype(np.int64)
+
+    for name in _epoch_name_columns(metrics):
+        metrics[name] = metrics[name].astype(str)
+
+    return metrics
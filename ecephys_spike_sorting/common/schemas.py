@@ -1,5 +1,6 @@
 from marshmallow import Schema
 from marshmallow.fields import Bool, Float, Int, String
+from marshmallow.validate import OneOf
 
 from ecephys_spike_sorting.modules.schema_fields import InputDir, NumpyArray, OutputDir
 
@@ -68,7 +69,28 @@ class CommonFiles(Schema):
 
 class WaveformMetricsFile(Schema):
     waveform_metrics_file = String(help="Location of waveform metrics CSV")
+    metrics_format = String(
+        required=False,
+        missing="csv",
+        validate=OneOf(["csv", "parquet", "feather"]),
+        help="File format for waveform metrics; parquet and feather files are written next to the CSV path, with their own extension",
+    )
 
 
 class ClusterMetricsFile(Schema):
     cluster_metrics_file = String(help="Location of cluster metrics CSV")
+    metrics_format = String(
+        required=False,
+        missing="csv",
+        validate=OneOf(["csv", "parquet", "feather"]),
+        help="File format for cluster metrics; parquet and feather files are written next to the CSV path, with their own extension",
+    )
+
+
+class InstrumentationParams(Schema):
+    chrome_trace_file = String(
+        required=False,
+        missing=None,
+        allow_none=True,
+        help="Chrome trace JSON file to append the module's timing spans to (none if not set)",
+    )
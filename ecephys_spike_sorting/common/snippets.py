@@ -0,0 +1,243 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# snippets closer than this are read together: reading the gap is cheaper
+# than starting another read
+GATHER_MAX_GAP_BYTES = 2**18
+# upper limit on the size of one merged read
+GATHER_MAX_READ_BYTES = 2**25
+# number of reads issued ahead of consumption by each thread
+GATHER_PREFETCH_PER_THREAD = 2
+
+
+class Snippets:
+
+    """
+    int16 snippets of the raw data, scaled to microvolts when used
+
+    The snippets are held as read from the file; scaled() (or np.asarray)
+    returns them in microvolts, so the float copy is only made for the
+    snippets that need it.
+
+    Attributes:
+    -----------
+    data : numpy.ndarray (num_snippets x num_channels x samples_per_spike), int16
+    bit_volts : float
+        Scale from int16 values to microvolts
+
+    """
+
+    def __init__(self, data, bit_volts=1.0):
+        self.data = data
+        self.bit_volts = bit_volts
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, index):
+        return Snippets(self.data[index], self.bit_volts)
+
+    def __array__(self, dtype=None):
+        return self.scaled('float64' if dtype is None else dtype)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def scaled(self, dtype='float64'):
+
+        """ Snippets in microvolts, as a new array of dtype """
+
+        return np.multiply(self.data, self.bit_volts, dtype=dtype)
+
+
+def plan_snippet_reads(starts, samples_per_spike, max_gap, max_read_samples):
+
+    """
+    Sort snippets by file offset and merge nearby snippets into reads
+
+    Neighbouring snippets (in time order) are read together if fewer than
+    max_gap samples lie between them, as long as the read stays shorter than
+    about max_read_samples.
+
+    Inputs:
+    -------
+    starts : numpy.ndarray (num_snippets x 0)
+        First sample of each snippet
+    samples_per_spike : int
+        Number of samples in each snippet
+    max_gap : int
+        Largest gap (in samples) read through to merge two snippets
+    max_read_samples : int
+        Samples per read (a single snippet is read whatever its length)
+
+    Outputs:
+    --------
+    order : numpy.ndarray (num_snippets x 0)
+        Indices of the snippets, in time order
+    bounds : numpy.ndarray (num_reads + 1 x 0)
+        Read i holds the snippets order[bounds[i]:bounds[i+1]]
+    read_starts, read_ends : numpy.ndarray (num_reads x 0)
+        Samples read by each read
+
+    """
+
+    starts = np.asarray(starts, dtype='int64')
+
+    order = np.argsort(starts, kind='stable')
+    sorted_starts = starts[order]
+
+    if sorted_starts.size == 0:
+        return order, np.zeros((1,), dtype='int64'), sorted_starts, sorted_starts
+
+    new_range = np.ones(sorted_starts.shape, dtype='bool')
+    new_range[1:] = np.diff(sorted_starts) > samples_per_spike + max_gap
+
+    # split ranges that are too long into reads of about max_read_samples
+    range_starts = sorted_starts[new_range][np.cumsum(new_range) - 1]
+    read_index = (sorted_starts - range_starts) // max(1, max_read_samples - samples_per_spike)
+
+    new_read = new_range.copy()
+    new_read[1:] |= np.diff(read_index) != 0
+
+    first = np.flatnonzero(new_read)
+    bounds = np.append(first, sorted_starts.size)
+
+    read_starts = sorted_starts[first]
+    read_ends = sorted_starts[bounds[1:] - 1] + samples_per_spike
+
+    return order, bounds, read_starts, read_ends
+
+
+def iter_snippet_reads(raw_data,
+                       starts,
+                       samples_per_spike,
+                       channels=None,
+                       max_gap=None,
+                       max_read_samples=None,
+                       num_threads=4):
+
+    """
+    Read snippets of the raw data, in file order, with reads issued ahead
+
+    The snippets are sorted and merged into reads by plan_snippet_reads. A
+    pool of num_threads threads issues the reads (and cuts the snippets out
+    of them) while the caller works on earlier ones; at most
+    GATHER_PREFETCH_PER_THREAD reads per thread are held ahead.
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray or memmap (num_samples x num_channels), int16
+    starts : numpy.ndarray (num_snippets x 0)
+        First sample of each snippet; all snippets must be inside the data
+    samples_per_spike : int
+        Number of samples in each snippet
+    channels : numpy.ndarray or None
+        Channels to keep (default all)
+    max_gap, max_read_samples : int or None
+        See plan_snippet_reads; the defaults are GATHER_MAX_GAP_BYTES and
+        GATHER_MAX_READ_BYTES of data
+    num_threads : int
+        Number of reads in flight
+
+    Outputs:
+    --------
+    Yields (indices, snippets) for each read, where indices are positions in
+    starts and snippets is an int16 array (len(indices) x channels x samples)
+
+    """
+
+    starts = np.asarray(starts, dtype='int64')
+
+    if np.any(starts < 0) or np.any(starts + samples_per_spike > raw_data.shape[0]):
+        raise ValueError('Snippets must be inside the data')
+
+    max_gap, max_read_samples = _read_limits(raw_data, max_gap, max_read_samples)
+
+    order, bounds, read_starts, read_ends = plan_snippet_reads(starts, samples_per_spike, max_gap, max_read_samples)
+
+    offsets = np.arange(samples_per_spike)
+
+    def read(idx):
+
+        indices = order[bounds[idx]:bounds[idx + 1]]
+
+        block = np.asarray(raw_data[read_starts[idx]:read_ends[idx], :])
+        if channels is not None:
+            block = block[:, channels]
+
+        snippets = block[(starts[indices] - read_starts[idx])[:, np.newaxis] + offsets, :]
+
+        return indices, np.ascontiguousarray(np.transpose(snippets, (0, 2, 1)))
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+
+        pending = collections.deque()
+        next_read = 0
+
+        while next_read < read_starts.size or len(pending) > 0:
+
+            while next_read < read_starts.size and len(pending) < num_threads * GATHER_PREFETCH_PER_THREAD:
+                pending.append(executor.submit(read, next_read))
+                next_read += 1
+
+            yield pending.popleft().result()
+
+
+def gather_read_samples(raw_data, starts, samples_per_spike, max_gap=None, max_read_samples=None):
+
+    """ Total number of samples that gather_snippets would read """
+
+    max_gap, max_read_samples = _read_limits(raw_data, max_gap, max_read_samples)
+
+    _, _, read_starts, read_ends = plan_snippet_reads(starts, samples_per_spike, max_gap, max_read_samples)
+
+    return int(np.sum(read_ends - read_starts))
+
+
+def gather_snippets(raw_data,
+                    starts,
+                    samples_per_spike,
+                    bit_volts=1.0,
+                    channels=None,
+                    max_gap=None,
+                    max_read_samples=None,
+                    num_threads=4):
+
+    """
+    Snippets of the raw data at many times, read in file order
+
+    Inputs:
+    -------
+    See iter_snippet_reads; bit_volts is the scale to microvolts
+
+    Outputs:
+    --------
+    snippets : Snippets (num_snippets x channels x samples_per_spike)
+        In the order of starts
+
+    """
+
+    num_channels = raw_data.shape[1] if channels is None else len(channels)
+
+    data = np.zeros((len(starts), num_channels, samples_per_spike), dtype=raw_data.dtype)
+
+    for indices, snippets in iter_snippet_reads(raw_data, starts, samples_per_spike, channels,
+                                                max_gap, max_read_samples, num_threads):
+        data[indices] = snippets
+
+    return Snippets(data, bit_volts)
+
+
+def _read_limits(raw_data, max_gap, max_read_samples):
+
+    row_bytes = raw_data.shape[1] * raw_data.dtype.itemsize
+
+    if max_gap is None:
+        max_gap = GATHER_MAX_GAP_BYTES // row_bytes
+    if max_read_samples is None:
+        max_read_samples = GATHER_MAX_READ_BYTES // row_bytes
+
+    return max_gap, max_read_samples
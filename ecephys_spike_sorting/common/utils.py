@@ -1,8 +1,10 @@
+import hashlib
 import json
 import os
 import pathlib
 import sys
 import time
+from functools import cached_property
 
 import numpy as np
 import pandas as pd
@@ -221,7 +223,12 @@ def read_cluster_amplitude_tsv(filename):
     return cluster_amplitude
 
 
-def load(folder, filename):
+# number of spikes read at a time when selecting from per-spike arrays
+# that may be memory-mapped (e.g. pc_features, ~400 bytes per spike)
+SPIKE_CHUNK_SIZE = 100000
+
+
+def load(folder, filename, mmap_mode=None):
     """
     Loads a numpy file from a folder.
 
@@ -231,6 +238,9 @@ def load(folder, filename):
         Directory containing the file to load
     filename : String
         Name of the numpy file
+    mmap_mode : String (optional)
+        Passed to np.load; 'r' returns a read-only memory-map instead of
+        reading the whole file into memory
 
     Outputs:
     --------
@@ -239,7 +249,582 @@ def load(folder, filename):
 
     """
 
-    return np.load(os.path.join(folder, filename))
+    return np.load(os.path.join(folder, filename), mmap_mode=mmap_mode)
+
+
+def save(folder, filename, data):
+    """
+    Saves a numpy file to a folder, replacing any existing file only once the
+    new one has been written completely.
+
+    The existing file may still be memory-mapped (load_kilosort_data with
+    mmap_mode set), and possibly be the source of data; np.save directly
+    over it would truncate the file while it is being read.
+
+    Inputs:
+    -------
+    folder : String
+        Directory to save the file in
+    filename : String
+        Name of the numpy file
+    data : numpy.ndarray
+        Array to save
+
+    """
+
+    file_path = os.path.join(folder, filename)
+    temp_path = _temp_path(folder, filename)
+
+    if isinstance(data, np.memmap) and data.filename == temp_path:
+        # already written to the temporary file by select_spikes_to_file
+        data.flush()
+    else:
+        with open(temp_path, "wb") as f:
+            np.save(f, data)
+
+    os.replace(temp_path, file_path)
+
+
+def _temp_path(folder, filename):
+
+    return os.path.abspath(os.path.join(folder, filename + ".tmp"))
+
+
+def select_spikes(data, spike_mask, chunk_size=SPIKE_CHUNK_SIZE):
+    """
+    Selects rows of a per-spike array with a boolean mask, without making a
+    temporary copy of the whole array.
+
+    If the selected spikes are contiguous (e.g. an epoch of time-sorted spikes)
+    a view is returned, so a memory-mapped input stays memory-mapped. Otherwise
+    the rows are gathered chunk_size spikes at a time into a new array.
+
+    Inputs:
+    -------
+    data : numpy.ndarray or numpy.memmap (N x ...)
+        Per-spike array, e.g. pc_features
+    spike_mask : numpy.ndarray (N x 0)
+        True for spikes to select
+    chunk_size : int (optional)
+        Number of spikes to gather at a time
+
+    Outputs:
+    --------
+    selected : numpy.ndarray (num selected x ...)
+        Selected rows of data
+
+    """
+
+    spike_inds = np.flatnonzero(spike_mask)
+
+    if spike_inds.size == 0:
+        return data[:0]
+
+    first = spike_inds[0]
+    last = spike_inds[-1] + 1
+
+    if last - first == spike_inds.size:
+        return data[first:last]
+
+    selected = np.empty((spike_inds.size,) + data.shape[1:], dtype=data.dtype)
+
+    for start in range(0, spike_inds.size, chunk_size):
+        chunk_inds = spike_inds[start : start + chunk_size]
+        selected[start : start + chunk_inds.size] = data[chunk_inds]
+
+    return selected
+
+
+def select_spikes_to_file(data, spike_mask, folder, filename, chunk_size=SPIKE_CHUNK_SIZE):
+    """
+    Selects rows of a per-spike array with a boolean mask, writing them
+    directly into a new numpy file.
+
+    The rows are copied chunk_size spikes at a time, so neither data (e.g. a
+    memory-mapped pc_features) nor the selection has to fit in memory. The
+    file is written to the temporary path used by save(), which then only
+    has to move it into place: save(folder, filename, selected).
+
+    Inputs:
+    -------
+    data : numpy.ndarray or numpy.memmap (N x ...)
+        Per-spike array, e.g. pc_features
+    spike_mask : numpy.ndarray (N x 0)
+        True for spikes to select
+    folder : String
+        Directory of the new file
+    filename : String
+        Name of the numpy file it will be saved as
+    chunk_size : int (optional)
+        Number of spikes to copy at a time
+
+    Outputs:
+    --------
+    selected : numpy.memmap (num selected x ...)
+        Selected rows of data, memory-mapped from the new file
+
+    """
+
+    spike_inds = np.flatnonzero(spike_mask)
+
+    selected = np.lib.format.open_memmap(
+        _temp_path(folder, filename),
+        mode="w+",
+        dtype=data.dtype,
+        shape=(spike_inds.size,) + data.shape[1:],
+    )
+
+    for start in range(0, spike_inds.size, chunk_size):
+        chunk_inds = spike_inds[start : start + chunk_size]
+        selected[start : start + chunk_inds.size] = data[chunk_inds]
+
+    selected.flush()
+
+    return selected
+
+
+# cache of the unwhitened templates, written next to templates.npy, and the
+# signatures of the files it was computed from
+UNWHITENED_TEMPLATES_FILE = "templates_unwhitened.npy"
+UNWHITENED_TEMPLATES_INFO = "templates_unwhitened.json"
+
+
+def unwhiten_templates(templates, whitening_mat_inv, dtype="float64"):
+    """
+    Unwhitens all templates at once
+
+    Each template (samples x channels) is multiplied by the inverse of the
+    whitening matrix, with one matmul over the whole stack.
+
+    Inputs:
+    -------
+    templates : numpy.ndarray (M x samples x channels)
+        Whitened templates, as in templates.npy
+    whitening_mat_inv : numpy.ndarray (channels x channels)
+        Inverse of the whitening matrix
+    dtype : String (optional)
+        Data type of the result; 'float32' halves the memory
+
+    Outputs:
+    --------
+    unwhitened_templates : numpy.ndarray (M x samples x channels)
+
+    """
+
+    return np.matmul(
+        np.asarray(templates).astype(dtype, copy=False),
+        np.asarray(whitening_mat_inv).astype(dtype, copy=False),
+    )
+
+
+def load_unwhitened_templates(folder, dtype="float64", use_cache=True):
+    """
+    Unwhitened templates of a Kilosort output directory, cached on disk
+
+    The result of unwhiten_templates (for templates.npy with any NaNs set to
+    zero) is saved in folder, with the modification time, size and SHA-256
+    hash of templates.npy and whitening_mat_inv.npy. Later calls load the
+    cache if both files still match: unchanged modification times are
+    trusted, otherwise the hashes are compared. Any change to either file
+    (e.g. new templates after re-sorting) recomputes the cache.
+
+    Inputs:
+    -------
+    folder : String
+        Location of Kilosort output directory
+    dtype : String (optional)
+        Data type of the templates ('float64' or 'float32')
+    use_cache : bool (optional)
+        If False, the templates are always recomputed and no cache is written
+
+    Outputs:
+    --------
+    unwhitened_templates : numpy.ndarray (M x samples x channels)
+        Including any zero padding at the start of the templates
+
+    """
+
+    sources = ["templates.npy", "whitening_mat_inv.npy"]
+
+    info_path = os.path.join(folder, UNWHITENED_TEMPLATES_INFO)
+
+    if use_cache and os.path.isfile(info_path) and os.path.isfile(
+        os.path.join(folder, UNWHITENED_TEMPLATES_FILE)
+    ):
+        with open(info_path) as f:
+            info = json.load(f)
+
+        if info.get("dtype") == dtype and all(
+            _same_file(os.path.join(folder, name), info.get(name)) for name in sources
+        ):
+            return load(folder, UNWHITENED_TEMPLATES_FILE)
+
+    unwhitened_templates = unwhiten_templates(
+        np.nan_to_num(load(folder, "templates.npy")),
+        load(folder, "whitening_mat_inv.npy"),
+        dtype,
+    )
+
+    if use_cache:
+        info = {name: _file_signature(os.path.join(folder, name)) for name in sources}
+        info["dtype"] = dtype
+        try:
+            save(folder, UNWHITENED_TEMPLATES_FILE, unwhitened_templates)
+            with open(info_path, "w") as f:
+                json.dump(info, f, indent=2)
+        except OSError:
+            print("Could not cache the unwhitened templates in " + folder)
+
+    return unwhitened_templates
+
+
+def _file_signature(file_path):
+
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            sha.update(block)
+
+    stat = os.stat(file_path)
+
+    return {
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sha256": sha.hexdigest(),
+    }
+
+
+def _same_file(file_path, signature):
+
+    if signature is None or not os.path.isfile(file_path):
+        return False
+
+    stat = os.stat(file_path)
+
+    if stat.st_size != signature["size"]:
+        return False
+
+    if stat.st_mtime_ns == signature["mtime_ns"]:
+        return True
+
+    return _file_signature(file_path)["sha256"] == signature["sha256"]
+
+
+class KilosortDataset:
+    """
+    Kilosort output files in a directory, each loaded when first used
+
+    Every property reads (and, where needed, processes) its files on first
+    access and keeps the result, so a module only pays for the data it
+    actually uses; e.g. the templates are never loaded or unwhitened by code
+    that only needs the spike times.
+
+    Inputs:
+    -------
+    folder : String
+        Location of Kilosort output directory
+    sample_rate : float (optional)
+        AP band sample rate in Hz, needed for spike_times_seconds
+    use_master_clock : bool (optional)
+        Flags whether to load spike times that have been converted to the master clock timebase
+    template_zero_padding : int (default = 21)
+        Number of zeros added to the beginning of each template
+    mmap_mode : String (optional)
+        If set (e.g. 'r'), pc_features and template_features are memory-maps
+        instead of being read into memory
+    unwhitened_dtype : String (optional)
+        Data type of unwhitened_templates ('float64' or 'float32')
+    cache_unwhitened : bool (optional)
+        Flags whether unwhitened_templates are cached in folder (see
+        load_unwhitened_templates)
+
+    The modification time and size of every file are recorded when it is
+    read. refresh() drops the properties that depend on files changed since
+    then, and save() writes a file and keeps the new data, so one dataset can
+    be shared by several modules that rewrite the outputs (see
+    common.dataset_context).
+
+    """
+
+    # cached properties that depend on each file
+    _FILE_PROPERTIES = {
+        "spike_times.npy": ["spike_times", "spike_times_seconds"],
+        "spike_times_master_clock.npy": ["spike_times", "spike_times_seconds"],
+        "spike_clusters.npy": ["spike_clusters", "cluster_ids", "cluster_quality"],
+        "spike_templates.npy": ["spike_templates"],
+        "amplitudes.npy": ["amplitudes"],
+        "templates.npy": [
+            "templates",
+            "num_templates",
+            "unwhitened_templates",
+            "cluster_amplitude",
+        ],
+        "whitening_mat_inv.npy": ["whitening_mat_inv", "unwhitened_templates"],
+        "channel_map.npy": ["channel_map"],
+        "channel_positions.npy": ["channel_pos"],
+        "cluster_Amplitude.tsv": ["cluster_amplitude"],
+        "pc_features.npy": ["pc_features"],
+        "pc_feature_ind.npy": ["pc_feature_ind"],
+        "template_features.npy": ["template_features"],
+    }
+
+    def __init__(
+        self,
+        folder,
+        sample_rate=None,
+        use_master_clock=False,
+        template_zero_padding=21,
+        mmap_mode=None,
+        unwhitened_dtype="float64",
+        cache_unwhitened=True,
+    ):
+        self.folder = folder
+        self.sample_rate = sample_rate
+        self.use_master_clock = use_master_clock
+        self.template_zero_padding = template_zero_padding
+        self.mmap_mode = mmap_mode
+        self.unwhitened_dtype = unwhitened_dtype
+        self.cache_unwhitened = cache_unwhitened
+        self._file_stats = {}
+
+    def _record(self, filename):
+        """Remember the modification time and size of a file that was read"""
+        try:
+            stat = os.stat(os.path.join(self.folder, filename))
+            self._file_stats[filename] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            self._file_stats[filename] = None
+
+    def _load(self, filename, mmap_mode=None):
+        self._record(filename)
+        return load(self.folder, filename, mmap_mode)
+
+    @property
+    def _spike_times_file(self):
+        if self.use_master_clock:
+            return "spike_times_master_clock.npy"
+        return "spike_times.npy"
+
+    def invalidate(self, filename=None):
+        """
+        Drop cached data, so it is read again when next used
+
+        Inputs:
+        -------
+        filename : String (optional)
+            Only drop the properties that depend on this file; all if None
+
+        """
+
+        if filename is None:
+            filenames = list(self._FILE_PROPERTIES)
+        else:
+            filenames = [filename]
+
+        for name in filenames:
+            for prop in self._FILE_PROPERTIES.get(name, []):
+                self.__dict__.pop(prop, None)
+            self._file_stats.pop(name, None)
+
+    def refresh(self):
+        """
+        Drop cached data read from files that have changed on disk
+
+        Outputs:
+        --------
+        changed : list of Strings
+            Names of the files that were modified, replaced or removed
+
+        """
+
+        changed = []
+
+        for filename, recorded in list(self._file_stats.items()):
+            try:
+                stat = os.stat(os.path.join(self.folder, filename))
+                current = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                current = None
+            if current != recorded:
+                changed.append(filename)
+
+        for filename in changed:
+            self.invalidate(filename)
+
+        return changed
+
+    def save(self, filename, data):
+        """
+        Save an output file and keep the new data for later use
+
+        Drops everything derived from the old contents of the file. The new
+        spike arrays (and PC and template features, if they have the form
+        mmap_mode would load) are used as they are instead of being read
+        back from disk.
+
+        Inputs:
+        -------
+        filename : String
+            Name of the file in folder
+        data : numpy.ndarray
+            New contents of the file
+
+        """
+
+        save(self.folder, filename, data)
+
+        self.invalidate(filename)
+
+        if filename == self._spike_times_file:
+            self.__dict__["spike_times"] = np.squeeze(data)
+        elif filename == "spike_clusters.npy":
+            self.__dict__["spike_clusters"] = np.squeeze(data)
+        elif filename == "spike_templates.npy":
+            self.__dict__["spike_templates"] = data
+        elif filename == "amplitudes.npy":
+            self.__dict__["amplitudes"] = data
+        elif filename in ("pc_features.npy", "template_features.npy"):
+            if isinstance(data, np.memmap) == (self.mmap_mode is not None):
+                self.__dict__[filename[: -len(".npy")]] = data
+        else:
+            return
+
+        self._record(filename)
+
+    @cached_property
+    def spike_times(self):
+        """Spike times in samples (N x 0)"""
+        spike_times = self._load(self._spike_times_file)
+        return np.squeeze(spike_times)  # fix dimensions
+
+    @cached_property
+    def spike_times_seconds(self):
+        """Spike times in seconds (N x 0); requires sample_rate"""
+        return self.spike_times / self.sample_rate
+
+    @cached_property
+    def spike_clusters(self):
+        """Cluster IDs for N spikes"""
+        return np.squeeze(self._load("spike_clusters.npy"))  # fix dimensions
+
+    @cached_property
+    def spike_templates(self):
+        """Template IDs for N spikes"""
+        return self._load("spike_templates.npy")
+
+    @cached_property
+    def amplitudes(self):
+        """Amplitudes for N spikes"""
+        return self._load("amplitudes.npy")
+
+    @cached_property
+    def templates(self):
+        """Whitened templates (M x samples x channels), without zero padding"""
+
+        templates = self._load("templates.npy")
+
+        # fix any nans in templates
+        if np.sum(np.isnan(templates)):
+            templates = np.nan_to_num(templates)
+            np.save(os.path.join(self.folder, "templates.npy"), templates)
+            self._record("templates.npy")
+
+        # zero padding differs between sort versions, so derive from the
+        # values in the templates
+        s1 = np.nansum(templates, axis=0)
+        s2 = np.nansum(s1, axis=1)
+        wz = np.where(s2 == 0)
+        if np.any(wz[0]):
+            self.template_zero_padding = np.max(wz) + 1
+            print("template zero padding: " + repr(self.template_zero_padding))
+            templates = templates[:, self.template_zero_padding :, :]  # remove zeros
+
+        return templates
+
+    @cached_property
+    def num_templates(self):
+        """Number of templates (M), read from the file header if not loaded"""
+        if "templates" in self.__dict__:
+            return self.templates.shape[0]
+        return self._load("templates.npy", mmap_mode="r").shape[0]
+
+    @cached_property
+    def whitening_mat_inv(self):
+        """Inverse of the whitening matrix (channels x channels)"""
+        return self._load("whitening_mat_inv.npy")
+
+    @cached_property
+    def unwhitened_templates(self):
+        """Templates in the original (unwhitened) space (M x samples x channels)"""
+
+        templates = self.templates
+
+        # the cache holds the full templates; remove the same zero padding
+        unwhitened_templates = load_unwhitened_templates(
+            self.folder, self.unwhitened_dtype, self.cache_unwhitened
+        )
+        self._record("whitening_mat_inv.npy")
+
+        padding = unwhitened_templates.shape[1] - templates.shape[1]
+
+        return unwhitened_templates[:, padding:, :]
+
+    @cached_property
+    def channel_map(self):
+        """Channels from original data file used for sorting"""
+        return self._load("channel_map.npy")
+
+    @cached_property
+    def channel_pos(self):
+        """X and Z coordinates for each channel used in the sort (channels x 2)"""
+        return self._load("channel_positions.npy")
+
+    @cached_property
+    def cluster_ids(self):
+        """IDs of the clusters with spikes"""
+        # removed option to read cluster_ids from cluster_group_tsv because this file is changed by phy.
+        return np.unique(self.spike_clusters)
+
+    @cached_property
+    def cluster_quality(self):
+        """Quality rating of each cluster (all 'unsorted')"""
+        return ["unsorted"] * self.cluster_ids.size
+
+    @cached_property
+    def cluster_amplitude(self):
+        """Average amplitude of each template, from cluster_Amplitude.tsv"""
+
+        self._record("cluster_Amplitude.tsv")
+        cluster_amplitude = read_cluster_amplitude_tsv(
+            os.path.join(self.folder, "cluster_Amplitude.tsv")
+        )
+
+        # check that cluster_amplitude has the same number of entries as templates
+        # if highest index units have no spikes, they will not have an entry in cluster_Amplitudes.tsv
+        diff = self.num_templates - cluster_amplitude.size
+        if diff > 0:
+            pad = np.zeros((diff,))
+            cluster_amplitude = np.append(cluster_amplitude, pad)
+
+        return cluster_amplitude
+
+    @cached_property
+    def pc_features(self):
+        """PC features for each spike (N x num_PCs x channels), memory-mapped with mmap_mode"""
+        return self._load("pc_features.npy", self.mmap_mode)
+
+    @cached_property
+    def pc_feature_ind(self):
+        """Channels used for PC calculation for each unit (M x channels)"""
+        return self._load("pc_feature_ind.npy")
+
+    @cached_property
+    def template_features(self):
+        """Projections onto template features for each spike, or an empty array if absent"""
+        if os.path.isfile(os.path.join(self.folder, "template_features.npy")):
+            return self._load("template_features.npy", self.mmap_mode)
+        self._record("template_features.npy")
+        return np.asarray([])
 
 
 def load_kilosort_data(
@@ -249,10 +834,14 @@ def load_kilosort_data(
     use_master_clock=False,
     include_pcs=False,
     template_zero_padding=21,
+    mmap_mode=None,
 ):
     """
     Loads Kilosort output files from a directory
 
+    Reads everything through a KilosortDataset; code that only needs some of
+    the outputs should use a KilosortDataset directly.
+
     Inputs:
     -------
     folder : String
@@ -267,6 +856,9 @@ def load_kilosort_data(
         Flags whether to load spike principal components (large file)
     template_zero_padding : int (default = 21)
         Number of zeros added to the beginning of each template
+    mmap_mode : String (optional)
+        If set (e.g. 'r'), pc_features and template_features are returned as
+        memory-maps instead of being read into memory
 
     Outputs:
     --------
@@ -299,103 +891,35 @@ def load_kilosort_data(
 
     """
 
-    if use_master_clock:
-        spike_times = load(folder, "spike_times_master_clock.npy")
-    else:
-        spike_times = load(folder, "spike_times.npy")
-
-    spike_clusters = load(folder, "spike_clusters.npy")
-    spike_templates = load(folder, "spike_templates.npy")
-    amplitudes = load(folder, "amplitudes.npy")
-    templates = load(folder, "templates.npy")
-    unwhitening_mat = load(folder, "whitening_mat_inv.npy")
-    channel_map = load(folder, "channel_map.npy")
-    channel_pos = load(folder, "channel_positions.npy")
-
-    if include_pcs:
-        pc_features = load(folder, "pc_features.npy")
-        pc_feature_ind = load(folder, "pc_feature_ind.npy")
-        if os.path.isfile(os.path.join(folder, "template_features.npy")):
-            template_features = load(folder, "template_features.npy")
-        else:
-            template_features = np.asarray([])
-
-    # fix any nans in templates
-    if np.sum(np.isnan(templates)):
-        templates = np.nan_to_num(templates)
-        np.save(os.path.join(folder, "templates.npy"), templates)
-
-    # zero padding differs between sort versions, so derive from the
-    # values in the templates
-    s1 = np.nansum(templates, axis=0)
-    s2 = np.nansum(s1, axis=1)
-    wz = np.where(s2 == 0)
-    if np.any(wz[0]):
-        template_zero_padding = np.max(wz) + 1
-        print("template zero padding: " + repr(template_zero_padding))
-        templates = templates[:, template_zero_padding:, :]  # remove zeros
-
-    spike_clusters = np.squeeze(spike_clusters)  # fix dimensions
-    spike_times = np.squeeze(spike_times)  # fix dimensions
+    dataset = KilosortDataset(
+        folder, sample_rate, use_master_clock, template_zero_padding, mmap_mode
+    )
 
     if convert_to_seconds and sample_rate is not None:
-        spike_times = spike_times / sample_rate
-
-    unwhitened_temps = np.zeros((templates.shape))
-
-    for temp_idx in range(templates.shape[0]):
-
-        unwhitened_temps[temp_idx, :, :] = np.dot(
-            np.ascontiguousarray(templates[temp_idx, :, :]),
-            np.ascontiguousarray(unwhitening_mat),
-        )
-
-    # removed option to read cluster_ids from cluster_group_tsv because this file is changed by phy.
-    # try:
-    #     cluster_ids, cluster_quality = read_cluster_group_tsv(os.path.join(folder, 'cluster_group.tsv'))
-    # except OSError:
-    cluster_ids = np.unique(spike_clusters)
-    cluster_quality = ["unsorted"] * cluster_ids.size
-
-    cluster_amplitude = read_cluster_amplitude_tsv(
-        os.path.join(folder, "cluster_Amplitude.tsv")
+        spike_times = dataset.spike_times_seconds
+    else:
+        spike_times = dataset.spike_times
+
+    outputs = (
+        spike_times,
+        dataset.spike_clusters,
+        dataset.spike_templates,
+        dataset.amplitudes,
+        dataset.unwhitened_templates,
+        dataset.channel_map,
+        dataset.channel_pos,
+        dataset.cluster_ids,
+        dataset.cluster_quality,
+        dataset.cluster_amplitude,
     )
 
-    # check that cluster_amplitude has the same number of entries as templates
-    # if highest index units have no spikes, they will not have an entry in cluster_Amplitudes.tsv
-    diff = templates.shape[0] - cluster_amplitude.size
-    if diff > 0:
-        pad = np.zeros((diff,))
-        cluster_amplitude = np.append(cluster_amplitude, pad)
-
     if not include_pcs:
-        return (
-            spike_times,
-            spike_clusters,
-            spike_templates,
-            amplitudes,
-            unwhitened_temps,
-            channel_map,
-            channel_pos,
-            cluster_ids,
-            cluster_quality,
-            cluster_amplitude,
-        )
+        return outputs
     else:
-        return (
-            spike_times,
-            spike_clusters,
-            spike_templates,
-            amplitudes,
-            unwhitened_temps,
-            channel_map,
-            channel_pos,
-            cluster_ids,
-            cluster_quality,
-            cluster_amplitude,
-            pc_features,
-            pc_feature_ind,
-            template_features,
+        return outputs + (
+            dataset.pc_features,
+            dataset.pc_feature_ind,
+            dataset.template_features,
         )
 
 
@@ -456,6 +980,83 @@ def get_spike_depths(
     return spike_depths
 
 
+def get_spike_depths_from_pcs(
+    pc_features,
+    spike_clusters,
+    unit_template_ids,
+    pc_feature_ind,
+    channel_pos,
+    spike_mask=None,
+    chunk_size=SPIKE_CHUNK_SIZE,
+):
+    """
+    Calculates spike depths with get_spike_depths, reading the first PC of
+    each spike from pc_features chunk_size spikes at a time
+
+    Only one chunk of pc_features is in memory at once, so pc_features can be
+    memory-mapped (load_kilosort_data with mmap_mode set).
+
+    Input:
+    -----
+    pc_features : numpy.ndarray (N x num_PCs x template channels)
+        PC features for each spike
+    spike_clusters : numpy.ndarray (N x 0)
+        Cluster IDs for N spikes
+    unit_template_ids : numpy.ndarray (Nclusters x 0)
+        majority template assignment for each cluster ID
+    pc_feature_ind  : numpy.ndarray (M x channels)
+        Channels used for PC calculation for each unit
+    channel_pos : (channels x 2)
+        X and Y/depth position of each channel, in um
+    spike_mask : numpy.ndarray (N x 0) (optional)
+        True for spikes to include; defaults to all spikes
+    chunk_size : int (optional)
+        Number of spikes to read at a time
+
+    Output:
+    ------
+    spike_depths : numpy.ndarray (number of selected spikes x 0)
+        Distance (in microns) from each selected spike waveform from the probe tip
+
+    """
+
+    num_spikes = pc_features.shape[0]
+
+    if spike_mask is None:
+        spike_mask = np.ones((num_spikes,), dtype=bool)
+
+    spike_depths = []
+
+    for start in range(0, num_spikes, chunk_size):
+
+        in_chunk = spike_mask[start : start + chunk_size]
+        if not np.any(in_chunk):
+            continue
+
+        # first pc on each site for these spikes; the fancy index makes a copy
+        # of just this chunk, so pc_features is not altered
+        first_pc_sq = pc_features[start : start + chunk_size][in_chunk, 0, :]
+        # set negative pc_features to zero before taking square
+        first_pc_sq[first_pc_sq < 0] = 0
+        # elementwise square
+        first_pc_sq = pow(first_pc_sq, 2)
+
+        spike_depths.append(
+            get_spike_depths(
+                spike_clusters[start : start + chunk_size][in_chunk],
+                unit_template_ids,
+                first_pc_sq,
+                pc_feature_ind,
+                channel_pos,
+            )
+        )
+
+    if len(spike_depths) == 0:
+        return np.zeros((0,))
+
+    return np.concatenate(spike_depths)
+
+
 def get_spike_amplitudes(spike_templates, templates, amplitudes):
     """
     Calculates the amplitude of individual spikes, based on the original template
@@ -654,52 +1255,78 @@ def catGT_ex_params_from_str(ex_str):
     return ex_type, stream_index, prb_index, ex_name_str
 
 
+def cluster_table(spike_clusters, spike_templates, templates, channel_map):
+
+    """
+    Spike count and peak channel of each cluster label (the C_Waves clus_Table)
+
+    The peak channel of a label is the channel with the largest peak-to-peak
+    amplitude in its most common template, so units that were merged or split
+    in phy get the peak channel of the template that found most of their spikes.
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    spike_templates : numpy.ndarray (num_spikes x 0)
+        Template IDs for each spike time
+    templates : numpy.ndarray (num_templates x num_samples x num_channels)
+        Unwhitened templates
+    channel_map : numpy.ndarray (num_channels x 0)
+        Channels from the original data file used for sorting
+
+    Outputs:
+    --------
+    clus_table : numpy.ndarray (max_label + 1 x 2), uint32
+        Spike count (0) and peak channel in the data file (1) for each label;
+        zero for labels without spikes
+
+    """
+
+    spike_clusters = np.squeeze(spike_clusters).astype("int64")
+    spike_templates = np.squeeze(spike_templates).astype("int64")
+    channel_map = np.squeeze(channel_map)
+
+    total_units = np.max(spike_clusters) + 1
+    total_templates = max(templates.shape[0], np.max(spike_templates) + 1)
+
+    # spikes of each (label, template) pair; for each label, the template with
+    # the most spikes (the lowest ID on ties, as with np.argmax(np.bincount))
+    pairs, pair_counts = np.unique(spike_clusters * total_templates + spike_templates, return_counts=True)
+    pair_labels, pair_templates = np.divmod(pairs, total_templates)
+
+    order = np.lexsort((pair_templates, -pair_counts, pair_labels))
+    first = np.ones((order.size,), dtype="bool")
+    first[1:] = np.diff(pair_labels[order]) != 0
+
+    labels = pair_labels[order][first]
+    template_mode = pair_templates[order][first]
+
+    template_ptp = np.max(templates, 1) - np.min(templates, 1)
+
+    clus_table = np.zeros((total_units, 2), dtype="uint32")
+    clus_table[:, 0] = np.bincount(spike_clusters, minlength=total_units)
+    clus_table[labels, 1] = channel_map[np.argmax(template_ptp[template_mode], 1)]
+
+    return clus_table
+
+
 def getSortResults(output_dir, clu_version):
     # load results from phy for run logging and creation of the table for C_Waves
 
     cluLabel = np.load(os.path.join(output_dir, "spike_clusters.npy"))
     spkTemplate = np.load(os.path.join(output_dir, "spike_templates.npy"))
     cluLabel = np.squeeze(cluLabel)
-    spkTemplate = np.squeeze(spkTemplate)
 
-    unqLabel, labelCounts = np.unique(cluLabel, return_counts=True)
     nTot = cluLabel.shape[0]
-    nLabel = unqLabel.shape[0]
-    maxLabel = np.max(unqLabel)
 
-    templates = np.load(os.path.join(output_dir, "templates.npy"))
     channel_map = np.load(os.path.join(output_dir, "channel_map.npy"))
-    channel_map = np.squeeze(channel_map)
 
-    # read in inverse of whitening matrix
-    w_inv = np.load((os.path.join(output_dir, "whitening_mat_inv.npy")))
-    nTemplate = templates.shape[0]
-
-    # initialize peak_channels array
-    peak_channels = np.zeros(
-        [
-            nLabel,
-        ],
-        "uint32",
-    )
+    # unwhitened templates, from the cache written by any earlier module
+    unwhitened = load_unwhitened_templates(output_dir)
+    nTemplate = unwhitened.shape[0]
 
-    # After manual splits or merges, some labels will have spikes found with
-    # different templats.
-    # for each label in the list unqLabel, get the most common template
-    # For that template (nt x nchan), multiply the the transpose (nchan x nt) by inverse of
-    # the whitening matrix (nchan x nchan); get max and min along tthe time axis (1)
-    # to find the peak channel
-    for i in np.arange(0, nLabel):
-        curr_spkTemplate = spkTemplate[np.where(cluLabel == unqLabel[i])]
-        template_mode = np.argmax(np.bincount(curr_spkTemplate))
-        currT = templates[template_mode, :].T
-        curr_unwh = np.matmul(w_inv, currT)
-        currdiff = np.max(curr_unwh, 1) - np.min(curr_unwh, 1)
-        peak_channels[i] = channel_map[np.argmax(currdiff)]
-
-    clus_Table = np.zeros((maxLabel + 1, 2), dtype="uint32")
-    clus_Table[unqLabel, 0] = labelCounts
-    clus_Table[unqLabel, 1] = peak_channels
+    clus_Table = cluster_table(cluLabel, spkTemplate, unwhitened, channel_map)
 
     if clu_version == 0:
         np.save(os.path.join(output_dir, "clus_Table.npy"), clus_Table)
@@ -3,13 +3,14 @@ import matplotlib.pyplot as plt
 
 from scipy.signal import butter, filtfilt, medfilt
 
-from .utils import (get_spike_depths, 
+from .snippets import gather_snippets
+from .utils import (get_spike_depths_from_pcs, 
                     get_spike_amplitudes,
-                    load_kilosort_data,
+                    KilosortDataset,
                     rms)
 
 
-def plotKsTemplates(ks_directory, raw_data_file, sample_rate = 30000, bit_volts = 0.195, time_range = [10, 11], exclude_noise=True, fig=None, output_path=None):
+def plotKsTemplates(ks_directory, raw_data_file, sample_rate = 30000, bit_volts = 0.195, time_range = [10, 11], exclude_noise=True, fig=None, output_path=None, mmap_mode='r'):
 
     """
     Compares the template-based model to the raw data
@@ -32,6 +33,8 @@ def plotKsTemplates(ks_directory, raw_data_file, sample_rate = 30000, bit_volts
         Figure handle to use for plotting
     output_path : str
         Path for saving the image
+    mmap_mode : str
+        Passed to KilosortDataset; 'r' memory-maps pc_features instead of loading them
 
     Outputs:
     --------
@@ -39,13 +42,15 @@ def plotKsTemplates(ks_directory, raw_data_file, sample_rate = 30000, bit_volts
 
     """
 
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-    channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features= \
-                load_kilosort_data(ks_directory, 
-                    sample_rate, 
-                    convert_to_seconds = False,
-                    use_master_clock = False,
-                    include_pcs = True)
+    dataset = KilosortDataset(ks_directory, sample_rate, mmap_mode = mmap_mode)
+
+    spike_times = dataset.spike_times
+    spike_templates = dataset.spike_templates
+    amplitudes = dataset.amplitudes
+    templates = dataset.unwhitened_templates
+    channel_map = dataset.channel_map
+    clusterIDs = dataset.cluster_ids
+    cluster_quality = dataset.cluster_quality
 
     raw_data = np.memmap(raw_data_file, dtype='int16')
     data = np.reshape(raw_data, (int(raw_data.size / 384), 384))
@@ -108,7 +113,101 @@ def plotKsTemplates(ks_directory, raw_data_file, sample_rate = 30000, bit_volts
         plt.close('all')
 
 
-def plotDriftmap(ks_directory, sample_rate = 30000, time_range = [0, np.inf], exclude_noise=True, subselection = 50, fig=None, output_path=None):
+def plotUnitWaveforms(ks_directory, raw_data_file, cluster_id, sample_rate = 30000, bit_volts = 0.195, num_channels = 384, num_spikes = 100, pre_samples = 20, samples_per_spike = 82, channel_range = 8, fig=None, output_path=None):
+
+    """
+    Plots individual and mean waveforms of one unit around its peak channel
+
+    The snippets are read with gather_snippets, so only the samples around
+    the chosen spikes are read from the raw data file.
+
+    Inputs:
+    ------
+    ks_directory : str
+        Path to Kilosort outputs
+    raw_data_file : str
+        Path to raw .dat or .bin file
+    cluster_id : int
+        Unit to plot
+    sample_rate : float
+        Sample rate of original data (Hz)
+    bit_volts : float
+        Conversion factor for raw data to microvolts
+    num_channels : int
+        Number of channels in the raw data file
+    num_spikes : int
+        Max number of spikes to plot (chosen at random)
+    pre_samples : int
+        Number of samples before the peak
+    samples_per_spike : int
+        Number of samples per waveform
+    channel_range : int
+        Number of channels above and below the peak channel to plot
+    fig : matplotlib.pyplot.figure
+        Figure handle to use for plotting
+    output_path : str
+        Path for saving the image
+
+    Outputs:
+    --------
+    Saves image to output_path (optional)
+
+    """
+
+    dataset = KilosortDataset(ks_directory, sample_rate)
+
+    spike_times = dataset.spike_times
+    spike_clusters = dataset.spike_clusters
+    spike_templates = dataset.spike_templates
+    templates = dataset.unwhitened_templates
+    channel_map = dataset.channel_map
+
+    raw_data = np.memmap(raw_data_file, dtype='int16', mode='r')
+    data = np.reshape(raw_data, (int(raw_data.size / num_channels), num_channels))
+
+    starts = spike_times[spike_clusters == cluster_id].astype('int64') - pre_samples
+    starts = starts[(starts >= 0) * (starts + samples_per_spike <= data.shape[0])]
+
+    if starts.size > num_spikes:
+        starts = np.random.choice(starts, num_spikes, replace=False)
+
+    # peak channel of the unit's most common template
+    template_id = np.argmax(np.bincount(spike_templates[spike_clusters == cluster_id]))
+    template = templates[template_id]
+    peak_index = np.argmax(np.max(template, 0) - np.min(template, 0))
+
+    channel_indices = np.arange(max(peak_index - channel_range, 0), min(peak_index + channel_range + 1, channel_map.size))
+    channels = np.squeeze(channel_map)[channel_indices]
+
+    waveforms = gather_snippets(data, starts, samples_per_spike, bit_volts, channels).scaled()
+    waveforms -= np.mean(waveforms[:, :, :5], 2)[:, :, np.newaxis]
+
+    if fig is None:
+        fig = plt.figure(figsize=(6,12))
+
+    ax = plt.subplot(111)
+
+    t = (np.arange(samples_per_spike) - pre_samples) / sample_rate * 1000
+
+    spacing = max(np.max(np.abs(np.mean(waveforms, 0))), 1)
+
+    for i in range(channels.size):
+        ax.plot(t, waveforms[:, i, :].T + i * spacing, color='gray', alpha=0.1, linewidth=0.5)
+        ax.plot(t, np.mean(waveforms[:, i, :], 0) + i * spacing, color='k', linewidth=1.)
+
+    ax.set_yticks(np.arange(channels.size) * spacing)
+    ax.set_yticklabels(channels)
+
+    ax.set_xlabel('Time (ms)')
+    ax.set_ylabel('Channel')
+    ax.set_title('Unit ' + str(cluster_id) + ' (' + str(starts.size) + ' spikes)')
+
+    if output_path is not None:
+        plt.savefig(output_path)
+        plt.close('all')
+
+
+def plotDriftmap(ks_directory, sample_rate = 30000, time_range = [0, np.inf], exclude_noise=True, subselection = 50, fig=None, output_path=None, mmap_mode='r'):
 
     """
     Plots a "driftmap" of spike depths over time.
@@ -134,6 +233,8 @@ def plotDriftmap(ks_directory, sample_rate = 30000, time_range = [0, np.inf], ex
         Figure handle to use for plotting
     output_path : str
         Path for saving the image
+    mmap_mode : str
+        Passed to KilosortDataset; 'r' memory-maps pc_features instead of loading them
 
     Outputs:
     --------
@@ -141,14 +242,21 @@ def plotDriftmap(ks_directory, sample_rate = 30000, time_range = [0, np.inf], ex
 
     """
 
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-    channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                load_kilosort_data(ks_directory, 
-                    sample_rate, 
-                    use_master_clock = False,
-                    include_pcs = True)
-
-    spike_depths = get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos)
+    dataset = KilosortDataset(ks_directory, sample_rate, mmap_mode = mmap_mode)
+
+    spike_times = dataset.spike_times_seconds
+    spike_clusters = dataset.spike_clusters
+    spike_templates = dataset.spike_templates
+    amplitudes = dataset.amplitudes
+    templates = dataset.unwhitened_templates
+    channel_pos = dataset.channel_pos
+    clusterIDs = dataset.cluster_ids
+    cluster_quality = dataset.cluster_quality
+    pc_features = dataset.pc_features
+    pc_feature_ind = dataset.pc_feature_ind
+
+    # uncurated data: each spike's depth comes from the channels of its own template
+    spike_depths = get_spike_depths_from_pcs(pc_features, np.squeeze(spike_templates), np.arange(pc_feature_ind.shape[0]), pc_feature_ind, channel_pos)
     spike_amplitudes = get_spike_amplitudes(spike_templates, templates, amplitudes)
 
     if exclude_noise:
@@ -309,7 +417,7 @@ def plotContinuousFile(raw_data_file, sample_rate = 30000, bit_volts = 0.195, no
         plt.close('all')
         
 
-def plotFullProbeTSNE(ks_directory, total_spikes=150000, exclude_noise = True, fig=None, output_path = None):
+def plotFullProbeTSNE(ks_directory, total_spikes=150000, exclude_noise = True, fig=None, output_path = None, mmap_mode='r'):
 
     """
     Plots t-SNE embedding of spikes across the entire probe
@@ -335,6 +443,8 @@ def plotFullProbeTSNE(ks_directory, total_spikes=150000, exclude_noise = True, f
         Figure handle to use for plotting
     output_path : str
         Path for saving the image
+    mmap_mode : str
+        Passed to KilosortDataset; 'r' memory-maps pc_features instead of loading them
 
     Outputs:
     --------
@@ -353,13 +463,13 @@ def plotFullProbeTSNE(ks_directory, total_spikes=150000, exclude_noise = True, f
 
     from matplotlib.cm import get_cmap
 
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, channel_pos, \
-    clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                load_kilosort_data(ks_directory, 
-                    30000., 
-                    convert_to_seconds = False,
-                    use_master_clock = False,
-                    include_pcs = True)
+    dataset = KilosortDataset(ks_directory, 30000., mmap_mode = mmap_mode)
+
+    spike_clusters = dataset.spike_clusters
+    clusterIDs = dataset.cluster_ids
+    cluster_quality = dataset.cluster_quality
+    pc_features = dataset.pc_features
+    pc_feature_ind = dataset.pc_feature_ind
 
     if exclude_noise:
         good_units = clusterIDs[cluster_quality != 'noise']
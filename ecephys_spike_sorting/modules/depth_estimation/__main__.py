@@ -6,6 +6,7 @@ from pathlib import Path
 
 import numpy as np
 
+from ecephys_spike_sorting.common.instrumentation import span, trace_module
 from ecephys_spike_sorting.common.SGLXMetaToCoords import MetaToCoords
 from ecephys_spike_sorting.common.utils import write_probe_json
 from ecephys_spike_sorting.modules.depth_estimation.depth_estimation import (
@@ -17,6 +18,7 @@ from ecephys_spike_sorting.modules.utils import ObjectEncoder
 from ._schemas import DepthSchema
 
 
+@trace_module("depth_estimation")
 def run_depth_estimation(args):
 
     print("ecephys spike sorting: depth estimation module\n")
@@ -46,23 +48,25 @@ def run_depth_estimation(args):
 
     print("Computing surface channel...")
 
-    info_lfp = find_surface_channel(
-        dataLfp,
-        args["ephys_params"],
-        args["depth_estimation_params"],
-        xCoord,
-        yCoord,
-        shankInd,
-    )
-
-    write_probe_json(
-        args["common_files"]["probe_json"],
-        info_lfp["surface_y"],
-        info_lfp["air_y"],
-        np.squeeze(yCoord),
-        np.squeeze(xCoord),
-        np.squeeze(shankInd),
-    )
+    with span("find_surface_channel"):
+        info_lfp = find_surface_channel(
+            dataLfp,
+            args["ephys_params"],
+            args["depth_estimation_params"],
+            xCoord,
+            yCoord,
+            shankInd,
+        )
+
+    with span("write_probe_json"):
+        write_probe_json(
+            args["common_files"]["probe_json"],
+            info_lfp["surface_y"],
+            info_lfp["air_y"],
+            np.squeeze(yCoord),
+            np.squeeze(xCoord),
+            np.squeeze(shankInd),
+        )
 
     execution_time = time.time() - start
 
@@ -1,9 +1,14 @@
 from marshmallow import INCLUDE, Schema
-from marshmallow.fields import Bool, Float, Int, Nested, String
+from marshmallow.fields import Bool, Dict, Float, Int, Nested, String
 
 from ecephys_spike_sorting.modules.schema_fields import NumpyArray, OutputFile
 
-from ...common.schemas import CommonFiles, Directories, EphysParams
+from ...common.schemas import (
+    CommonFiles,
+    Directories,
+    EphysParams,
+    InstrumentationParams,
+)
 
 
 class DepthEstimationParams(Schema):
@@ -81,6 +86,7 @@ class InputParameters(Schema):
     ephys_params = Nested(EphysParams)
     directories = Nested(Directories)
     common_files = Nested(CommonFiles)
+    instrumentation_params = Nested(InstrumentationParams, required=False)
 
 
 class OutputSchema(Schema):
@@ -102,6 +108,7 @@ class OutputParameters(OutputSchema):
     air_channel = Int()
     probe_json = String()
     execution_time = Float()
+    spans = Dict(required=False, help="Tree of timing and memory spans of the run")
 
 
 class DepthSchema(Schema):
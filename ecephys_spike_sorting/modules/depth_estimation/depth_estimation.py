@@ -7,6 +7,7 @@ import numpy as np
 from scipy.ndimage.filters import gaussian_filter1d
 from scipy.signal import welch
 
+from ecephys_spike_sorting.common.instrumentation import span
 from ecephys_spike_sorting.common.OEFileInfo import get_lfp_channel_order
 from ecephys_spike_sorting.common.SGLXMetaToCoords import MetaToCoords
 from ecephys_spike_sorting.common.utils import find_range, printProgressBar, rms
@@ -148,32 +149,34 @@ def find_surface_channel(lfp_data, ephys_params, params, xCoord, yCoord, shankIn
         startPt = int(sample_frequency * params["skip_s_per_pass"] * p)
         endPt = startPt + int(sample_frequency)
 
-        chunk = np.copy(lfp_data[startPt:endPt, channels])
-        chunk = chunk[:, chunk_order]
+        with span("read_lfp_chunk", pass_index=p):
+            chunk = np.copy(lfp_data[startPt:endPt, channels])
+            chunk = chunk[:, chunk_order]
 
-        # subtract dc offset for all channels
-        for ch in np.arange(nchannels_used):
-            chunk[:, ch] = chunk[:, ch] - np.median(chunk[:, ch])
+            # subtract dc offset for all channels
+            for ch in np.arange(nchannels_used):
+                chunk[:, ch] = chunk[:, ch] - np.median(chunk[:, ch])
 
-        # reduce noise by correcting each timepoint with the signal in saline
-        # if there are no channels in the saline range, print messag
-        if saline_chan.any() == True:
-            saline_chunk = np.squeeze(chunk[:, saline_chan])
-            saline_median = np.median(saline_chunk, 1)
+            # reduce noise by correcting each timepoint with the signal in saline
+            # if there are no channels in the saline range, print messag
+            if saline_chan.any() == True:
+                saline_chunk = np.squeeze(chunk[:, saline_chan])
+                saline_median = np.median(saline_chunk, 1)
 
-            for ch in np.arange(nchannels_used):
-                chunk[:, ch] = chunk[:, ch] - saline_median
+                for ch in np.arange(nchannels_used):
+                    chunk[:, ch] = chunk[:, ch] - saline_median
 
-        power = np.zeros((int(nfft / 2 + 1), nchannels_used))
+        with span("power_spectra", pass_index=p):
+            power = np.zeros((int(nfft / 2 + 1), nchannels_used))
 
-        for ch in np.arange(nchannels_used):
+            for ch in np.arange(nchannels_used):
 
-            printProgressBar(p * nchannels_used + ch + 1, nchannels_used * n_passes)
+                printProgressBar(p * nchannels_used + ch + 1, nchannels_used * n_passes)
 
-            sample_frequencies, Pxx_den = welch(
-                chunk[:, ch], fs=sample_frequency, nfft=nfft
-            )
-            power[:, ch] = Pxx_den
+                sample_frequencies, Pxx_den = welch(
+                    chunk[:, ch], fs=sample_frequency, nfft=nfft
+                )
+                power[:, ch] = Pxx_den
 
         in_range = find_range(sample_frequencies, 0, params["max_freq"])
 
@@ -205,18 +208,19 @@ def find_surface_channel(lfp_data, ephys_params, params, xCoord, yCoord, shankIn
     print(repr(output_dict))
 
     if save_figure:
-        plot_results(
-            chunk,
-            power,
-            in_range,
-            values,
-            nchannels_used,
-            chan_y[chunk_order],
-            surface_y,
-            power_thresh,
-            diff_thresh,
-            params["figure_location"],
-        )
+        with span("plot_results"):
+            plot_results(
+                chunk,
+                power,
+                in_range,
+                values,
+                nchannels_used,
+                chan_y[chunk_order],
+                surface_y,
+                power_thresh,
+                diff_thresh,
+                params["figure_location"],
+            )
 
     return output_dict
 
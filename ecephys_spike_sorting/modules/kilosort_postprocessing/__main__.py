@@ -7,11 +7,14 @@ import numpy as np
 
 from ecephys_spike_sorting.modules.utils import ObjectEncoder
 
-from ...common.utils import getSortResults, load_kilosort_data
+from ...common.dataset_context import kilosort_dataset
+from ...common.instrumentation import span, trace_module
+from ...common.utils import getSortResults, save
 from ._schemas import PostprocessingSchema
 from .postprocessing import align_spike_times, remove_double_counted_spikes
 
 
+@trace_module("kilosort_postprocessing")
 def run_postprocessing(args):
 
     print("ecephys spike sorting: kilosort postprocessing module")
@@ -25,113 +28,106 @@ def run_postprocessing(args):
 
     include_pcs = args["ks_postprocessing_params"]["include_pcs"]
 
-    if include_pcs:
-        (
-            spike_times,
-            spike_clusters,
-            spike_templates,
-            amplitudes,
-            templates,
-            channel_map,
-            channel_pos,
-            clusterIDs,
-            cluster_quality,
-            cluster_amplitude,
-            pc_features,
-            pc_feature_ind,
-            template_features,
-        ) = load_kilosort_data(
-            args["directories"]["kilosort_output_directory"],
-            args["ephys_params"]["sample_rate"],
-            convert_to_seconds=False,
-            use_master_clock=False,
-            include_pcs=include_pcs,
-        )
-    else:
-        (
-            spike_times,
-            spike_clusters,
-            spike_templates,
-            amplitudes,
-            templates,
-            channel_map,
-            channel_pos,
-            clusterIDs,
-            cluster_quality,
-            cluster_amplitude,
-        ) = load_kilosort_data(
-            args["directories"]["kilosort_output_directory"],
-            args["ephys_params"]["sample_rate"],
-            convert_to_seconds=False,
-            use_master_clock=False,
-            include_pcs=include_pcs,
-        )
-        # empty arrays to stand in for the missing variables
-        pc_features = np.asarray([])
-        pc_feature_ind = np.asarray([])
-        template_features = np.asarray([])
+    # files are only read when first used; templates and cluster amplitudes
+    # are only needed to remove duplicates
+    dataset = kilosort_dataset(
+        args["directories"]["kilosort_output_directory"],
+        args["ephys_params"]["sample_rate"],
+        mmap_mode=args["ks_postprocessing_params"]["mmap_mode"],
+    )
+
+    with span("load_kilosort_data"):
+        spike_times = dataset.spike_times
+        spike_clusters = dataset.spike_clusters
+        spike_templates = dataset.spike_templates
+        amplitudes = dataset.amplitudes
+
+        if include_pcs:
+            pc_features = dataset.pc_features
+            pc_feature_ind = dataset.pc_feature_ind
+            template_features = dataset.template_features
+        else:
+            # empty arrays to stand in for the missing variables
+            pc_features = np.asarray([])
+            pc_feature_ind = np.asarray([])
+            template_features = np.asarray([])
 
     if args["ks_postprocessing_params"]["align_avg_waveform"]:
-        spike_times = align_spike_times(
-            spike_times,
-            spike_clusters,
-            args["ephys_params"]["ap_band_file"],
-            args["directories"]["kilosort_output_directory"],
-            args["ks_postprocessing_params"]["cWaves_path"],
-        )
+        with span("align_spike_times"):
+            spike_times = align_spike_times(
+                spike_times,
+                spike_clusters,
+                args["ephys_params"]["ap_band_file"],
+                args["directories"]["kilosort_output_directory"],
+                args["ks_postprocessing_params"]["cWaves_path"],
+                args["ks_postprocessing_params"]["c_waves_engine"],
+                args["ephys_params"]["num_channels"],
+                args["ephys_params"]["bit_volts"],
+            )
 
     if args["ks_postprocessing_params"]["remove_duplicates"]:
-        (
-            spike_times,
-            spike_clusters,
-            spike_templates,
-            amplitudes,
-            pc_features,
-            template_features,
-            overlap_matrix,
-            overlap_summary,
-        ) = remove_double_counted_spikes(
-            spike_times,
-            spike_clusters,
-            spike_templates,
-            amplitudes,
-            channel_map,
-            channel_pos,
-            templates,
-            pc_features,
-            pc_feature_ind,
-            template_features,
-            cluster_amplitude,
-            args["ephys_params"]["sample_rate"],
-            args["ks_postprocessing_params"],
-        )
-
-    print("Saving data...")
-
-    # save data -- it's fine to overwrite existing files, because the original outputs are stored in rez.mat
-    output_dir = args["directories"]["kilosort_output_directory"]
-    np.save(os.path.join(output_dir, "spike_times.npy"), spike_times)
-    np.save(os.path.join(output_dir, "amplitudes.npy"), amplitudes)
-    np.save(os.path.join(output_dir, "spike_clusters.npy"), spike_clusters)
-    np.save(os.path.join(output_dir, "spike_templates.npy"), spike_templates)
-
-    if args["ks_postprocessing_params"]["include_pcs"]:
-        np.save(os.path.join(output_dir, "pc_features.npy"), pc_features)
-        if template_features.size > 0:
-            np.save(
-                os.path.join(output_dir, "template_features.npy"), template_features
+        with span("remove_double_counted_spikes"):
+            (
+                spike_times,
+                spike_clusters,
+                spike_templates,
+                amplitudes,
+                pc_features,
+                template_features,
+                overlap_matrix,
+                overlap_summary,
+            ) = remove_double_counted_spikes(
+                spike_times,
+                spike_clusters,
+                spike_templates,
+                amplitudes,
+                dataset.channel_map,
+                dataset.channel_pos,
+                dataset.unwhitened_templates,
+                pc_features,
+                pc_feature_ind,
+                template_features,
+                dataset.cluster_amplitude,
+                args["ephys_params"]["sample_rate"],
+                args["ks_postprocessing_params"],
+                features_dir=args["directories"]["kilosort_output_directory"],
             )
 
-    if args["ks_postprocessing_params"]["remove_duplicates"]:
-        np.save(os.path.join(output_dir, "overlap_matrix.npy"), overlap_matrix)
-        np.save(os.path.join(output_dir, "overlap_summary.npy"), overlap_summary)
-        # save the overlap_summary as a text file -- allows user to easily understand what happened
-        np.savetxt(
-            os.path.join(output_dir, "overlap_summary.csv"),
-            overlap_summary,
-            fmt="%d",
-            delimiter=",",
-        )
+    with span("save_data"):
+        print("Saving data...")
+
+        # save data -- it's fine to overwrite existing files, because the original outputs are stored in rez.mat
+        # each file is written to a temporary file first, because pc_features and
+        # template_features may still be memory-mapped from the files being replaced.
+        # Saving through the dataset keeps the new arrays for later modules of an
+        # in-process run
+        output_dir = args["directories"]["kilosort_output_directory"]
+        dataset.save("spike_times.npy", spike_times)
+        dataset.save("amplitudes.npy", amplitudes)
+        dataset.save("spike_clusters.npy", spike_clusters)
+        dataset.save("spike_templates.npy", spike_templates)
+
+        # features only change when spikes are removed; otherwise they are still
+        # the (possibly memory-mapped) contents of the existing files. Compacted
+        # memory-mapped features are already written, and are only moved into place
+        if (
+            args["ks_postprocessing_params"]["include_pcs"]
+            and args["ks_postprocessing_params"]["remove_duplicates"]
+        ):
+            dataset.save("pc_features.npy", pc_features)
+            if template_features.size > 0:
+                dataset.save("template_features.npy", template_features)
+
+        if args["ks_postprocessing_params"]["remove_duplicates"]:
+            save(output_dir, "overlap_matrix.npy", overlap_matrix)
+            save(output_dir, "overlap_summary.npy", overlap_summary)
+            # save the overlap_summary as a text file -- allows user to easily understand what happened
+            np.savetxt(
+                os.path.join(output_dir, "overlap_summary.csv"),
+                overlap_summary,
+                fmt="%d",
+                delimiter=",",
+            )
 
     execution_time = time.time() - start
 
@@ -1,9 +1,10 @@
 from marshmallow import INCLUDE, Schema
-from marshmallow.fields import Boolean, Float, Int, Nested, String
+from marshmallow.fields import Boolean, Dict, Float, Int, Nested, String
+from marshmallow.validate import OneOf
 
 from ecephys_spike_sorting.modules.schema_fields import InputDir
 
-from ...common.schemas import Directories, EphysParams
+from ...common.schemas import Directories, EphysParams, InstrumentationParams
 
 
 class PostprocessingParams(Schema):
@@ -33,6 +34,12 @@ class PostprocessingParams(Schema):
         missing=True,
         help="Set to false if features were not saved with Phy output",
     )
+    mmap_mode = String(
+        required=False,
+        allow_none=True,
+        missing=None,
+        help="Set to 'r' to memory-map pc_features.npy and template_features.npy rather than loading them into memory",
+    )
     remove_duplicates = Boolean(
         required=False, missing=True, help="Set to True for duplicate removal"
     )
@@ -44,6 +51,14 @@ class PostprocessingParams(Schema):
     cWaves_path = InputDir(
         require=False, help="directory containing the CWaves executable."
     )
+    c_waves_engine = String(
+        required=False,
+        missing="external",
+        validate=OneOf(["python", "external"]),
+        help="Compute the mean waveforms for align_avg_waveform by calling the "
+        "C_Waves executable in cWaves_path, or in python (in-process; not yet "
+        "validated against the C_Waves outputs)",
+    )
 
 
 class InputParameters(Schema):
@@ -53,6 +68,7 @@ class InputParameters(Schema):
     ks_postprocessing_params = Nested(PostprocessingParams)
     directories = Nested(Directories)
     ephys_params = Nested(EphysParams)
+    instrumentation_params = Nested(InstrumentationParams, required=False)
 
 
 class OutputSchema(Schema):
@@ -71,6 +87,7 @@ class OutputParameters(OutputSchema):
         unknown = INCLUDE
 
     execution_time = Float()
+    spans = Dict(required=False, help="Tree of timing and memory spans of the run")
 
 
 class PostprocessingSchema(Schema):
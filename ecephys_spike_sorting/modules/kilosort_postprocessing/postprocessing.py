@@ -3,8 +3,17 @@ import subprocess
 import sys
 
 import numpy as np
+from scipy.spatial import cKDTree
 
-from ...common.utils import getSortResults, printProgressBar
+from ...common.cluster_index import ClusterIndex
+from ...common.instrumentation import span
+from ...common.utils import (
+    getSortResults,
+    printProgressBar,
+    select_spikes,
+    select_spikes_to_file,
+)
+from ..mean_waveforms.c_waves import c_waves_mean_waveforms
 
 
 def remove_double_counted_spikes(
@@ -22,6 +31,7 @@ def remove_double_counted_spikes(
     sample_rate,
     params,
     epochs=None,
+    features_dir=None,
 ):
     """Remove putative double-counted spikes from Kilosort outputs
 
@@ -54,6 +64,10 @@ def remove_double_counted_spikes(
         'include_pcs' : whether to update files pc_features and template_features. Should be 'true' unless these files are absent
     epochs : list of Epoch objects
         contains information on Epoch start and stop times
+    features_dir : String (optional)
+        Kilosort output directory; if given, memory-mapped pc_features and
+        template_features are compacted straight into new files there (see
+        remove_spikes)
 
 
     Outputs:
@@ -101,122 +115,100 @@ def remove_double_counted_spikes(
         params["between_unit_overlap_window"] * sample_rate
     )
 
-    print("Removing within-unit overlapping spikes...")
+    with span("within_unit_overlap"):
+        print("Removing within-unit overlapping spikes...")
 
-    spikes_to_remove = np.zeros((0,), dtype="int")
+        # spikes are only marked here, and all arrays are compacted once at the end
+        spikes_to_keep = np.ones((spike_times.size,), dtype=bool)
 
-    for idx1, unit_id1 in enumerate(sorted_unit_list):
-
-        printProgressBar(idx1 + 1, len(unit_list))
-
-        for_unit1 = np.where(spike_clusters == unit_id1)[0]
-
-        to_remove = find_within_unit_overlap(
-            spike_times[for_unit1], within_unit_overlap_samples
+        to_remove, removed_per_unit = find_all_within_unit_overlaps(
+            spike_times, spike_clusters, num_clusters, within_unit_overlap_samples
         )
 
-        overlap_matrix[idx1, idx1] = len(to_remove)
-
-        spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove]))
-
-    (
-        spike_times,
-        spike_clusters,
-        spike_templates,
-        amplitudes,
-        pc_features,
-        template_features,
-    ) = remove_spikes(
-        spike_times,
-        spike_clusters,
-        spike_templates,
-        amplitudes,
-        pc_features,
-        template_features,
-        spikes_to_remove,
-        include_pcs,
-    )
-
-    print("Removing between-unit overlapping spikes...")
+        overlap_matrix[np.arange(num_clusters), np.arange(num_clusters)] = (
+            removed_per_unit[sorted_unit_list]
+        )
 
-    spikes_to_remove = np.zeros((0,), dtype="int")
+        spikes_to_keep[to_remove] = False
 
-    for idx1, unit_id1 in enumerate(sorted_unit_list):
+    with span("between_unit_overlap"):
+        print("Removing between-unit overlapping spikes...")
 
-        printProgressBar(idx1 + 1, len(unit_list))
+        # pairs of units (as indices into sorted_unit_list, idx1 < idx2) whose
+        # peak channels are closer than between_unit_dist_um
+        neighbor_pairs = find_neighboring_units(
+            channel_pos[peak_chan_idx[sorted_unit_list], :2],
+            params["between_unit_dist_um"],
+        )
 
-        for_unit1 = np.where(spike_clusters == unit_id1)[0]
+        # the between-unit pass only sees the spikes that survived the
+        # within-unit pass; kept maps its indices back to the full arrays
+        kept = np.flatnonzero(spikes_to_keep)
+        kept_times = spike_times[kept]
 
-        for idx2, unit_id2 in enumerate(sorted_unit_list):
+        cluster_index = ClusterIndex(spike_clusters[kept], num_clusters)
 
-            deltaX = np.squeeze(
-                channel_pos[peak_chan_idx[unit_id2], 0]
-                - channel_pos[peak_chan_idx[unit_id1], 0]
-            )
-            deltaZ = np.squeeze(
-                channel_pos[peak_chan_idx[unit_id2], 1]
-                - channel_pos[peak_chan_idx[unit_id1], 1]
-            )
+        for pair_idx, (idx1, idx2) in enumerate(neighbor_pairs):
 
-            dist = pow((pow(deltaX, 2) + pow(deltaZ, 2)), 0.5)
+            printProgressBar(pair_idx + 1, len(neighbor_pairs))
 
-            if idx2 > idx1 and dist < params["between_unit_dist_um"]:
+            unit_id1 = sorted_unit_list[idx1]
+            unit_id2 = sorted_unit_list[idx2]
 
-                amp1 = cluster_amplitude[unit_id1]
-                amp2 = cluster_amplitude[unit_id2]
+            amp1 = cluster_amplitude[unit_id1]
+            amp2 = cluster_amplitude[unit_id2]
 
-                for_unit2 = np.where(spike_clusters == unit_id2)[0]
+            for_unit1 = cluster_index.indices(unit_id1)
+            for_unit2 = cluster_index.indices(unit_id2)
 
-                to_remove1, to_remove2 = find_between_unit_overlap(
-                    spike_times[for_unit1],
-                    spike_times[for_unit2],
-                    amp1,
-                    amp2,
-                    between_unit_overlap_samples,
-                    params["deletion_mode"],
-                )
+            to_remove1, to_remove2 = find_between_unit_overlap(
+                kept_times[for_unit1],
+                kept_times[for_unit2],
+                amp1,
+                amp2,
+                between_unit_overlap_samples,
+                params["deletion_mode"],
+            )
 
-                overlap_matrix[idx1, idx2] = overlap_matrix[idx1, idx2] + len(
-                    to_remove1
-                )
-                overlap_matrix[idx2, idx1] = overlap_matrix[idx2, idx1] + len(
-                    to_remove2
-                )
+            overlap_matrix[idx1, idx2] = overlap_matrix[idx1, idx2] + len(to_remove1)
+            overlap_matrix[idx2, idx1] = overlap_matrix[idx2, idx1] + len(to_remove2)
 
-                spikes_to_remove = np.concatenate(
-                    (spikes_to_remove, for_unit1[to_remove1], for_unit2[to_remove2])
-                )
+            spikes_to_keep[kept[for_unit1[to_remove1]]] = False
+            spikes_to_keep[kept[for_unit2[to_remove2]]] = False
 
-    (
-        spike_times,
-        spike_clusters,
-        spike_templates,
-        amplitudes,
-        pc_features,
-        template_features,
-    ) = remove_spikes(
-        spike_times,
-        spike_clusters,
-        spike_templates,
-        amplitudes,
-        pc_features,
-        template_features,
-        np.unique(spikes_to_remove),
-        include_pcs,
-    )
-    #   build overlap summary
-    overlap_summary = np.zeros((num_clusters, 5), dtype=int)
-    for idx1, unit_id1 in enumerate(sorted_unit_list):
-        overlap_summary[idx1, 0] = unit_id1
-        overlap_summary[idx1, 1] = np.sum(spike_clusters == unit_id1)
-        overlap_summary[idx1, 2] = overlap_matrix[idx1, idx1]
-        overlap_summary[idx1, 3] = (
-            np.sum(overlap_matrix[idx1, :]) - overlap_matrix[idx1, idx1]
+    with span("remove_spikes"):
+        (
+            spike_times,
+            spike_clusters,
+            spike_templates,
+            amplitudes,
+            pc_features,
+            template_features,
+        ) = remove_spikes(
+            spike_times,
+            spike_clusters,
+            spike_templates,
+            amplitudes,
+            pc_features,
+            template_features,
+            spikes_to_keep,
+            include_pcs,
+            features_dir,
         )
-        overlap_summary[idx1, 4] = sorted_unit_list[np.argmax(overlap_matrix[idx1, :])]
-    #   sort by label
-    new_order = np.argsort(overlap_summary[:, 0])
-    overlap_summary = overlap_summary[new_order, :]
+    with span("overlap_summary"):
+        #   build overlap summary
+        overlap_summary = np.zeros((num_clusters, 5), dtype=int)
+        for idx1, unit_id1 in enumerate(sorted_unit_list):
+            overlap_summary[idx1, 0] = unit_id1
+            overlap_summary[idx1, 1] = np.sum(spike_clusters == unit_id1)
+            overlap_summary[idx1, 2] = overlap_matrix[idx1, idx1]
+            overlap_summary[idx1, 3] = (
+                np.sum(overlap_matrix[idx1, :]) - overlap_matrix[idx1, idx1]
+            )
+            overlap_summary[idx1, 4] = sorted_unit_list[np.argmax(overlap_matrix[idx1, :])]
+        #   sort by label
+        new_order = np.argsort(overlap_summary[:, 0])
+        overlap_summary = overlap_summary[new_order, :]
 
     return (
         spike_times,
@@ -230,6 +222,45 @@ def remove_double_counted_spikes(
     )
 
 
+def find_neighboring_units(unit_positions, max_distance):
+    """
+    Finds all pairs of units closer than max_distance
+
+    The pairs are found with a KD-tree on the unit positions, so only units
+    that are actually close are compared.
+
+    Parameters
+    ----------
+    unit_positions : numpy.ndarray (num_units x 2)
+        X and Z coordinates of the peak channel of each unit
+    max_distance : float
+        Pairs are included if their distance is less than this value (um)
+
+    Outputs
+    -------
+    pairs : numpy.ndarray (num_pairs x 2)
+        Indices of the units in each pair, with pairs[:, 0] < pairs[:, 1],
+        sorted by first and then second index
+
+    """
+
+    unit_positions = np.asarray(unit_positions, dtype="float64")
+
+    if max_distance <= 0 or unit_positions.shape[0] < 2:
+        return np.zeros((0, 2), dtype="int")
+
+    # query slightly beyond max_distance, then apply the exact criterion
+    pairs = cKDTree(unit_positions).query_pairs(
+        max_distance * (1 + 1e-9), output_type="ndarray"
+    )
+
+    delta = unit_positions[pairs[:, 1]] - unit_positions[pairs[:, 0]]
+    dist = pow((pow(delta[:, 0], 2) + pow(delta[:, 1], 2)), 0.5)
+    pairs = pairs[dist < max_distance]
+
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+
 def find_within_unit_overlap(spike_train, overlap_window=5):
     """
     Finds overlapping spikes within a single spike train.
@@ -254,6 +285,57 @@ def find_within_unit_overlap(spike_train, overlap_window=5):
     return spikes_to_remove
 
 
+def find_all_within_unit_overlaps(
+    spike_times, spike_clusters, num_clusters, overlap_window=5
+):
+    """
+    Finds overlapping spikes within the spike train of every unit, in one pass
+
+    The spikes are sorted by cluster and then time, so the spike train of
+    each unit is a contiguous run; consecutive spikes of the same unit closer
+    than overlap_window are overlapping, and the earlier one of each pair is
+    removed, as in find_within_unit_overlap.
+
+    Parameters
+    ----------
+    spike_times : numpy.ndarray
+        Spike times (in samples)
+    spike_clusters : numpy.ndarray
+        Cluster IDs for each spike time
+    num_clusters : int
+        Only clusters 0 to num_clusters - 1 are searched
+    overlap_window : int
+        Number of samples to search for overlapping spikes
+
+    Outputs
+    -------
+    spikes_to_remove : numpy.ndarray
+        Indices of overlapping spikes, in ascending order
+    removed_per_unit : numpy.ndarray (num_clusters x 0)
+        Number of spikes to remove from each cluster
+
+    """
+
+    spike_times = np.ravel(spike_times).astype("int64")
+    spike_clusters = np.ravel(spike_clusters).astype("int64")
+
+    order = np.lexsort((spike_times, spike_clusters))
+
+    sorted_clusters = spike_clusters[order]
+
+    overlapping = (np.diff(spike_times[order]) < overlap_window) & (
+        np.diff(sorted_clusters) == 0
+    )
+    overlapping &= sorted_clusters[:-1] < num_clusters
+
+    spikes_to_remove = np.sort(order[:-1][overlapping])
+    removed_per_unit = np.bincount(
+        sorted_clusters[:-1][overlapping], minlength=num_clusters
+    )
+
+    return spikes_to_remove, removed_per_unit
+
+
 def find_between_unit_overlap(
     spike_train1,
     spike_train2,
@@ -382,12 +464,20 @@ def remove_spikes(
     amplitudes,
     pc_features,
     template_features,
-    spikes_to_remove,
+    spikes_to_keep,
     include_pcs,
+    features_dir=None,
 ):
     """
     Removes spikes from Kilosort outputs
 
+    Every per-spike array is compacted once, with the same mask. pc_features
+    and template_features are copied in chunks, so no temporary copy of the
+    whole array is made. If they are memory-mapped and features_dir is given,
+    the chunks are written straight into the new pc_features.npy and
+    template_features.npy (as the temporary files that save() moves into
+    place), so the compacted arrays are never held in memory.
+
     Inputs:
     ------
     spike_times : numpy.ndarray (num_spikes x 0)
@@ -400,29 +490,39 @@ def remove_spikes(
         Amplitude value for each spike time
     pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
         Pre-computed PCs for blocks of channels around each spike
-    spikes_to_remove : numpy.ndarray
-        Indices of spikes to remove
+    spikes_to_keep : numpy.ndarray (num_spikes x 0)
+        False for spikes to remove
     include_pcs : update pc_features and template_features. Should be true unless that output is absent.
+    features_dir : String (optional)
+        Directory for the new feature files, if the features are memory-mapped
 
     Outputs:
     --------
-    spike_times : numpy.ndarray (num_spikes - spikes_to_remove x 0)
-    spike_clusters : numpy.ndarray (num_spikes - spikes_to_remove x 0)
-    spike_templates : numpy.ndarray (num_spikes - spikes_to_remove x 0)
-    amplitudes : numpy.ndarray (num_spikes - spikes_to_remove x 0)
-    pc_features : numpy.ndarray (num_spikes - spikes_to_remove x num_pcs x num_channels)
+    spike_times : numpy.ndarray (num_kept x 0)
+    spike_clusters : numpy.ndarray (num_kept x 0)
+    spike_templates : numpy.ndarray (num_kept x 0)
+    amplitudes : numpy.ndarray (num_kept x 0)
+    pc_features : numpy.ndarray (num_kept x num_pcs x num_channels)
+    template_features : numpy.ndarray (num_kept x number of template features)
 
     """
 
-    spike_times = np.delete(spike_times, spikes_to_remove, 0)
-    spike_clusters = np.delete(spike_clusters, spikes_to_remove, 0)
-    spike_templates = np.delete(spike_templates, spikes_to_remove, 0)
-    amplitudes = np.delete(amplitudes, spikes_to_remove, 0)
+    spike_times = spike_times[spikes_to_keep]
+    spike_clusters = spike_clusters[spikes_to_keep]
+    spike_templates = spike_templates[spikes_to_keep]
+    amplitudes = amplitudes[spikes_to_keep]
 
     if include_pcs:
-        pc_features = np.delete(pc_features, spikes_to_remove, 0)
+        pc_features = _compact_features(
+            pc_features, spikes_to_keep, features_dir, "pc_features.npy"
+        )
         if template_features.size > 0:
-            template_features = np.delete(template_features, spikes_to_remove, 0)
+            template_features = _compact_features(
+                template_features,
+                spikes_to_keep,
+                features_dir,
+                "template_features.npy",
+            )
     # otherwise, just returns the input pc_fearures and template_features arrays
 
     return (
@@ -435,9 +535,117 @@ def remove_spikes(
     )
 
 
+def _compact_features(features, spikes_to_keep, features_dir, filename):
+
+    if features_dir is not None and isinstance(features, np.memmap):
+        return select_spikes_to_file(features, spikes_to_keep, features_dir, filename)
+
+    return select_spikes(features, spikes_to_keep)
+
+
 def align_spike_times(
-    spike_times, spike_clusters, spikeglx_bin, output_dir, cWaves_path
+    spike_times,
+    spike_clusters,
+    spikeglx_bin,
+    output_dir,
+    cWaves_path,
+    c_waves_engine="external",
+    num_channels=384,
+    bit_volts=0.195,
 ):
+    """Shift the spike times of each unit so its mean waveform peaks at pre_samples
+
+    The mean waveforms (of up to 5000 spikes per unit) are calculated in
+    python from the spike arrays in memory (c_waves_engine = 'python'), or by
+    C_Waves from the files in output_dir ('external').
+
+    Inputs:
+    ------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    spikeglx_bin : str
+        Path to the AP band binary file
+    output_dir : str
+        Kilosort output directory
+    cWaves_path : str
+        Directory containing the C_Waves executable
+    c_waves_engine : str
+        'python' or 'external'
+    num_channels : int
+        Total number of channels in the binary file
+    bit_volts : float
+        Scalar required to convert int16 values into microvolts
+
+    Outputs:
+    --------
+    spike_times : numpy.ndarray (num_spikes x 0)
+
+    """
+
+    if c_waves_engine == "python":
+
+        print("Calculating mean waveforms for align_spike_times in python.")
+
+        raw_data = np.memmap(spikeglx_bin, dtype="int16", mode="r")
+        raw_data = np.reshape(
+            raw_data, (int(raw_data.size / num_channels), num_channels)
+        )
+
+        # no peak channels are needed, so the SNR is not calculated
+        mean_waveforms, snr_array = c_waves_mean_waveforms(
+            raw_data, spike_times, spike_clusters, bit_volts, 82, 20, 5000
+        )
+
+    else:
+
+        mean_waveforms, snr_array = run_c_waves(
+            spikeglx_bin, output_dir, cWaves_path
+        )
+
+    (nClu, nChan, nt) = mean_waveforms.shape
+
+    peak_t = 19  # because pre_samples in C_Waves set to 20
+
+    # Loop over units
+    for i in range(nClu):
+        nSpike = snr_array[i, 1]
+        if nSpike > 10:
+            # only try to correct if we some spikes to average
+            curr_wave = mean_waveforms[i, :, :]
+            max_site = np.argmax(np.max(curr_wave, 1) - np.min(curr_wave, 1))
+            max_site_wave = curr_wave[max_site, :]
+
+            min_v = abs(np.min(max_site_wave))
+            max_v = abs(np.max(max_site_wave))
+            min_t = np.argmin(max_site_wave)
+            max_t = np.argmax(max_site_wave)
+
+            # align to min or max?
+            if min_v > 30 and max_v > 30:
+                # set spike to to earlier of the two
+                if min_t <= max_t:
+                    mean_peak_time = min_t
+                else:
+                    mean_peak_time = max_t
+            else:
+                # only one substantial peak, align to larger
+                if min_v >= max_v:
+                    mean_peak_time = min_t
+                else:
+                    mean_peak_time = max_t
+
+            deltat = peak_t - mean_peak_time
+            # print('nClu, deltat: ' + repr(i) + ', ' +  repr(deltat) )
+            clu_ind = spike_clusters == i
+            spike_times[clu_ind] = spike_times[clu_ind] - deltat
+
+    return spike_times
+
+
+def run_c_waves(spikeglx_bin, output_dir, cWaves_path):
+    """Mean waveforms for align_spike_times, by calling C_Waves"""
 
     print("Calculating mean waveforms for aligh_spike_times using C_waves.")
 
@@ -487,43 +695,4 @@ def align_spike_times(
     mean_waveform_fullpath = os.path.join(output_dir, "preprocess_mean_waveforms.npy")
     snr_fullpath = os.path.join(output_dir, "preprocess_cluster_snr.npy")
 
-    mean_waveforms = np.load(mean_waveform_fullpath)
-    snr_array = np.load(snr_fullpath)
-    (nClu, nChan, nt) = mean_waveforms.shape
-
-    peak_t = 19  # because pre_samples in C_Waves set to 20
-
-    # Loop over units
-    for i in range(nClu):
-        nSpike = snr_array[i, 1]
-        if nSpike > 10:
-            # only try to correct if we some spikes to average
-            curr_wave = mean_waveforms[i, :, :]
-            max_site = np.argmax(np.max(curr_wave, 1) - np.min(curr_wave, 1))
-            max_site_wave = curr_wave[max_site, :]
-
-            min_v = abs(np.min(max_site_wave))
-            max_v = abs(np.max(max_site_wave))
-            min_t = np.argmin(max_site_wave)
-            max_t = np.argmax(max_site_wave)
-
-            # align to min or max?
-            if min_v > 30 and max_v > 30:
-                # set spike to to earlier of the two
-                if min_t <= max_t:
-                    mean_peak_time = min_t
-                else:
-                    mean_peak_time = max_t
-            else:
-                # only one substantial peak, align to larger
-                if min_v >= max_v:
-                    mean_peak_time = min_t
-                else:
-                    mean_peak_time = max_t
-
-            deltat = peak_t - mean_peak_time
-            # print('nClu, deltat: ' + repr(i) + ', ' +  repr(deltat) )
-            clu_ind = spike_clusters == i
-            spike_times[clu_ind] = spike_times[clu_ind] - deltat
-
-    return spike_times
+    return np.load(mean_waveform_fullpath), np.load(snr_fullpath)
@@ -1,23 +1,34 @@
 import json
 import os
-import pathlib
 import subprocess
 import sys
 import time
 
 import numpy as np
-import pandas as pd
 from scipy.io import loadmat
 
 from ecephys_spike_sorting.modules.utils import ObjectEncoder
 
-from ...common.utils import getFileVersion, getSortResults, load_kilosort_data
+from ...common.dataset_context import kilosort_dataset
+from ...common.instrumentation import span, trace_module
+from ...common.metrics_io import (
+    file_metrics_format,
+    find_metrics_file,
+    merge_metrics,
+    read_metrics,
+    replace_metrics_rows,
+    versioned_path,
+    write_metrics,
+)
+from ...common.utils import cluster_table, getFileVersion, getSortResults
 from ._schemas import MeanWaveformSchema
-from .extract_waveforms import extract_waveforms, writeDataAsNpy
-from .metrics_from_file import metrics_from_file
+from .c_waves import c_waves_mean_waveforms
+from .extract_waveforms import extract_waveforms, updateDataAsNpy, writeDataAsNpy
+from .metrics_from_file import metrics_from_c_waves
 from .waveform_metrics import calculate_waveform_metrics
 
 
+@trace_module("mean_waveforms")
 def calculate_mean_waveforms(args):
 
     print("ecephys spike sorting: mean waveforms module")
@@ -27,8 +38,9 @@ def calculate_mean_waveforms(args):
     if args["mean_waveform_params"]["use_C_Waves"]:
 
         print("Calculating mean waveforms using C_waves.")
+        # C_Waves always extracts all units
+        cluster_ids = None
         spikeglx_bin = args["ephys_params"]["ap_band_file"]
-        # regenerate the clus_Table in case there has been manual curation of the data in phy
         output_dir = args["directories"]["kilosort_output_directory"]
 
         # get version number for new clus_table file
@@ -38,12 +50,6 @@ def calculate_mean_waveforms(args):
         # version = 0 if no clu_Table exists, file = clus_Table.npy
         # version = 1 or higher, new clus_Table = clus_Table_version.npy
 
-        getSortResults(output_dir, clu_version)
-
-        # build paths to cluster and times tables, which are generated by
-        # kilosort_helper module
-        clus_time_npy = os.path.join(output_dir, "spike_times.npy")
-        clus_lbl_npy = os.path.join(output_dir, "spike_clusters.npy")
         dest, wavefile = os.path.split(
             args["mean_waveform_params"]["mean_waveforms_file"]
         )
@@ -63,63 +69,12 @@ def calculate_mean_waveforms(args):
                 new_snr = os.path.join(dest, "cluster_snr_0.npy")
                 os.rename(old_snr, new_snr)
 
-        # kilosort saves the spike_clusters files as uint32.
-        # when phy re-saves after curation, it saves as int32 (!)
-        # to ensure the correct datatype for C_Waves, load the spike_clusters
-        # and convert if necessary
-        sc = np.load(clus_lbl_npy)
-        if sc.dtype != "uint32":
-            sc = sc.astype("uint32")
-            np.save(clus_lbl_npy, sc)
-
-        # path to the 'runit.bat' executable that calls C_Waves.
-        # Essential in linux where C_Waves executable is only callable through runit
-        if sys.platform.startswith("win"):
-            exe_path = os.path.join(
-                args["mean_waveform_params"]["cWaves_path"], "runit.bat"
-            )
-        elif sys.platform.startswith("linux"):
-            exe_path = os.path.join(
-                args["mean_waveform_params"]["cWaves_path"], "runit.sh"
-            )
-        else:
-            print("unknown system, cannot run C_Waves")
-
-        cwaves_cmd = (
-            exe_path
-            + " -spikeglx_bin="
-            + spikeglx_bin
-            + " -clus_table_npy="
-            + clus_table_npy
-            + " -clus_time_npy="
-            + clus_time_npy
-            + " -clus_lbl_npy="
-            + clus_lbl_npy
-            + " -dest="
-            + dest
-            + " -samples_per_spike="
-            + repr(args["mean_waveform_params"]["samples_per_spike"])
-            + " -pre_samples="
-            + repr(args["mean_waveform_params"]["pre_samples"])
-            + " -num_spikes="
-            + repr(args["mean_waveform_params"]["spikes_per_epoch"])
-            + " -snr_radius="
-            + repr(args["mean_waveform_params"]["snr_radius"])
-            + " -snr_radius_um="
-            + repr(args["mean_waveform_params"]["snr_radius_um"])
-        )
-
-        print(cwaves_cmd)
-
-        # make the C_Waves call
-        subprocess.Popen(cwaves_cmd, shell="False").wait()
-
         # for first version, retain original names
         if clu_version == 0:
             mean_waveform_fullpath = os.path.join(dest, "mean_waveforms.npy")
             snr_fullpath = os.path.join(dest, "cluster_snr.npy")
         else:
-            # build names with version number and rename
+            # build names with version number
             # version 0 files are not renamed to maintain compatiblity with
             mean_waveform_fullpath = os.path.join(
                 dest, "mean_waveforms_" + repr(clu_version) + ".npy"
@@ -127,39 +82,13 @@ def calculate_mean_waveforms(args):
             snr_fullpath = os.path.join(
                 dest, "cluster_snr_" + repr(clu_version) + ".npy"
             )
-            os.rename(os.path.join(dest, "mean_waveforms.npy"), mean_waveform_fullpath)
-            os.rename(os.path.join(dest, "cluster_snr.npy"), snr_fullpath)
 
-        # C_Waves writes out files of the waveforms and snr
-        # call version of calculate_waveform_metrics that will use these files
-
-        # load in kilosort output needed for these calculations
-        (
-            spike_times,
-            spike_clusters,
-            spike_templates,
-            amplitudes,
-            templates,
-            channel_map,
-            channel_pos,
-            clusterIDs,
-            cluster_quality,
-            cluster_amplitude,
-        ) = load_kilosort_data(
-            args["directories"]["kilosort_output_directory"],
-            args["ephys_params"]["sample_rate"],
-            convert_to_seconds=False,
-        )
+        # kilosort output needed for these calculations, read when first used
+        dataset = kilosort_dataset(output_dir, args["ephys_params"]["sample_rate"])
 
-        # read in inverse of whitening matrix
-        w_inv = np.load(
-            (
-                os.path.join(
-                    args["directories"]["kilosort_output_directory"],
-                    "whitening_mat_inv.npy",
-                )
-            )
-        )
+        with span("load_kilosort_data"):
+            spike_times = dataset.spike_times
+            spike_clusters = dataset.spike_clusters
 
         # the channel_pos loaded from the phy output omits any sites excluded
         # as noise by the kilosort_helper module, or excluded fow low spike rete
@@ -175,102 +104,242 @@ def calculate_mean_waveforms(args):
         site_x = np.squeeze(loadmat(chanMapMat)["xcoords"])
         site_y = np.squeeze(loadmat(chanMapMat)["ycoords"])
 
-        metrics = metrics_from_file(
-            mean_waveform_fullpath,
-            snr_fullpath,
-            clus_table_npy,
-            spike_times,
-            spike_clusters,
-            templates,
-            channel_map,
-            args["ephys_params"]["bit_volts"],
-            args["ephys_params"]["sample_rate"],
-            args["ephys_params"]["vertical_site_spacing"],
-            w_inv,
-            site_x,
-            site_y,
-            args["mean_waveform_params"],
-        )
+        if args["mean_waveform_params"]["c_waves_engine"] == "python":
+
+            # regenerate the clus_Table in case there has been manual curation of
+            # the data in phy, from the spike arrays already in memory
+            with span("cluster_table"):
+                clus_table = cluster_table(
+                    spike_clusters,
+                    dataset.spike_templates,
+                    dataset.unwhitened_templates,
+                    dataset.channel_map,
+                )
+                np.save(clus_table_npy, clus_table)
+
+            with span("c_waves", num_spikes=spike_times.size):
+                rawData = np.memmap(spikeglx_bin, dtype="int16", mode="r")
+                data = np.reshape(
+                    rawData,
+                    (
+                        int(rawData.size / args["ephys_params"]["num_channels"]),
+                        args["ephys_params"]["num_channels"],
+                    ),
+                )
+
+                mean_waveforms, snr_array = c_waves_mean_waveforms(
+                    data,
+                    spike_times,
+                    spike_clusters,
+                    args["ephys_params"]["bit_volts"],
+                    args["mean_waveform_params"]["samples_per_spike"],
+                    args["mean_waveform_params"]["pre_samples"],
+                    args["mean_waveform_params"]["spikes_per_epoch"],
+                    clus_table[:, 1],
+                    args["mean_waveform_params"]["snr_radius"],
+                    args["mean_waveform_params"]["snr_radius_um"],
+                    site_x,
+                    site_y,
+                    args["mean_waveform_params"]["gather_threads"],
+                )
+
+                np.save(mean_waveform_fullpath, mean_waveforms)
+                np.save(snr_fullpath, snr_array)
 
-        wm_fullpath = args["waveform_metrics"]["waveform_metrics_file"]
+        else:
 
-        if clu_version > 0:
-            # save new metrics as _version number
-            wm_fullpath = os.path.join(
-                pathlib.Path(wm_fullpath).parent,
-                pathlib.Path(wm_fullpath).stem + "_" + repr(clu_version) + ".csv",
+            # regenerate the clus_Table in case there has been manual curation of the data in phy
+            getSortResults(output_dir, clu_version)
+
+            # build paths to cluster and times tables, which are generated by
+            # kilosort_helper module
+            clus_time_npy = os.path.join(output_dir, "spike_times.npy")
+            clus_lbl_npy = os.path.join(output_dir, "spike_clusters.npy")
+
+            # kilosort saves the spike_clusters files as uint32.
+            # when phy re-saves after curation, it saves as int32 (!)
+            # to ensure the correct datatype for C_Waves, load the spike_clusters
+            # and convert if necessary
+            sc = np.load(clus_lbl_npy)
+            if sc.dtype != "uint32":
+                sc = sc.astype("uint32")
+                dataset.save("spike_clusters.npy", sc)
+
+            # path to the 'runit.bat' executable that calls C_Waves.
+            # Essential in linux where C_Waves executable is only callable through runit
+            if sys.platform.startswith("win"):
+                exe_path = os.path.join(
+                    args["mean_waveform_params"]["cWaves_path"], "runit.bat"
+                )
+            elif sys.platform.startswith("linux"):
+                exe_path = os.path.join(
+                    args["mean_waveform_params"]["cWaves_path"], "runit.sh"
+                )
+            else:
+                print("unknown system, cannot run C_Waves")
+
+            cwaves_cmd = (
+                exe_path
+                + " -spikeglx_bin="
+                + spikeglx_bin
+                + " -clus_table_npy="
+                + clus_table_npy
+                + " -clus_time_npy="
+                + clus_time_npy
+                + " -clus_lbl_npy="
+                + clus_lbl_npy
+                + " -dest="
+                + dest
+                + " -samples_per_spike="
+                + repr(args["mean_waveform_params"]["samples_per_spike"])
+                + " -pre_samples="
+                + repr(args["mean_waveform_params"]["pre_samples"])
+                + " -num_spikes="
+                + repr(args["mean_waveform_params"]["spikes_per_epoch"])
+                + " -snr_radius="
+                + repr(args["mean_waveform_params"]["snr_radius"])
+                + " -snr_radius_um="
+                + repr(args["mean_waveform_params"]["snr_radius_um"])
             )
 
-        metrics.to_csv(wm_fullpath, index=False)
+            print(cwaves_cmd)
+
+            # make the C_Waves call
+            with span("C_Waves"):
+                subprocess.Popen(cwaves_cmd, shell="False").wait()
+
+            # C_Waves output names are hard coded; rename to the version number
+            if clu_version > 0:
+                os.rename(
+                    os.path.join(dest, "mean_waveforms.npy"), mean_waveform_fullpath
+                )
+                os.rename(os.path.join(dest, "cluster_snr.npy"), snr_fullpath)
+
+            mean_waveforms = np.load(mean_waveform_fullpath)
+            snr_array = np.load(snr_fullpath)
+            clus_table = np.load(clus_table_npy)
+
+        # C_Waves writes out files of the waveforms and snr
+        # call version of calculate_waveform_metrics that will use these arrays
+        with span("metrics_from_c_waves"):
+            metrics = metrics_from_c_waves(
+                mean_waveforms,
+                snr_array,
+                clus_table,
+                spike_times,
+                spike_clusters,
+                dataset.unwhitened_templates,
+                dataset.channel_map,
+                args["ephys_params"]["bit_volts"],
+                args["ephys_params"]["sample_rate"],
+                args["ephys_params"]["vertical_site_spacing"],
+                dataset.whitening_mat_inv,
+                site_x,
+                site_y,
+                args["mean_waveform_params"],
+            )
 
     else:
 
         print("Calculating mean waveforms using python.")
-        print("Loading data...")
+        # the python path does not version its output files
+        clu_version = 0
+        cluster_ids = args["mean_waveform_params"]["cluster_ids"]
 
-        rawData = np.memmap(
-            args["ephys_params"]["ap_band_file"], dtype="int16", mode="r"
-        )
-        data = np.reshape(
-            rawData,
-            (
-                int(rawData.size / args["ephys_params"]["num_channels"]),
-                args["ephys_params"]["num_channels"],
-            ),
-        )
+        with span("load_kilosort_data"):
+            print("Loading data...")
 
-        (
-            spike_times,
-            spike_clusters,
-            spike_templates,
-            amplitudes,
-            templates,
-            channel_map,
-            channel_pos,
-            clusterIDs,
-            cluster_quality,
-            cluster_amplitude,
-        ) = load_kilosort_data(
-            args["directories"]["kilosort_output_directory"],
-            args["ephys_params"]["sample_rate"],
-            convert_to_seconds=False,
-        )
+            rawData = np.memmap(
+                args["ephys_params"]["ap_band_file"], dtype="int16", mode="r"
+            )
+            data = np.reshape(
+                rawData,
+                (
+                    int(rawData.size / args["ephys_params"]["num_channels"]),
+                    args["ephys_params"]["num_channels"],
+                ),
+            )
+
+            dataset = kilosort_dataset(
+                args["directories"]["kilosort_output_directory"],
+                args["ephys_params"]["sample_rate"],
+            )
+
+            spike_times = dataset.spike_times
+            spike_clusters = dataset.spike_clusters
+            templates = dataset.unwhitened_templates
+            channel_map = dataset.channel_map
+            channel_pos = dataset.channel_pos
+
+        with span("extract_waveforms"):
+            print("Calculating mean waveforms...")
+
+            waveforms, spike_counts, coords, labels, metrics = extract_waveforms(
+                data,
+                spike_times,
+                spike_clusters,
+                templates,
+                channel_map,
+                args["ephys_params"]["bit_volts"],
+                args["ephys_params"]["sample_rate"],
+                args["ephys_params"]["vertical_site_spacing"],
+                args["mean_waveform_params"],
+                channel_pos=channel_pos,
+            )
+
+        with span("save_waveforms"):
+            if cluster_ids is None:
+                writeDataAsNpy(
+                    waveforms, args["mean_waveform_params"]["mean_waveforms_file"]
+                )
+            else:
+                # only some units were extracted; keep the saved waveforms of the others
+                updateDataAsNpy(
+                    waveforms,
+                    args["mean_waveform_params"]["mean_waveforms_file"],
+                    cluster_ids,
+                )
 
-        print("Calculating mean waveforms...")
-
-        waveforms, spike_counts, coords, labels, metrics = extract_waveforms(
-            data,
-            spike_times,
-            spike_clusters,
-            templates,
-            channel_map,
-            args["ephys_params"]["bit_volts"],
-            args["ephys_params"]["sample_rate"],
-            args["ephys_params"]["vertical_site_spacing"],
-            args["mean_waveform_params"],
+    with span("save_metrics"):
+        waveform_metrics_file = versioned_path(
+            args["waveform_metrics"]["waveform_metrics_file"], clu_version
         )
 
-        writeDataAsNpy(waveforms, args["mean_waveform_params"]["mean_waveforms_file"])
-        metrics.to_csv(args["waveform_metrics"]["waveform_metrics_file"], index=False)
+        if cluster_ids is not None:
+            # replace the rows of the extracted units in the existing metrics,
+            # so the other units are kept here and in the merge below
+            metrics_prev = find_metrics_file(
+                waveform_metrics_file, args["waveform_metrics"]["metrics_format"]
+            )
+            if metrics_prev is not None:
+                metrics = replace_metrics_rows(
+                    read_metrics(metrics_prev), metrics, cluster_ids
+                )
+
+        # save new metrics as _version number
+        write_metrics(
+            metrics,
+            waveform_metrics_file,
+            args["waveform_metrics"]["metrics_format"],
+        )
 
     # if the cluster metrics have already been run, merge the waveform metrics into that file
-    # build file path with current version
-    metrics_args = args["cluster_metrics"]["cluster_metrics_file"]
-    metrics_curr = os.path.join(
-        pathlib.Path(metrics_args).parent,
-        pathlib.Path(metrics_args).stem + "_" + repr(clu_version) + ".csv",
+    # find file with current version, in any format
+    metrics_curr = find_metrics_file(
+        versioned_path(args["cluster_metrics"]["cluster_metrics_file"], clu_version),
+        args["cluster_metrics"]["metrics_format"],
     )
 
-    if os.path.exists(metrics_curr):
-        qmetrics = pd.read_csv(metrics_curr)
-        qmetrics = qmetrics.drop(qmetrics.columns[0], axis="columns")
-        qmetrics = qmetrics.merge(
-            pd.read_csv(wm_fullpath, index_col=0),
-            on="cluster_id",
-            suffixes=("_quality_metrics", "_waveform_metrics"),
-        )
-        print("Saving merged quality metrics ...")
-        qmetrics.to_csv(metrics_curr, index=False)
+    with span("merge_metrics"):
+        if metrics_curr is not None:
+            # join the in-memory waveform metrics, instead of rereading them
+            qmetrics = merge_metrics(
+                read_metrics(metrics_curr),
+                metrics,
+                suffixes=("_quality_metrics", "_waveform_metrics"),
+            )
+            print("Saving merged quality metrics ...")
+            write_metrics(qmetrics, metrics_curr, file_metrics_format(metrics_curr))
 
     execution_time = time.time() - start
 
@@ -1,5 +1,6 @@
 from marshmallow import INCLUDE, Schema
-from marshmallow.fields import Bool, Float, Int, Nested, String
+from marshmallow.fields import Bool, Dict, Float, Int, List, Nested, String
+from marshmallow.validate import OneOf
 
 from ecephys_spike_sorting.modules.schema_fields import InputDir
 
@@ -7,6 +8,7 @@ from ...common.schemas import (
     ClusterMetricsFile,
     Directories,
     EphysParams,
+    InstrumentationParams,
     WaveformMetricsFile,
 )
 
@@ -51,6 +53,14 @@ class MeanWaveformParams(Schema):
         missing=False,
         help="Use faster C routine to calculate mean waveforms",
     )
+    c_waves_engine = String(
+        required=False,
+        missing="external",
+        validate=OneOf(["python", "external"]),
+        help="With use_C_Waves, compute the C_Waves outputs by calling the C_Waves "
+        "executable in cWaves_path, or in python (in-process; not yet validated "
+        "against the C_Waves outputs)",
+    )
     snr_radius = Int(
         require=False,
         missing=8,
@@ -64,6 +74,30 @@ class MeanWaveformParams(Schema):
     mean_waveforms_file = String(
         required=False, help="Path to mean waveforms file (.npy)"
     )
+    stream_chunk_s = Float(
+        required=False,
+        missing=5.0,
+        help="Seconds of data read at a time when extracting waveforms in python",
+    )
+    cluster_ids = List(
+        Int,
+        required=False,
+        missing=None,
+        allow_none=True,
+        help="IDs of the units to extract in python (default all units); their rows replace those in the existing mean waveforms and metrics files",
+    )
+    read_mode = String(
+        required=False,
+        missing="auto",
+        validate=OneOf(["auto", "stream", "gather"]),
+        help="Stream the whole file, or gather only the spike snippets; auto "
+        "gathers when that reads a small part of the file",
+    )
+    gather_threads = Int(
+        required=False,
+        missing=4,
+        help="Number of reads in flight when gathering spike snippets",
+    )
 
 
 class InputParameters(Schema):
@@ -75,6 +109,7 @@ class InputParameters(Schema):
     cluster_metrics = Nested(ClusterMetricsFile)
     ephys_params = Nested(EphysParams)
     directories = Nested(Directories)
+    instrumentation_params = Nested(InstrumentationParams, required=False)
 
 
 class OutputSchema(Schema):
@@ -93,6 +128,7 @@ class OutputParameters(OutputSchema):
         unknown = INCLUDE
 
     execution_time = Float()
+    spans = Dict(required=False, help="Tree of timing and memory spans of the run")
     mean_waveforms_file = String()
 
 
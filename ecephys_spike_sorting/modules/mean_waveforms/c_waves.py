@@ -0,0 +1,174 @@
+import numpy as np
+
+from .stream_waveforms import gather_mean_waveforms
+
+# the SNR noise is measured on the first samples of each snippet, before the
+# spike, as in C_Waves
+SNR_NOISE_SAMPLES = 15
+
+
+def select_c_waves_spikes(spike_times, spike_clusters, total_units, num_spikes):
+
+    """
+    Up to num_spikes spikes of each cluster, spread evenly through its spikes
+
+    Spikes are drawn uniformly from the entire recording (every
+    count / num_spikes-th spike, in time order), so no random state is used.
+
+    Outputs:
+    --------
+    times : numpy.ndarray (num_selected x 0)
+    clusters : numpy.ndarray (num_selected x 0)
+
+    """
+
+    spike_times = np.squeeze(spike_times).astype('int64')
+    spike_clusters = np.squeeze(spike_clusters).astype('int64')
+
+    order = np.lexsort((spike_times, spike_clusters))
+
+    counts = np.bincount(spike_clusters, minlength=total_units)[:total_units]
+    offsets = np.cumsum(counts) - counts
+    selected = np.minimum(counts, num_spikes)
+
+    clusters = np.repeat(np.arange(total_units), selected)
+    rank = np.arange(clusters.size) - np.repeat(np.cumsum(selected) - selected, selected)
+
+    positions = offsets[clusters] + rank * counts[clusters] // selected[clusters]
+
+    return spike_times[order[positions]], clusters
+
+
+def c_waves_mean_waveforms(raw_data,
+                           spike_times,
+                           spike_clusters,
+                           bit_volts,
+                           samples_per_spike,
+                           pre_samples,
+                           num_spikes,
+                           peak_channels=None,
+                           snr_radius=8,
+                           snr_radius_um=None,
+                           site_x=None,
+                           site_y=None,
+                           num_threads=4):
+
+    """
+    Mean waveforms and SNR of every cluster, in the format of C_Waves
+
+    Runs in the same process as the module, on the spike arrays it has
+    already loaded. The snippets are read with gather_mean_waveforms, in
+    merged reads issued by num_threads threads.
+
+    The SNR is (Vmax - Vmin) of the mean waveform on the peak channel, over
+    2 * sqrt(variance), where the variance of the residuals (snippet - mean)
+    is taken over the first SNR_NOISE_SAMPLES samples of the channels in a
+    disk around the peak channel, with one degree of freedom per mean value.
+    The disk holds the sites within snr_radius_um of the peak site if that
+    and the site positions are given, and otherwise the channels within
+    snr_radius channels of the peak channel.
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray or memmap (num_samples x num_channels), int16
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    bit_volts : float
+        Scale from int16 values to microvolts
+    samples_per_spike : int
+        Number of samples in each snippet
+    pre_samples : int
+        Number of samples before the peak
+    num_spikes : int
+        Max number of spikes averaged per cluster
+    peak_channels : numpy.ndarray (num_clusters x 0) or None
+        Peak channel of each cluster (column 1 of cluster_table); the SNR is
+        only calculated if given
+    snr_radius : int
+        Disk radius in channels
+    snr_radius_um : float or None
+        Disk radius in um
+    site_x, site_y : numpy.ndarray or None
+        Positions (um) of the sites, in order of channel in the data file;
+        channels without a position (e.g. the sync channel) are left out of
+        the disk
+    num_threads : int
+        Number of reads in flight
+
+    Outputs:
+    --------
+    mean_waveforms : numpy.ndarray (num_clusters x num_channels x samples_per_spike), float32
+        Mean waveform in microvolts, zero for clusters without spikes
+    cluster_snr : numpy.ndarray (num_clusters x 2), float32
+        SNR (0) and number of spikes averaged (1)
+
+    """
+
+    num_channels = raw_data.shape[1]
+
+    if peak_channels is not None:
+        total_units = len(peak_channels)
+    else:
+        total_units = int(np.max(spike_clusters)) + 1
+
+    times, clusters = select_c_waves_spikes(spike_times, spike_clusters, total_units, num_spikes)
+
+    waveforms, valid_count = gather_mean_waveforms(raw_data,
+                                                   times,
+                                                   clusters,
+                                                   np.zeros(clusters.shape, dtype='int64'),
+                                                   total_units,
+                                                   1,
+                                                   pre_samples,
+                                                   samples_per_spike,
+                                                   bit_volts,
+                                                   num_threads)
+
+    waveforms = np.nan_to_num(waveforms[:, 0])
+    valid_count = valid_count[:, 0]
+
+    mean_waveforms = waveforms[:, 0].astype('float32')
+
+    cluster_snr = np.zeros((total_units, 2), dtype='float32')
+    cluster_snr[:, 1] = valid_count
+
+    if peak_channels is None:
+        return mean_waveforms, cluster_snr
+
+    peak_channels = np.asarray(peak_channels, dtype='int64')
+
+    # channels in the disk around the peak channel of each cluster
+    if site_x is not None and site_y is not None:
+        num_sites = len(site_x)
+        has_site = peak_channels < num_sites
+        peak_sites = np.minimum(peak_channels, num_sites - 1)
+    else:
+        num_sites = num_channels
+        has_site = np.ones((total_units,), dtype='bool')
+        peak_sites = peak_channels
+
+    if snr_radius_um is not None and site_x is not None and site_y is not None:
+        distance = np.hypot(np.asarray(site_x)[np.newaxis, :] - np.asarray(site_x)[peak_sites, np.newaxis],
+                            np.asarray(site_y)[np.newaxis, :] - np.asarray(site_y)[peak_sites, np.newaxis])
+        in_disk = distance <= snr_radius_um
+    else:
+        in_disk = np.abs(np.arange(num_sites)[np.newaxis, :] - peak_sites[:, np.newaxis]) <= snr_radius
+
+    # sums of squared residuals from the std of each channel and sample
+    noise_samples = min(SNR_NOISE_SAMPLES, samples_per_spike)
+    residuals = np.sum(waveforms[:, 1, :num_sites, :noise_samples] ** 2, 2) * valid_count[:, np.newaxis]
+
+    degrees_of_freedom = np.sum(in_disk, 1) * noise_samples * (valid_count - 1)
+
+    peak_waveforms = mean_waveforms[np.arange(total_units), peak_channels].astype('float64')
+    vpp = np.max(peak_waveforms, 1) - np.min(peak_waveforms, 1)
+
+    has_snr = has_site & (degrees_of_freedom > 0)
+    variance = np.sum(residuals * in_disk, 1)[has_snr] / degrees_of_freedom[has_snr]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cluster_snr[has_snr, 0] = vpp[has_snr] / (2 * np.sqrt(variance))
+
+    return mean_waveforms, cluster_snr
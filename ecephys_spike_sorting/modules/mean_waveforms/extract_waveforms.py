@@ -7,9 +7,11 @@ import pandas as pd
 
 import warnings
 
-from .waveform_metrics import calculate_waveform_metrics
+from .stream_waveforms import GATHER_AUTO_FRACTION, gather_mean_waveforms, select_waveform_spikes, stream_mean_waveforms
+from .waveform_metrics import calculate_snr_from_std, calculate_waveform_metrics_batch
 from ...common.epoch import Epoch
-from ...common.utils import printProgressBar
+from ...common.instrumentation import span
+from ...common.snippets import gather_read_samples
 
 def extract_waveforms(raw_data, 
                       spike_times, 
@@ -20,7 +22,8 @@ def extract_waveforms(raw_data,
                       sample_rate, 
                       site_spacing, 
                       params, 
-                      epochs=None):
+                      epochs=None,
+                      channel_pos=None):
     
     """
     Calculate mean waveforms for sorted units.
@@ -34,6 +37,14 @@ def extract_waveforms(raw_data,
     cluster_quality : 'noise' or 'good'
     sample_rate : Hz
     site_spacing : m
+    epochs : list of Epoch objects (optional)
+    channel_pos : numpy array (channels in channel_map x 2) (optional)
+        site positions (um) for the 2D waveform metrics; if not given, sites
+        are taken to be site_spacing apart in one column
+
+    The data are either read in one pass, in time order (see
+    stream_mean_waveforms), or only the snippets are read (see
+    gather_mean_waveforms), which is faster when few units are extracted.
 
     Outputs:
     -------
@@ -56,6 +67,11 @@ def extract_waveforms(raw_data,
     pre_samples : number of samples prior to peak
     num_epochs : number of epochs to calculate mean waveforms
     spikes_per_epoch : max number of spikes to generate average for epoch
+    stream_chunk_s : seconds of data read at a time (optional, default 5)
+    cluster_ids : IDs of the units to extract (optional, default all)
+    read_mode : 'stream', 'gather' or 'auto' (optional, default 'auto', which
+        gathers if that reads less than GATHER_AUTO_FRACTION of the data)
+    gather_threads : number of reads in flight when gathering (optional, default 4)
 
     """
 
@@ -80,77 +96,97 @@ def extract_waveforms(raw_data,
     total_units = len(cluster_ids)
     total_epochs = len(epochs)
 
-    # allocate array for waveforms, datatype = default, double
-    mean_waveforms = np.zeros(
-        (total_units, total_epochs, 2, raw_data.shape[1], samples_per_spike))
-    spike_count = np.zeros((total_units, total_epochs + 1), dtype = 'int')
-
     peak_channels = np.squeeze(channel_map[np.argmax(np.max(templates,1) - np.min(templates,1),1)])
 
-    for epoch_idx, epoch in enumerate(epochs):
-
-        print("Epoch: " + epoch.name)
-
-        in_epoch = ((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time)
-
-        spike_times_in_epoch = spike_times[in_epoch]
-
-        for cluster_idx, cluster_id in enumerate(cluster_ids):
-
-            printProgressBar(cluster_idx+1, total_units)
-
-            in_cluster = (spike_clusters[in_epoch] == cluster_id)
-
-            if np.sum(in_cluster) > 0:
-
-                times_for_cluster = spike_times_in_epoch[in_cluster]
-
-                waveforms = np.empty(
-                    (spikes_per_epoch, raw_data.shape[1], samples_per_spike))
-                waveforms[:] = np.nan
-
-                np.random.shuffle(times_for_cluster)
-
-                total_waveforms = np.min(
-                    [times_for_cluster.size, spikes_per_epoch])
-
-                for wv_idx, peak_time in enumerate(times_for_cluster[:total_waveforms]):
-                    start = int(peak_time-pre_samples)
-                    end = start + samples_per_spike
-                    rawWaveform = raw_data[start:end, :].T
-
-                    # in case spike was at start or end of dataset
-                    if rawWaveform.shape[1] == samples_per_spike:
-                        waveforms[wv_idx, :, :] = rawWaveform * bit_volts
-
-                # concatenate to existing dataframe
-                metrics = pd.concat([metrics, calculate_waveform_metrics(waveforms[:total_waveforms, :, :],
-                                                                         cluster_id, 
-                                                                         peak_channels[cluster_idx], 
-                                                                         channel_map,
-                                                                         sample_rate, 
-                                                                         upsampling_factor,
-                                                                         spread_threshold,
-                                                                         site_range,
-                                                                         site_spacing,
-                                                                         epoch.name
-                                                                         )])
-
-                with warnings.catch_warnings():
-
-                    warnings.simplefilter("ignore", category=RuntimeWarning)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   0, :, :] = np.nanmean(waveforms, 0)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   1, :, :] = np.nanstd(waveforms, 0)
-
-                    # remove offset
-                    for channel in range(0, mean_waveforms.shape[3]):
-                        mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] = \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] - \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, 0]
-
-                spike_count[cluster_idx, epoch_idx] = total_waveforms
+    if channel_pos is not None:
+        site_x, site_y = channel_pos[:, 0], channel_pos[:, 1]
+    else:
+        site_x, site_y = None, None
+
+    if params.get('cluster_ids') is not None:
+        # re-extract a subset of units (e.g. after curation)
+        in_units = np.isin(np.squeeze(spike_clusters), params['cluster_ids'])
+        spike_times = np.squeeze(spike_times)[in_units]
+        spike_clusters = np.squeeze(spike_clusters)[in_units]
+
+    with span('select_spikes'):
+        times, clusters, epoch_indices, spike_count = select_waveform_spikes(spike_times,
+                                                                            spike_clusters,
+                                                                            epochs,
+                                                                            sample_rate,
+                                                                            spikes_per_epoch,
+                                                                            total_units)
+
+    read_mode = params.get('read_mode', 'auto')
+
+    if read_mode == 'auto':
+        starts = times - pre_samples
+        starts = starts[(starts >= 0) & (starts + samples_per_spike <= raw_data.shape[0])]
+        gather_fraction = gather_read_samples(raw_data, starts, samples_per_spike) / raw_data.shape[0]
+        read_mode = 'gather' if gather_fraction < GATHER_AUTO_FRACTION else 'stream'
+
+    with span('read_waveforms', num_spikes=times.size, read_mode=read_mode):
+        print("Reading waveforms for " + repr(times.size) + " spikes")
+        # datatype = default, double
+        if read_mode == 'gather':
+            mean_waveforms, valid_count = gather_mean_waveforms(raw_data,
+                                                                times,
+                                                                clusters,
+                                                                epoch_indices,
+                                                                total_units,
+                                                                total_epochs,
+                                                                pre_samples,
+                                                                samples_per_spike,
+                                                                bit_volts,
+                                                                params.get('gather_threads', 4))
+        else:
+            mean_waveforms, valid_count = stream_mean_waveforms(raw_data,
+                                                                times,
+                                                                clusters,
+                                                                epoch_indices,
+                                                                total_units,
+                                                                total_epochs,
+                                                                pre_samples,
+                                                                samples_per_spike,
+                                                                bit_volts,
+                                                                int(params.get('stream_chunk_s', 5.0) * sample_rate))
+
+    with span('waveform_metrics'):
+        print("Calculating waveform metrics")
+
+        # clusters with spikes in each epoch, in order of epoch
+        epoch_idx, cluster_idx = np.nonzero(spike_count[:, :total_epochs].T)
+
+        if cluster_idx.size > 0:
+
+            peak_mean = mean_waveforms[cluster_idx, epoch_idx, 0, peak_channels[cluster_idx], :]
+            peak_std = mean_waveforms[cluster_idx, epoch_idx, 1, peak_channels[cluster_idx], :]
+
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                snr = calculate_snr_from_std(peak_mean, peak_std)
+
+            channel_map = np.squeeze(channel_map)
+
+            if site_x is None or site_y is None:
+                site_x = np.zeros((len(channel_map),))
+                site_y = np.arange(len(channel_map)) * site_spacing * 1e6
+
+            metrics = calculate_waveform_metrics_batch(mean_waveforms[cluster_idx, epoch_idx, 0][:, channel_map, :],
+                                                       snr,
+                                                       cluster_ids[cluster_idx],
+                                                       peak_channels[cluster_idx],
+                                                       np.argmin(np.abs(channel_map[np.newaxis, :] - peak_channels[cluster_idx, np.newaxis]), 1),
+                                                       sample_rate,
+                                                       upsampling_factor,
+                                                       spread_threshold,
+                                                       site_range,
+                                                       site_x,
+                                                       site_y,
+                                                       [epochs[idx].name for idx in epoch_idx])
+
+    # remove offset
+    mean_waveforms[:, :, 0, :, :] -= mean_waveforms[:, :, 0, :, :1]
 
     dimCoords, dimLabels = generateDimLabels(
         cluster_ids, total_epochs, pre_samples, samples_per_spike, raw_data.shape[1], sample_rate)
@@ -208,3 +244,29 @@ def writeDataAsNpy(waveforms, output_file):
     mean_waveforms = waveforms[:, -1, 0, :, :]  # extract overall mean
 
     np.save(output_file, mean_waveforms)
+
+
+def updateDataAsNpy(waveforms, output_file, cluster_ids):
+    """ Saves the overall mean waveforms of some units into an existing file
+
+    The rows of cluster_ids are replaced (with zeros for units that no longer
+    have spikes); the other units keep their saved waveforms. Without a
+    matching existing file, all units are written as in writeDataAsNpy. """
+
+    mean_waveforms = waveforms[:, -1, 0, :, :]  # extract overall mean
+
+    if os.path.exists(output_file):
+        saved = np.load(output_file)
+        if saved.shape[1:] == mean_waveforms.shape[1:]:
+            total_units = max(saved.shape[0], mean_waveforms.shape[0])
+            updated = np.zeros((total_units,) + mean_waveforms.shape[1:], dtype=mean_waveforms.dtype)
+            updated[:saved.shape[0]] = saved
+            cluster_ids = np.asarray(cluster_ids, dtype='int64')
+            updated[cluster_ids[cluster_ids < total_units]] = 0
+            in_range = cluster_ids[cluster_ids < mean_waveforms.shape[0]]
+            updated[in_range] = mean_waveforms[in_range]
+            mean_waveforms = updated
+        else:
+            print('Mean waveforms in ' + output_file + ' have a different shape; overwriting them')
+
+    np.save(output_file, mean_waveforms)
@@ -7,8 +7,7 @@ import pandas as pd
 import xarray as xr
 
 from ...common.epoch import Epoch
-from ...common.utils import printProgressBar
-from .waveform_metrics import calculate_waveform_metrics_from_avg
+from .waveform_metrics import calculate_waveform_metrics_batch
 
 
 def metrics_from_file(
@@ -69,6 +68,60 @@ def metrics_from_file(
 
     """
 
+    mean_waveforms = np.load(mean_waveform_fullpath)
+    snr_array = np.load(snr_fullpath)
+    clus_table = np.load(clus_fullpath)
+
+    return metrics_from_c_waves(
+        mean_waveforms,
+        snr_array,
+        clus_table,
+        spike_times,
+        spike_clusters,
+        templates,
+        channel_map,
+        bit_volts,
+        sample_rate,
+        site_spacing,
+        w_inv,
+        site_x,
+        site_y,
+        params,
+    )
+
+
+def metrics_from_c_waves(
+    mean_waveforms,
+    snr_array,
+    clus_table,
+    spike_times,
+    spike_clusters,
+    templates,
+    channel_map,
+    bit_volts,
+    sample_rate,
+    site_spacing,
+    w_inv,
+    site_x,
+    site_y,
+    params,
+):
+    """
+    Call waveform_metrics for each cluster, from C_Waves output in memory
+
+    Inputs:
+    -------
+    mean_waveforms : numpy.ndarray (num_clusters x num_channels x num_samples)
+        contents of mean_waveforms.npy
+    snr_array : numpy.ndarray (num_clusters x 2)
+        contents of cluster_snr.npy
+    clus_table : numpy.ndarray (num_clusters x 2)
+        contents of clus_Table.npy (contains peak channels)
+
+    The other inputs are as for metrics_from_file.
+
+    """
+
     # #############################################
 
     samples_per_spike = params["samples_per_spike"]
@@ -86,10 +139,7 @@ def metrics_from_file(
     cluster_ids = np.arange(np.max(spike_clusters) + 1)
     total_units = len(cluster_ids)
 
-    mean_waveforms = np.load(mean_waveform_fullpath)
-    snr_array = np.load(snr_fullpath)
-    clus_table = np.load(clus_fullpath)
-    peak_channels = clus_table[:, 1]
+    peak_channels = clus_table[:, 1].copy()
 
     # peak channels were estimated from the unwhitened templates, but the
     # actual peak channel is sometimes offset (due to drift, or other effects)
@@ -105,32 +155,24 @@ def metrics_from_file(
     vpp_nonzero = vpp_val > 0
     peak_channels[vpp_nonzero] = meas_pkchan[vpp_nonzero]
 
-    for cluster_idx, cluster_id in enumerate(cluster_ids):
-
-        printProgressBar(cluster_idx + 1, total_units)
-
-        snr = snr_array[cluster_idx, 0]
-        nSpike = snr_array[cluster_idx, 1]
-        # if at least one spike, calculate metrics and concatenate to existing dataframe
-        if nSpike > 0:
-            metrics = pd.concat(
-                [
-                    metrics,
-                    calculate_waveform_metrics_from_avg(
-                        mean_waveforms[cluster_idx, :],
-                        snr,
-                        cluster_id,
-                        peak_channels[cluster_idx],
-                        channel_map,
-                        sample_rate,
-                        upsampling_factor,
-                        spread_threshold,
-                        site_range,
-                        site_x,
-                        site_y,
-                    ),
-                ]
-            )
+    # calculate metrics for the clusters with at least one spike, all at once
+    has_spikes = np.flatnonzero(snr_array[:total_units, 1] > 0)
+
+    if has_spikes.size > 0:
+        metrics = calculate_waveform_metrics_batch(
+            mean_waveforms[has_spikes],
+            snr_array[has_spikes, 0],
+            cluster_ids[has_spikes],
+            peak_channels[has_spikes],
+            peak_channels[has_spikes],
+            sample_rate,
+            upsampling_factor,
+            spread_threshold,
+            site_range,
+            site_x,
+            site_y,
+            "complete_session",
+        )
 
     return metrics
 
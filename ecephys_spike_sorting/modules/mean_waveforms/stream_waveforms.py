@@ -0,0 +1,279 @@
+import numpy as np
+
+from ...common.cluster_index import ClusterIndex
+from ...common.snippets import Snippets, iter_snippet_reads
+from ...common.utils import printProgressBar
+
+# upper limit on the float64 snippets held at once while accumulating
+SNIPPET_BATCH_BYTES = 2**27
+# extract_waveforms gathers the snippets, instead of streaming the data, when
+# that reads less than this fraction of the samples
+GATHER_AUTO_FRACTION = 0.1
+
+
+def select_waveform_spikes(spike_times, spike_clusters, epochs, sample_rate, spikes_per_epoch, total_units):
+
+    """
+    Choose the spikes to average for each cluster and epoch
+
+    For each epoch (in order) and each cluster with spikes in it (in order of
+    cluster ID), the spike times of the cluster are shuffled with
+    np.random.shuffle and the first spikes_per_epoch are kept, so the same
+    spikes are chosen (for the same random state) as when the waveforms were
+    read one cluster at a time.
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    epochs : list of Epoch objects
+        Start and end times in seconds
+    sample_rate : float
+        Hz
+    spikes_per_epoch : int
+        Max number of spikes per cluster and epoch
+    total_units : int
+        Number of cluster IDs
+
+    Outputs:
+    --------
+    times : numpy.ndarray (num_selected x 0)
+        Peak time (in samples) of each selected spike
+    clusters : numpy.ndarray (num_selected x 0)
+        Cluster ID of each selected spike
+    epoch_indices : numpy.ndarray (num_selected x 0)
+        Epoch of each selected spike; a spike in overlapping epochs is
+        selected separately for each
+    spike_count : numpy.ndarray (total_units x num_epochs + 1)
+        Number of spikes selected for each cluster and epoch
+
+    """
+
+    spike_times = np.squeeze(spike_times)
+    spike_clusters = np.squeeze(spike_clusters)
+
+    spike_count = np.zeros((total_units, len(epochs) + 1), dtype='int')
+
+    times = []
+    clusters = []
+    epoch_indices = []
+
+    for epoch_idx, epoch in enumerate(epochs):
+
+        in_epoch = ((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time)
+
+        cluster_index = ClusterIndex(spike_clusters[in_epoch], total_units)
+        sorted_times = cluster_index.sort(spike_times[in_epoch])
+
+        for cluster_id in cluster_index.cluster_ids:
+
+            times_for_cluster = cluster_index.unit(sorted_times, cluster_id).copy()
+
+            np.random.shuffle(times_for_cluster)
+
+            total_waveforms = min(times_for_cluster.size, spikes_per_epoch)
+
+            times.append(times_for_cluster[:total_waveforms])
+            clusters.append(np.full((total_waveforms,), cluster_id, dtype='int64'))
+            epoch_indices.append(np.full((total_waveforms,), epoch_idx, dtype='int64'))
+
+            spike_count[cluster_id, epoch_idx] = total_waveforms
+
+    if len(times) == 0:
+        return np.zeros((0,), dtype='int64'), np.zeros((0,), dtype='int64'), np.zeros((0,), dtype='int64'), spike_count
+
+    return np.concatenate(times).astype('int64'), np.concatenate(clusters), np.concatenate(epoch_indices), spike_count
+
+
+def stream_mean_waveforms(raw_data,
+                          times,
+                          clusters,
+                          epoch_indices,
+                          total_units,
+                          total_epochs,
+                          pre_samples,
+                          samples_per_spike,
+                          bit_volts,
+                          chunk_samples):
+
+    """
+    Mean and standard deviation of spike waveforms, in one pass over the data
+
+    The selected spikes are sorted by time and the data is read in order, in
+    chunks of up to chunk_samples samples (plus a halo of samples_per_spike,
+    so snippets crossing the end of a chunk are complete). Chunks without
+    selected spikes are skipped, and each chunk is read from its first to its
+    last needed sample only, so every part of the file is read at most once.
+    The snippets in a chunk are added to per-cluster, per-epoch running means
+    and sums of squared deviations (Welford's method, combined a batch at a
+    time), which give the mean and std of every cluster and epoch at the end.
+
+    Snippets that extend past the start or end of the data are not included,
+    but are still counted as selected by select_waveform_spikes.
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray or memmap (num_samples x num_channels), int16
+    times, clusters, epoch_indices : numpy.ndarray (num_selected x 0)
+        Outputs of select_waveform_spikes
+    total_units, total_epochs : int
+    pre_samples : int
+        Number of samples before the peak
+    samples_per_spike : int
+        Number of samples in each snippet
+    bit_volts : float
+        Scale from int16 values to microvolts
+    chunk_samples : int
+        Samples read per chunk (excluding the halo)
+
+    Outputs:
+    --------
+    mean_waveforms : numpy.ndarray (total_units x total_epochs x 2 x num_channels x samples_per_spike)
+        Mean (0) and std (1) in microvolts; zero for clusters without spikes
+        in an epoch, NaN if none of their snippets were inside the data
+    valid_count : numpy.ndarray (total_units x total_epochs)
+        Number of snippets averaged
+
+    """
+
+    num_samples, num_channels = raw_data.shape
+
+    mean_waveforms = np.zeros((total_units, total_epochs, 2, num_channels, samples_per_spike))
+    valid_count = np.zeros((total_units, total_epochs), dtype='int64')
+
+    starts = np.asarray(times, dtype='int64') - pre_samples
+    inside = (starts >= 0) & (starts + samples_per_spike <= num_samples)
+
+    order = np.argsort(starts[inside], kind='stable')
+    starts = starts[inside][order]
+    keys = (np.asarray(clusters)[inside] * total_epochs + np.asarray(epoch_indices)[inside])[order]
+
+    batch_size = max(1, SNIPPET_BATCH_BYTES // (num_channels * samples_per_spike * 8))
+    offsets = np.arange(samples_per_spike)
+
+    chunk_bounds = np.searchsorted(starts, np.arange(0, num_samples + chunk_samples, chunk_samples))
+    chunk_bounds = np.unique(chunk_bounds)
+
+    for idx, (first, last) in enumerate(zip(chunk_bounds[:-1], chunk_bounds[1:])):
+
+        printProgressBar(idx + 1, len(chunk_bounds) - 1)
+
+        # one sequential read from the first to the last sample needed
+        chunk_start = starts[first]
+        chunk = np.asarray(raw_data[chunk_start:starts[last - 1] + samples_per_spike, :])
+
+        for batch_start in range(first, last, batch_size):
+
+            batch = slice(batch_start, min(batch_start + batch_size, last))
+
+            snippets = chunk[(starts[batch] - chunk_start)[:, np.newaxis] + offsets, :]
+            snippets = np.transpose(snippets, (0, 2, 1)) * bit_volts
+
+            _accumulate(mean_waveforms, valid_count, snippets, keys[batch], total_epochs)
+
+    _finalize(mean_waveforms, valid_count, clusters, epoch_indices, total_units, total_epochs)
+
+    return mean_waveforms, valid_count
+
+
+def gather_mean_waveforms(raw_data,
+                          times,
+                          clusters,
+                          epoch_indices,
+                          total_units,
+                          total_epochs,
+                          pre_samples,
+                          samples_per_spike,
+                          bit_volts,
+                          num_threads=4):
+
+    """
+    Mean and standard deviation of spike waveforms, reading only the snippets
+
+    Same inputs and outputs as stream_mean_waveforms (without chunk_samples),
+    but the snippets are read with iter_snippet_reads: sorted by offset,
+    merged into reads where they are close together, and read ahead by
+    num_threads threads. This reads much less of the file than streaming when
+    only a few units are extracted.
+
+    """
+
+    num_samples, num_channels = raw_data.shape
+
+    mean_waveforms = np.zeros((total_units, total_epochs, 2, num_channels, samples_per_spike))
+    valid_count = np.zeros((total_units, total_epochs), dtype='int64')
+
+    starts = np.asarray(times, dtype='int64') - pre_samples
+    inside = (starts >= 0) & (starts + samples_per_spike <= num_samples)
+
+    starts = starts[inside]
+    keys = np.asarray(clusters)[inside] * total_epochs + np.asarray(epoch_indices)[inside]
+
+    batch_size = max(1, SNIPPET_BATCH_BYTES // (num_channels * samples_per_spike * 8))
+
+    batch_indices = []
+    batch_snippets = []
+    batch_count = 0
+
+    for indices, snippets in iter_snippet_reads(raw_data, starts, samples_per_spike, num_threads=num_threads):
+
+        batch_indices.append(indices)
+        batch_snippets.append(snippets)
+        batch_count += indices.size
+
+        if batch_count >= batch_size:
+            _accumulate(mean_waveforms, valid_count, Snippets(np.concatenate(batch_snippets), bit_volts).scaled(),
+                        keys[np.concatenate(batch_indices)], total_epochs)
+            batch_indices, batch_snippets, batch_count = [], [], 0
+
+    if batch_count > 0:
+        _accumulate(mean_waveforms, valid_count, Snippets(np.concatenate(batch_snippets), bit_volts).scaled(),
+                    keys[np.concatenate(batch_indices)], total_epochs)
+
+    _finalize(mean_waveforms, valid_count, clusters, epoch_indices, total_units, total_epochs)
+
+    return mean_waveforms, valid_count
+
+
+def _finalize(mean_waveforms, valid_count, clusters, epoch_indices, total_units, total_epochs):
+
+    # sums of squared deviations to standard deviations
+    has_spikes = np.zeros((total_units * total_epochs,), dtype='bool')
+    has_spikes[np.asarray(clusters) * total_epochs + np.asarray(epoch_indices)] = True
+    has_spikes = np.reshape(has_spikes, (total_units, total_epochs))
+
+    averaged = valid_count > 0
+    mean_waveforms[averaged, 1] = np.sqrt(mean_waveforms[averaged, 1] / valid_count[averaged][:, np.newaxis, np.newaxis])
+    mean_waveforms[has_spikes & ~averaged] = np.nan
+
+
+def _accumulate(mean_waveforms, valid_count, snippets, keys, total_epochs):
+
+    # Chan et al. update of the running means (mean_waveforms[..., 0, :, :])
+    # and sums of squared deviations (mean_waveforms[..., 1, :, :]) with a
+    # batch of snippets; keys = cluster * total_epochs + epoch
+
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    snippets = snippets[order]
+
+    group_keys, group_starts, group_counts = np.unique(keys, return_index=True, return_counts=True)
+
+    batch_mean = np.add.reduceat(snippets, group_starts, axis=0) / group_counts[:, np.newaxis, np.newaxis]
+    deviations = snippets - np.repeat(batch_mean, group_counts, axis=0)
+    batch_m2 = np.add.reduceat(deviations * deviations, group_starts, axis=0)
+
+    cluster_ids, epoch_ids = np.divmod(group_keys, total_epochs)
+
+    previous_count = valid_count[cluster_ids, epoch_ids]
+    new_count = previous_count + group_counts
+
+    delta = batch_mean - mean_waveforms[cluster_ids, epoch_ids, 0]
+
+    mean_waveforms[cluster_ids, epoch_ids, 0] += delta * (group_counts / new_count)[:, np.newaxis, np.newaxis]
+    mean_waveforms[cluster_ids, epoch_ids, 1] += batch_m2 + delta * delta * \
+        (previous_count * group_counts / new_count)[:, np.newaxis, np.newaxis]
+
+    valid_count[cluster_ids, epoch_ids] = new_count
@@ -1,5 +1,6 @@
 import numpy as np
 import random
+import warnings
 import pandas as pd
 
 from scipy.stats import linregress
@@ -14,7 +15,9 @@ def calculate_waveform_metrics(waveforms,
                                spread_threshold,
                                site_range,
                                site_spacing,
-                               epoch_name):
+                               epoch_name,
+                               site_x=None,
+                               site_y=None):
     
     """
     Calculate metrics for an array of waveforms.
@@ -45,6 +48,10 @@ def calculate_waveform_metrics(waveforms,
         Number of sites to use for 2D waveform metrics
     site_spacing : float
         Average vertical distance between sites (m)
+    epoch_name : str
+    site_x, site_y : numpy.ndarray (optional)
+        Positions (um) of the channels in channel_map; if not given, the
+        channels are taken to be in one column, site_spacing apart
 
     Outputs:
     -------
@@ -55,37 +62,74 @@ def calculate_waveform_metrics(waveforms,
 
     snr = calculate_snr(waveforms[:, peak_channel, :])
 
-    mean_2D_waveform = np.squeeze(np.nanmean(waveforms[:, channel_map, :], 0))
-    local_peak = np.argmin(np.abs(channel_map - peak_channel))
-
-    num_samples = waveforms.shape[2]
-    new_sample_count = int(num_samples * upsampling_factor)
+    return calculate_waveform_metrics_from_mean(np.nanmean(waveforms, 0),
+                                                snr,
+                                                cluster_id,
+                                                peak_channel,
+                                                channel_map,
+                                                sample_rate,
+                                                upsampling_factor,
+                                                spread_threshold,
+                                                site_range,
+                                                site_spacing,
+                                                epoch_name,
+                                                site_x,
+                                                site_y)
+
+
+def calculate_waveform_metrics_from_mean(mean_waveform,
+                                         snr,
+                                         cluster_id,
+                                         peak_channel,
+                                         channel_map,
+                                         sample_rate,
+                                         upsampling_factor,
+                                         spread_threshold,
+                                         site_range,
+                                         site_spacing,
+                                         epoch_name,
+                                         site_x=None,
+                                         site_y=None):
 
-    mean_1D_waveform = resample(
-        mean_2D_waveform[local_peak, :], new_sample_count)
+    """
+    Calculate metrics from the mean waveform of a cluster on all channels
 
-    timestamps = np.linspace(0, num_samples / sample_rate, new_sample_count)
+    As calculate_waveform_metrics, for waveforms that have already been
+    averaged (e.g. by stream_mean_waveforms), with the SNR given.
 
-    duration = calculate_waveform_duration(mean_1D_waveform, timestamps)
-    halfwidth = calculate_waveform_halfwidth(mean_1D_waveform, timestamps)
-    PT_ratio = calculate_waveform_PT_ratio(mean_1D_waveform)
-    repolarization_slope = calculate_waveform_repolarization_slope(
-        mean_1D_waveform, timestamps)
-    recovery_slope = calculate_waveform_recovery_slope(
-        mean_1D_waveform, timestamps)
+    Inputs:
+    -------
+    mean_waveform : numpy.ndarray (num_channels x num_samples)
+    snr : float
+        e.g. from calculate_snr_from_std
+    other inputs : as calculate_waveform_metrics
 
-    amplitude, spread, velocity_above, velocity_below = calculate_2D_features(
-        mean_2D_waveform, timestamps, local_peak, spread_threshold, site_range, site_spacing)
+    Outputs:
+    -------
+    metrics : pandas.DataFrame
+        Single-row table containing all metrics
 
-    data = [[cluster_id, epoch_name, peak_channel, snr, duration, halfwidth, PT_ratio, repolarization_slope,
-              recovery_slope, amplitude, spread, velocity_above, velocity_below]]
+    """
 
-    metrics = pd.DataFrame(data,
-                           columns=['cluster_id', 'epoch_name', 'peak_channel', 'snr', 'duration', 'halfwidth',
-                                     'PT_ratio', 'repolarization_slope', 'recovery_slope', 'amplitude',
-                                     'spread', 'velocity_above', 'velocity_below'])
+    channel_map = np.squeeze(channel_map)
+    local_peak = np.argmin(np.abs(channel_map - peak_channel))
 
-    return metrics
+    if site_x is None or site_y is None:
+        site_x = np.zeros((len(channel_map),))
+        site_y = np.arange(len(channel_map)) * site_spacing * 1e6
+
+    return calculate_waveform_metrics_batch(mean_waveform[np.newaxis, channel_map, :],
+                                            [snr],
+                                            [cluster_id],
+                                            [peak_channel],
+                                            [local_peak],
+                                            sample_rate,
+                                            upsampling_factor,
+                                            spread_threshold,
+                                            site_range,
+                                            site_x,
+                                            site_y,
+                                            epoch_name)
 
 def calculate_waveform_metrics_from_avg(avg_waveform,
                                         snr,
@@ -135,45 +179,104 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
 
     """
 
-    # snr = calculate_snr(waveforms[:, peak_channel, :])
-    
     # calulating from average waveforms drawn from whole session
-    epoch_name = 'complete_session'
     
     # all metric calculations are restricted to the channesl in the map
     # jic removed this -- we need to sample all channels for 2D calculations
     # moreover, this is assumed in the stnadard Allen calculation
-    # mean_2D_waveform = np.squeeze(avg_waveform[channel_map, :])
-    # local_peak = np.argmin(np.abs(channel_map - peak_channel))
-    mean_2D_waveform = avg_waveform
-    local_peak = peak_channel
+    return calculate_waveform_metrics_batch(avg_waveform[np.newaxis, :, :],
+                                            [snr],
+                                            [cluster_id],
+                                            [peak_channel],
+                                            [peak_channel],
+                                            sample_rate,
+                                            upsampling_factor,
+                                            spread_threshold,
+                                            site_range,
+                                            site_x,
+                                            site_y,
+                                            'complete_session')
+
+
+def calculate_waveform_metrics_batch(mean_waveforms,
+                                     snr,
+                                     cluster_ids,
+                                     peak_channels,
+                                     local_peaks,
+                                     sample_rate,
+                                     upsampling_factor,
+                                     spread_threshold,
+                                     site_range,
+                                     site_x,
+                                     site_y,
+                                     epoch_names):
 
-    num_samples = mean_2D_waveform.shape[1]
-    new_sample_count = int(num_samples * upsampling_factor)
+    """
+    Calculate metrics from the mean waveforms of many units at once
 
-    mean_1D_waveform = resample(
-        mean_2D_waveform[local_peak, :], new_sample_count)
+    Gives the same metrics as calculating them one unit at a time with the
+    1D and 2D feature functions below: the peak-channel waveforms of all
+    units are upsampled with one FFT resample, and each feature is computed
+    as an array operation over units. Units whose waveform contains NaN get
+    NaN metrics.
+
+    Inputs:
+    -------
+    mean_waveforms : numpy.ndarray (num_units x num_channels x num_samples)
+        Channels in the order of site_x and site_y
+    snr : numpy.ndarray (num_units x 0)
+    cluster_ids : numpy.ndarray (num_units x 0)
+    peak_channels : numpy.ndarray (num_units x 0)
+        Peak channel, as given in the output table
+    local_peaks : numpy.ndarray (num_units x 0)
+        Index of the peak channel in mean_waveforms
+    sample_rate : float
+        Sample rate in Hz
+    upsampling_factor : float
+        Relative rate at which to upsample the spike waveform
+    spread_threshold : float
+        Threshold for computing spread of 2D waveform
+    site_range : float
+        Number of sites to use for 2D waveform metrics
+    site_x, site_y : numpy.ndarray (num_channels x 0)
+        Channel positions in um
+    epoch_names : str or list of str (one per unit)
+
+    Outputs:
+    -------
+    metrics : pandas.DataFrame
+        One row per unit, in order
+
+    """
+
+    mean_waveforms = np.asarray(mean_waveforms)
+    local_peaks = np.asarray(local_peaks, dtype='int64')
+    site_x = np.asarray(site_x)
+    site_y = np.asarray(site_y)
+
+    num_units, num_channels, num_samples = mean_waveforms.shape
+    new_sample_count = int(num_samples * upsampling_factor)
 
     timestamps = np.linspace(0, num_samples / sample_rate, new_sample_count)
 
-    duration = calculate_waveform_duration(mean_1D_waveform, timestamps)
-    halfwidth = calculate_waveform_halfwidth(mean_1D_waveform, timestamps)
-    PT_ratio = calculate_waveform_PT_ratio(mean_1D_waveform)
-    repolarization_slope = calculate_waveform_repolarization_slope(
-        mean_1D_waveform, timestamps)
-    recovery_slope = calculate_waveform_recovery_slope(
-        mean_1D_waveform, timestamps)
+    missing = np.any(np.isnan(mean_waveforms), (1, 2))
+    mean_waveforms = np.where(missing[:, np.newaxis, np.newaxis], 0, mean_waveforms)
 
-    amplitude, spread, velocity_above, velocity_below = calculate_2D_features(
-        mean_2D_waveform, timestamps, local_peak, site_x, site_y, spread_threshold, site_range)
+    mean_1D_waveforms = resample(mean_waveforms[np.arange(num_units), local_peaks, :], new_sample_count, axis=1)
 
-    data = [[cluster_id, epoch_name, peak_channel, snr, duration, halfwidth, PT_ratio, repolarization_slope,
-              recovery_slope, amplitude, spread, velocity_above, velocity_below]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        features_1D = calculate_1D_features_batch(mean_1D_waveforms, timestamps)
+        features_2D = calculate_2D_features_batch(mean_waveforms, timestamps, local_peaks,
+                                                  site_x, site_y, spread_threshold, site_range)
 
-    metrics = pd.DataFrame(data,
-                           columns=['cluster_id', 'epoch_name', 'peak_channel', 'snr', 'duration', 'halfwidth',
-                                     'PT_ratio', 'repolarization_slope', 'recovery_slope', 'amplitude',
-                                     'spread', 'velocity_above', 'velocity_below'])
+    metrics = pd.DataFrame({'cluster_id': np.asarray(cluster_ids),
+                            'epoch_name': epoch_names,
+                            'peak_channel': np.asarray(peak_channels),
+                            'snr': np.asarray(snr, dtype='float64')},
+                           index=np.zeros((num_units,), dtype='int64'))
+
+    for name, values in list(features_1D.items()) + list(features_2D.items()):
+        metrics[name] = np.where(missing, np.nan, values)
 
     return metrics
 
@@ -210,6 +313,30 @@ def calculate_snr(W):
     return snr
 
 
+def calculate_snr_from_std(mean_waveform, std_waveform):
+
+    """
+    Calculate SNR from the mean and standard deviation of spike waveforms
+
+    Equal to calculate_snr of the waveforms the mean and std (ddof = 0) were
+    taken from: the residuals about the mean have zero mean, so their std is
+    the root mean square of std_waveform.
+
+    Input:
+    -------
+    mean_waveform : mean of N waveforms (samples, or units x samples)
+    std_waveform : std of N waveforms (samples, or units x samples)
+
+    Output:
+    snr : signal-to-noise ratio for unit (scalar, or one per unit)
+
+    """
+
+    A = np.max(mean_waveform, -1) - np.min(mean_waveform, -1)
+
+    return A/(2*np.sqrt(np.mean(std_waveform ** 2, -1)))
+
+
 def calculate_waveform_duration(waveform, timestamps):
     
     """ 
@@ -488,6 +615,200 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
     return amplitude, spread, velocity_above, velocity_below
 
 
+# ==========================================================
+
+# EXTRACTING FEATURES OF MANY UNITS
+
+# ==========================================================
+
+
+def calculate_1D_features_batch(waveforms, timestamps, window=20):
+
+    """
+    1D features of many waveforms, as the single-waveform functions above
+
+    Inputs:
+    ------
+    waveforms : numpy.ndarray (num_units x N samples)
+    timestamps : numpy.ndarray (N samples)
+    window : int
+        Window (in samples) for the slope regressions
+
+    Outputs:
+    --------
+    features : dict of numpy.ndarray (num_units x 0)
+        duration, halfwidth, PT_ratio, repolarization_slope, recovery_slope;
+        NaN where the single-waveform function has no value
+
+    """
+
+    rows = np.arange(waveforms.shape[0])
+    samples = np.arange(waveforms.shape[1])[np.newaxis, :]
+
+    trough_idx = np.argmin(waveforms, 1)
+    peak_idx = np.argmax(waveforms, 1)
+    trough = waveforms[rows, trough_idx]
+    peak = waveforms[rows, peak_idx]
+
+    # features are measured from the peak if it is larger than the trough
+    peak_first = peak > np.abs(trough)
+    start_idx = np.where(peak_first, peak_idx, trough_idx)
+    after_start = samples >= start_idx[:, np.newaxis]
+
+    # duration: to the trough after the peak, or the peak after the trough
+    end_idx = np.where(peak_first,
+                       np.argmin(np.where(after_start, waveforms, np.inf), 1),
+                       np.argmax(np.where(after_start, waveforms, -np.inf), 1))
+
+    duration = (timestamps[end_idx] - timestamps[start_idx]) * 1e3
+
+    # halfwidth: between the first crossings of half the peak (or trough)
+    # before and after it; the sign flips the comparisons for the trough
+    sign = np.where(peak_first, 1.0, -1.0)[:, np.newaxis]
+    threshold = sign * waveforms[rows, start_idx][:, np.newaxis] * 0.5
+
+    crossing_1 = ~after_start & (sign * waveforms > threshold)
+    crossing_2 = after_start & (sign * waveforms < threshold)
+
+    halfwidth = np.where(np.any(crossing_1, 1) & np.any(crossing_2, 1),
+                         (timestamps[np.argmax(crossing_2, 1)] - timestamps[np.argmax(crossing_1, 1)]) * 1e3,
+                         np.nan)
+
+    PT_ratio = np.abs(peak / trough)
+
+    # slopes of the return to baseline, inverted if the peak is the largest deflection
+    max_point = np.argmax(np.abs(waveforms), 1)
+    inverted = - waveforms * np.sign(waveforms[rows, max_point])[:, np.newaxis]
+
+    repolarization_window = (samples >= max_point[:, np.newaxis]) & (samples < max_point[:, np.newaxis] + window)
+    repolarization_slope = _masked_slope(timestamps[np.newaxis, :], inverted, repolarization_window) * 1e-6
+
+    recovery_idx = np.argmax(np.where(samples >= max_point[:, np.newaxis], inverted, -np.inf), 1)
+    recovery_window = (samples >= recovery_idx[:, np.newaxis]) & (samples < recovery_idx[:, np.newaxis] + window)
+    recovery_slope = _masked_slope(timestamps[np.newaxis, :], inverted, recovery_window) * 1e-6
+
+    return {'duration': duration,
+            'halfwidth': halfwidth,
+            'PT_ratio': PT_ratio,
+            'repolarization_slope': repolarization_slope,
+            'recovery_slope': recovery_slope}
+
+
+def calculate_2D_features_batch(waveforms, timestamps, peak_channels, site_x, site_y, spread_threshold = 0.12, site_range=16):
+
+    """
+    Features of many 2D waveforms, as calculate_2D_features
+
+    Inputs:
+    ------
+    waveforms : numpy.ndarray (num_units x N channels x M samples)
+    timestamps : numpy.ndarray (M samples)
+    peak_channels : numpy.ndarray (num_units x 0)
+    site_x, site_y : numpy.ndarray (N channels)
+    spread_threshold : float
+    site_range: int
+
+    Outputs:
+    --------
+    features : dict of numpy.ndarray (num_units x 0)
+        amplitude (uV), spread (um), velocity_above and velocity_below (s / m)
+
+    """
+
+    assert site_range % 2 == 0 # must be even
+
+    num_units, num_channels, num_samples = waveforms.shape
+    rows = np.arange(num_units)[:, np.newaxis]
+
+    x_peak = site_x[peak_channels][:, np.newaxis]
+    y_peak = site_y[peak_channels][:, np.newaxis]
+
+    dist = np.sqrt(( pow((site_x[np.newaxis, :] - x_peak),2) + pow((site_y[np.newaxis, :] - y_peak),2)))
+    ydiff = site_y[np.newaxis, :] != y_peak
+    channel_amplitude = np.max(waveforms, 2) - np.min(waveforms, 2)
+
+    # nearest neighbour at a different y, as found by the loop in
+    # calculate_2D_features: a site is taken if it is no further than all the
+    # earlier sites at a different y (and 1e6 um), and the x of the last site
+    # taken with a nonzero amplitude is kept
+    nearest = np.minimum.accumulate(np.where(ydiff, dist, 1e6), 1)
+    nearest = np.concatenate((np.full((num_units, 1), 1e6), nearest[:, :-1]), 1)
+
+    taken = ydiff & (dist <= nearest) & (channel_amplitude > 0)
+    last_taken = num_channels - 1 - np.argmax(taken[:, ::-1], 1)
+    x_nn = np.where(np.any(taken, 1), site_x[last_taken], -1)[:, np.newaxis]
+
+    # the first site_range sites in the two columns, in order of distance
+    inCol = (site_x[np.newaxis, :] == x_peak) | (site_x[np.newaxis, :] == x_nn)
+    sort_dist_ind = np.argsort(dist, 1)
+    inCol_sorted = np.take_along_axis(inCol, sort_dist_ind, 1)
+
+    first_in_col = np.argsort(~inCol_sorted, 1, kind='stable')[:, :site_range]
+    found = np.take_along_axis(inCol_sorted, first_in_col, 1)
+    sites_to_sample = np.take_along_axis(sort_dist_ind, first_in_col, 1)
+
+    wv = waveforms[rows, sites_to_sample, :]
+
+    trough_idx = np.argmin(wv, 2)
+    overall_amplitude = np.max(wv, 2) - np.min(wv, 2)
+
+    amplitude = np.max(np.where(found, overall_amplitude, -np.inf), 1)
+    max_chan = np.argmax(np.where(found, overall_amplitude, -np.inf), 1)
+
+    above_thresh = found & (overall_amplitude > (amplitude * spread_threshold)[:, np.newaxis])
+
+    # outliers are removed if there are at least two points (see isnot_outlier)
+    points = np.where(above_thresh, np.arange(sites_to_sample.shape[1])[np.newaxis, :], np.nan)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        diff = np.abs(points - np.nanmedian(points, 1)[:, np.newaxis])
+        modified_z_score = 0.6745 * diff / np.nanmedian(diff, 1)[:, np.newaxis]
+
+    points_above_thresh = above_thresh & ((modified_z_score <= 1.5) | (np.sum(above_thresh, 1) <= 1)[:, np.newaxis])
+
+    yDist = site_y[sites_to_sample] - y_peak
+
+    spread = np.where(np.any(points_above_thresh, 1),
+                      np.max(np.where(points_above_thresh, yDist, -np.inf), 1) -
+                      np.min(np.where(points_above_thresh, yDist, np.inf), 1),
+                      0)
+
+    trough_times = timestamps[trough_idx] - timestamps[trough_idx[rows[:, 0], max_chan]][:, np.newaxis]
+
+    velocity_above = _velocity(yDist, trough_times, points_above_thresh & (yDist >= 0))
+    velocity_below = _velocity(yDist, trough_times, points_above_thresh & (yDist <= 0))
+
+    return {'amplitude': amplitude,
+            'spread': spread,
+            'velocity_above': velocity_above,
+            'velocity_below': velocity_below}
+
+
+def _velocity(yDist, times, mask):
+
+    # as get_velocity, for the sites in mask on one side of the soma
+
+    spread = np.max(np.where(mask, yDist, -np.inf), 1) - np.min(np.where(mask, yDist, np.inf), 1)
+
+    has_spread = (np.sum(mask, 1) > 1) & (spread > 0)
+
+    return np.where(has_spread, _masked_slope(yDist, times, mask) * 1e6, np.nan)
+
+
+def _masked_slope(x, y, mask):
+
+    # least-squares slope of y against x for each row, over the points in mask
+
+    x = np.broadcast_to(x, y.shape)
+    count = np.sum(mask, 1)[:, np.newaxis]
+
+    dx = np.where(mask, x - np.sum(np.where(mask, x, 0), 1)[:, np.newaxis] / count, 0)
+    dy = np.where(mask, y - np.sum(np.where(mask, y, 0), 1)[:, np.newaxis] / count, 0)
+
+    return np.sum(dx * dy, 1) / np.sum(dx * dx, 1)
+
+
 # ==========================================================
 
 # HELPER FUNCTIONS:
@@ -6,7 +6,8 @@ import numpy as np
 
 from ecephys_spike_sorting.modules.utils import ObjectEncoder
 
-from ...common.utils import load_kilosort_data, write_cluster_group_tsv
+from ...common.dataset_context import kilosort_dataset
+from ...common.utils import write_cluster_group_tsv
 from ._schemas import NoiseTemplateSchema
 from .id_noise_templates import id_noise_templates, id_noise_templates_rf
 
@@ -17,36 +18,28 @@ def classify_noise_templates(args):
 
     start = time.time()
 
-    (
-        spike_times,
-        spike_clusters,
-        spike_templates,
-        amplitudes,
-        templates,
-        channel_map,
-        channel_pos,
-        cluster_ids,
-        cluster_quality,
-        cluster_amplitude,
-    ) = load_kilosort_data(
+    # only the templates (and, for the random forest, the spikes) are used
+    dataset = kilosort_dataset(
         args["directories"]["kilosort_output_directory"],
         args["ephys_params"]["sample_rate"],
-        convert_to_seconds=True,
     )
 
     if args["noise_waveform_params"]["use_random_forest"]:
         # use random forest classifier
         cluster_ids, is_noise = id_noise_templates_rf(
-            spike_times,
-            spike_clusters,
-            cluster_ids,
-            templates,
+            dataset.spike_times_seconds,
+            dataset.spike_clusters,
+            dataset.cluster_ids,
+            dataset.unwhitened_templates,
             args["noise_waveform_params"],
         )
     else:
         # use heuristics to identify templates that look like noise
         cluster_ids, is_noise = id_noise_templates(
-            cluster_ids, templates, channel_pos, args["noise_waveform_params"]
+            dataset.cluster_ids,
+            dataset.unwhitened_templates,
+            dataset.channel_pos,
+            args["noise_waveform_params"],
         )
 
     mapping = {False: "good", True: "noise"}
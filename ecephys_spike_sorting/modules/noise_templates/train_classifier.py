@@ -5,6 +5,8 @@ import pandas as pd
 
 import matplotlib.pyplot as plt
 
+from ecephys_spike_sorting.common.utils import load_unwhitened_templates
+
 base_directory = '/mnt/md0/data'
 
 mice = ['392810', '405755', '448504', '407972', '444384']
@@ -40,15 +42,10 @@ for mouse in mice:
         
         subfolder = glob.glob(os.path.join(folder, 'continuous', 'Neuropix-*-100.0'))[0]
         
-        templates_raw = load(subfolder,'templates.npy')
-        unwhitening_mat = load(subfolder,'whitening_mat_inv.npy')
         cluster_ids, cluster_quality = read_template_ratings_file(os.path.join(subfolder, 'template_ratings_new.csv'))
         
-        templates = np.zeros(templates_raw.shape)
-        
-        for temp_idx in range(templates.shape[0]):
-            
-            templates[temp_idx,:,:] = np.dot(np.ascontiguousarray(templates_raw[temp_idx,:,:]),np.ascontiguousarray(unwhitening_mat))
+        # cached next to templates.npy by the sorting modules
+        templates = load_unwhitened_templates(subfolder)
             
         peak_channels = np.argmin(np.min(templates,1),1)
         
@@ -5,16 +5,27 @@ import sys
 import time
 
 import numpy as np
-import pandas as pd
 
 from ecephys_spike_sorting.modules.utils import ObjectEncoder
 
-from ...common.utils import getFileVersion, load_kilosort_data
+from ...common.dataset_context import kilosort_dataset
+from ...common.instrumentation import span, trace_module
+from ...common.metrics_io import (
+    find_metrics_file,
+    merge_metrics,
+    metrics_path,
+    read_metrics,
+    versioned_path,
+    write_metrics,
+)
+from ...common.utils import getFileVersion
 from ._schemas import QualityMetricsSchema
+from .fingerprint import fingerprint_file, load_fingerprint, save_fingerprint
 from .ibl_metrics import calculate_ibl_metrics
-from .metrics import calculate_metrics
+from .metrics import calculate_metrics, calculate_windowed_metrics
 
 
+@trace_module("quality_metrics")
 def calculate_quality_metrics(args):
 
     print("ecephys spike sorting: quality metrics module")
@@ -25,77 +36,89 @@ def calculate_quality_metrics(args):
 
     # make usre we can write an output file
 
-    output_file_args = args["cluster_metrics"]["cluster_metrics_file"]
+    metrics_format = args["cluster_metrics"]["metrics_format"]
+    output_file_args = metrics_path(
+        args["cluster_metrics"]["cluster_metrics_file"], metrics_format
+    )
 
     output_file, metrics_version = getFileVersion(output_file_args)
 
+    previous_metrics = None
+    previous_fingerprint = None
+
+    if include_pcs and args["quality_metrics_params"]["incremental"]:
+        previous_metrics, previous_fingerprint = load_previous_metrics(
+            output_file_args, metrics_version
+        )
+
     print("kilosort_output_dir: ")
     print(args["directories"]["kilosort_output_directory"])
     print("Loading data...")
 
     try:
-        if include_pcs:
-            (
+        # the metrics only need the spikes (and PCs); templates are not loaded
+        dataset = kilosort_dataset(
+            args["directories"]["kilosort_output_directory"],
+            args["ephys_params"]["sample_rate"],
+            use_master_clock=False,
+            mmap_mode=args["quality_metrics_params"]["mmap_mode"],
+        )
+
+        with span("load_kilosort_data"):
+            spike_times = dataset.spike_times_seconds
+            spike_clusters = dataset.spike_clusters
+            spike_templates = dataset.spike_templates
+            amplitudes = dataset.amplitudes
+            channel_map = dataset.channel_map
+            channel_pos = dataset.channel_pos
+
+            if include_pcs:
+                pc_features = dataset.pc_features
+                pc_feature_ind = dataset.pc_feature_ind
+            else:
+                pc_features = []
+                pc_feature_ind = []
+
+        with span("calculate_metrics"):
+            metrics, fingerprint = calculate_metrics(
                 spike_times,
                 spike_clusters,
                 spike_templates,
                 amplitudes,
-                templates,
                 channel_map,
                 channel_pos,
-                clusterIDs,
-                cluster_quality,
-                cluster_amplitude,
+                None,  # templates are not used by calculate_metrics
                 pc_features,
                 pc_feature_ind,
-                template_features,
-            ) = load_kilosort_data(
-                args["directories"]["kilosort_output_directory"],
-                args["ephys_params"]["sample_rate"],
-                use_master_clock=False,
-                include_pcs=include_pcs,
-            )
-        else:
-            (
-                spike_times,
-                spike_clusters,
-                spike_templates,
-                amplitudes,
-                templates,
-                channel_map,
-                channel_pos,
-                clusterIDs,
-                cluster_quality,
-                cluster_amplitude,
-            ) = load_kilosort_data(
-                args["directories"]["kilosort_output_directory"],
-                args["ephys_params"]["sample_rate"],
-                use_master_clock=False,
-                include_pcs=include_pcs,
-            )
-            pc_features = []
-            pc_feature_ind = []
-
-        metrics = calculate_metrics(
-            spike_times,
-            spike_clusters,
-            spike_templates,
-            amplitudes,
-            channel_map,
-            channel_pos,
-            templates,
-            pc_features,
-            pc_feature_ind,
-            args["quality_metrics_params"],
-        )
-        if args["quality_metrics_params"]["include_ibl"]:
-            ibl_metrics = calculate_ibl_metrics(
-                spike_times,
-                spike_clusters,
-                amplitudes,
                 args["quality_metrics_params"],
-                args["ephys_params"]["sample_rate"],
+                previous_metrics=previous_metrics,
+                previous_fingerprint=previous_fingerprint,
+                return_fingerprint=True,
             )
+        if args["quality_metrics_params"]["include_ibl"]:
+            with span("calculate_ibl_metrics"):
+                ibl_metrics = calculate_ibl_metrics(
+                    spike_times,
+                    spike_clusters,
+                    amplitudes,
+                    args["quality_metrics_params"],
+                    args["ephys_params"]["sample_rate"],
+                )
+
+        window_length = args["quality_metrics_params"]["sliding_window_s"]
+        if window_length is not None:
+            with span("calculate_windowed_metrics"):
+                print("Calculating metrics in sliding windows")
+                window_step = args["quality_metrics_params"]["sliding_window_step_s"]
+                windowed_metrics = calculate_windowed_metrics(
+                    spike_times,
+                    spike_clusters,
+                    np.max(spike_clusters) + 1,
+                    args["quality_metrics_params"],
+                    window_length,
+                    window_length if window_step is None else window_step,
+                    amplitudes=amplitudes,
+                )
 
     except FileNotFoundError:
 
@@ -107,30 +130,43 @@ def calculate_quality_metrics(args):
 
     if args["quality_metrics_params"]["include_ibl"]:
         # merge allen and ibl metrics
-        metrics = metrics.merge(
-            ibl_metrics, on="cluster_id", suffixes=("_quality_metrics", "_ibl")
+        metrics = merge_metrics(
+            metrics, ibl_metrics, suffixes=("_quality_metrics", "_ibl")
         )
 
-    # build name for waveform_metrics file with matched version
-    wm_args = args["waveform_metrics"]["waveform_metrics_file"]
-    if metrics_version == 0:
-        wm = wm_args
-    else:
-        # buld name for waveform metrics file with matched version
-        wm = os.path.join(
-            pathlib.Path(wm_args).parent,
-            pathlib.Path(wm_args).stem + "_" + repr(metrics_version) + ".csv",
-        )
-    if os.path.exists(wm):
-        metrics = metrics.merge(
-            pd.read_csv(wm, index_col=0),
-            on="cluster_id",
+    # find the waveform_metrics file with matched version, in any format
+    wm = find_metrics_file(
+        versioned_path(
+            args["waveform_metrics"]["waveform_metrics_file"], metrics_version
+        ),
+        args["waveform_metrics"]["metrics_format"],
+    )
+    if wm is not None:
+        metrics = merge_metrics(
+            metrics,
+            read_metrics(wm),
             suffixes=("_quality_metrics", "_waveform_metrics"),
         )
 
-    print("Saving data...")
+    with span("save_metrics"):
+        print("Saving data...")
 
-    metrics.to_csv(output_file, index=False)
+        write_metrics(metrics, output_file, metrics_format)
+
+        if fingerprint is not None:
+            save_fingerprint(fingerprint_file(output_file), fingerprint)
+
+        if window_length is not None:
+            windowed_output_file = write_metrics(
+                windowed_metrics,
+                os.path.join(
+                    pathlib.Path(output_file).parent,
+                    pathlib.Path(output_file).stem + "_windowed.csv",
+                ),
+                metrics_format,
+            )
+        else:
+            windowed_output_file = None
 
     execution_time = time.time() - start
 
@@ -140,9 +176,35 @@ def calculate_quality_metrics(args):
     return {
         "execution_time": execution_time,
         "quality_metrics_output_file": output_file,
+        "windowed_metrics_output_file": windowed_output_file,
     }  # output manifest
 
 
+def load_previous_metrics(output_file_args, metrics_version):
+    """Metrics and fingerprint of the latest earlier run, if both exist"""
+
+    # with overwrite, version 0 replaces the file from the previous run
+    previous_file = versioned_path(output_file_args, max(metrics_version - 1, 0))
+
+    if not (
+        os.path.exists(previous_file)
+        and os.path.exists(fingerprint_file(previous_file))
+    ):
+        print("No previous metrics with fingerprint; calculating all units")
+        return None, None
+
+    print("Updating metrics from " + previous_file)
+
+    previous_metrics = read_metrics(previous_file)
+    if "epoch_name" not in previous_metrics.columns:
+        # merged with waveform metrics, which also have an epoch_name
+        previous_metrics = previous_metrics.rename(
+            columns={"epoch_name_quality_metrics": "epoch_name"}
+        )
+
+    return previous_metrics, load_fingerprint(fingerprint_file(previous_file))
+
+
 def main():
     """Main entry point:"""
     input_json_index = sys.argv.index("--input_json") + 1
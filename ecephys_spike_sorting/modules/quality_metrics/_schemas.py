@@ -1,10 +1,11 @@
 from marshmallow import INCLUDE, Schema
-from marshmallow.fields import Boolean, Float, Int, Nested, String
+from marshmallow.fields import Boolean, Dict, Float, Int, Nested, String
 
 from ...common.schemas import (
     ClusterMetricsFile,
     Directories,
     EphysParams,
+    InstrumentationParams,
     WaveformMetricsFile,
 )
 
@@ -46,6 +47,48 @@ class QualityMetricsParams(Schema):
         missing=4,
         help="Number of neighbors to use for NearestNeighbor calculation",
     )
+    mmap_mode = String(
+        required=False,
+        allow_none=True,
+        missing=None,
+        help="Set to 'r' to memory-map pc_features.npy and template_features.npy rather than loading them into memory",
+    )
+    n_jobs = Int(
+        required=False,
+        missing=1,
+        help="Number of worker processes for computing PC metrics",
+    )
+    random_seed = Int(
+        required=False,
+        allow_none=True,
+        missing=None,
+        help="Seed for subsampling spikes in PC metrics; results do not depend on n_jobs when set",
+    )
+    batch_pc_neighborhoods = Boolean(
+        required=False,
+        missing=False,
+        help="Calculate PC metrics together for units that share a peak channel and need no subsampling",
+    )
+    mahalanobis_float32 = Boolean(
+        required=False,
+        missing=False,
+        help="Calculate isolation distance and L-ratio in single precision",
+    )
+    nn_cache_size = Int(
+        required=False,
+        missing=0,
+        help="Number of channel neighborhoods whose KD-tree is kept for reuse; 0 searches separately for every unit",
+    )
+    nn_approx_eps = Float(
+        required=False,
+        missing=0,
+        help="With nn_cache_size > 0, approximate nearest neighbors to within a factor (1 + nn_approx_eps) of the true distance",
+    )
+    incremental = Boolean(
+        required=False,
+        missing=False,
+        help="Recalculate PC-based metrics only for clusters that changed since the previous run (e.g. after phy curation), and their neighbors; other rows are copied from the previous metrics file",
+    )
     n_silhouette = Int(
         required=False,
         missing=10000,
@@ -60,6 +103,18 @@ class QualityMetricsParams(Schema):
         missing=100,
         help="Interval length is seconds for computing spike depth",
     )
+    sliding_window_s = Float(
+        required=False,
+        allow_none=True,
+        missing=None,
+        help="If set, also calculate spike-train metrics in sliding windows of this length in seconds",
+    )
+    sliding_window_step_s = Float(
+        required=False,
+        allow_none=True,
+        missing=None,
+        help="Time between sliding window starts in seconds; defaults to sliding_window_s",
+    )
     include_pcs = Boolean(
         required=False,
         missing=True,
@@ -81,6 +136,7 @@ class InputParameters(Schema):
     directories = Nested(Directories)
     waveform_metrics = Nested(WaveformMetricsFile)
     cluster_metrics = Nested(ClusterMetricsFile)
+    instrumentation_params = Nested(InstrumentationParams, required=False)
 
 
 class OutputSchema(Schema):
@@ -99,7 +155,9 @@ class OutputParameters(OutputSchema):
         unknown = INCLUDE
 
     execution_time = Float()
+    spans = Dict(required=False, help="Tree of timing and memory spans of the run")
     quality_metrics_output_file = String()
+    windowed_metrics_output_file = String(allow_none=True)
 
 
 class QualityMetricsSchema(Schema):
@@ -0,0 +1,127 @@
+import numpy as np
+
+from ...common.utils import SPIKE_CHUNK_SIZE
+
+
+def grouped_histograms(sorted_values, starts, ends, num_bins, from_zero=False, chunk_size=10*SPIKE_CHUNK_SIZE):
+
+    """ Histograms of many groups of values, built with one bincount
+
+    Each group is a range of sorted_values, e.g. the amplitudes of one unit in
+    an array put in cluster order by ClusterIndex.sort, or of one unit in one
+    window. Groups may overlap. The bins of each group are those np.histogram
+    would use:
+
+    - from_zero = False: np.histogram(values, num_bins), equal bins from the
+      minimum to the maximum of the group
+    - from_zero = True: np.histogram(values, np.linspace(0, max(values),
+      num_bins + 1)), values below 0 are not counted
+
+    Bin indices are computed as in np.histogram (including its correction of
+    values within rounding error of an edge), for all groups at once, in
+    chunks of chunk_size values. Values are binned in double precision.
+
+    Inputs:
+    -------
+    sorted_values : numpy.ndarray (num_values x 0)
+        Values of all groups
+    starts, ends : numpy.ndarray (num_groups x 0)
+        Range of sorted_values (start inclusive, end exclusive) in each group
+    num_bins : Int
+        Number of bins per group
+    from_zero : Bool (optional)
+        If True, bins span 0 to the maximum of each group
+
+    Outputs:
+    --------
+    counts : numpy.ndarray (num_groups x num_bins)
+        Zero for empty groups
+    edges : numpy.ndarray (num_groups x num_bins + 1)
+        Bin edges of each group; NaN for empty groups
+
+    """
+
+    sorted_values = np.asarray(sorted_values, dtype='float64').ravel()
+    starts = np.asarray(starts, dtype='int64')
+    ends = np.asarray(ends, dtype='int64')
+
+    counts = np.zeros((starts.size, num_bins), dtype='int64')
+    edges = np.full((starts.size, num_bins + 1), np.nan)
+
+    groups = np.flatnonzero(ends > starts)
+
+    if groups.size == 0:
+        return counts, edges
+
+    starts = starts[groups]
+    ends = ends[groups]
+
+    # outer edges, as in np.histogram
+    last_edge = _range_reduce(np.maximum, sorted_values, starts, ends)
+
+    if from_zero:
+        first_edge = np.zeros(last_edge.shape)
+    else:
+        first_edge = _range_reduce(np.minimum, sorted_values, starts, ends)
+        single_value = first_edge == last_edge
+        first_edge[single_value] -= 0.5
+        last_edge[single_value] += 0.5
+
+    # np.linspace(first_edge, last_edge, num_bins + 1) for every group
+    step = (last_edge - first_edge) / num_bins
+    group_edges = np.arange(num_bins + 1)[np.newaxis, :] * step[:, np.newaxis] + first_edge[:, np.newaxis]
+    group_edges[:, -1] = last_edge
+    edges[groups] = group_edges
+
+    # groups whose bins do not increase are left to np.histogram
+    increasing = last_edge > first_edge
+
+    lengths = np.where(increasing, ends - starts, 0)
+    cum_lengths = np.cumsum(lengths)
+    group_counts = np.zeros((groups.size * num_bins,), dtype='int64')
+
+    for chunk_start in range(0, cum_lengths[-1], chunk_size):
+
+        positions = np.arange(chunk_start, min(chunk_start + chunk_size, cum_lengths[-1]))
+        group_idx = np.searchsorted(cum_lengths, positions, side='right')
+        values = sorted_values[positions - cum_lengths[group_idx] + ends[group_idx]]
+
+        if from_zero:
+            keep = values >= 0
+            values = values[keep]
+            group_idx = group_idx[keep]
+
+        first = first_edge[group_idx]
+
+        indices = (((values - first) / (last_edge[group_idx] - first)) * num_bins).astype(np.intp)
+        indices[indices == num_bins] -= 1
+
+        # the index computation is not guaranteed to give exactly consistent
+        # results within ~1 ULP of the bin edges
+        indices[values < group_edges[group_idx, indices]] -= 1
+        # the last bin includes the right edge, the other bins do not
+        indices[(values >= group_edges[group_idx, indices + 1]) & (indices != num_bins - 1)] += 1
+
+        group_counts += np.bincount(group_idx * num_bins + indices, minlength=group_counts.size)
+
+    counts[groups] = np.reshape(group_counts, (groups.size, num_bins))
+
+    for idx in np.flatnonzero(~increasing):
+        counts[groups[idx]] = np.histogram(sorted_values[starts[idx]:ends[idx]], group_edges[idx])[0]
+
+    return counts, edges
+
+
+def _range_reduce(ufunc, values, starts, ends):
+
+    # ufunc.reduce over values[start:end] for each (non-empty) range
+
+    at_end = ends == values.size
+    bounds = np.stack((starts, np.where(at_end, values.size - 1, ends)), 1).ravel()
+
+    # reduceat reduces each range up to the next index; with end clipped to
+    # the last value, add that value back in
+    reduced = ufunc.reduceat(values, bounds)[::2]
+    reduced[at_end] = ufunc(reduced[at_end], values[-1])
+
+    return reduced
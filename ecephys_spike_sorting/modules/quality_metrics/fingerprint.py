@@ -0,0 +1,175 @@
+import json
+import os
+import pathlib
+
+import numpy as np
+
+from ...common.cluster_index import ClusterIndex
+from ...common.utils import SPIKE_CHUNK_SIZE
+
+# parameters that change the PC-based metrics; rows can only be copied
+# forward from a run that used the same values
+PC_METRICS_PARAMS = ('max_radius_um',
+                     'max_spikes_for_unit',
+                     'max_spikes_for_nn',
+                     'n_neighbors',
+                     'random_seed',
+                     'mahalanobis_float32',
+                     'batch_pc_neighborhoods',
+                     'nn_cache_size',
+                     'nn_approx_eps')
+
+
+def cluster_fingerprints(spike_clusters, total_units, cluster_index=None, chunk_size=SPIKE_CHUNK_SIZE):
+
+    """ Fingerprint of the set of spikes assigned to each cluster
+
+    Each spike index is mixed into a 64-bit hash (splitmix64) and the hashes
+    are summed (modulo 2**64) per cluster. The sum does not depend on the order
+    of the spikes, so two runs give the same fingerprint for a cluster exactly
+    when it holds the same spikes (up to a 2**-64 chance of collision). The
+    sums are taken from a running total over the cluster-sorted spikes, in
+    chunks, so no per-spike hash array is kept.
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    total_units : Int
+        Number of cluster IDs
+    cluster_index : ClusterIndex (optional)
+        Index of spike_clusters, if already built
+
+    Outputs:
+    --------
+    fingerprints : numpy.ndarray (total_units x 0), uint64
+    counts : numpy.ndarray (total_units x 0)
+        Number of spikes in each cluster
+
+    """
+
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
+
+    offsets = cluster_index.offsets
+    num_spikes = cluster_index.num_spikes
+
+    # running hash total at each cluster boundary of the sorted spikes
+    totals = np.zeros(offsets.shape, dtype='uint64')
+    carry = np.uint64(0)
+
+    for start in range(0, num_spikes, chunk_size):
+
+        stop = min(start + chunk_size, num_spikes)
+
+        running = np.cumsum(_spike_hash(cluster_index.order[start:stop]), dtype='uint64')
+        running += carry
+
+        ends = (offsets > start) & (offsets <= stop)
+        totals[ends] = running[offsets[ends] - start - 1]
+
+        carry = running[-1]
+
+    return totals[1:] - totals[:-1], cluster_index.counts.astype('int64')
+
+
+def _spike_hash(spike_indices):
+
+    # splitmix64 finalizer; integer arrays wrap around on overflow
+    z = spike_indices.astype('uint64') + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+
+    return z ^ (z >> np.uint64(31))
+
+
+def find_changed_clusters(previous_fingerprint, fingerprints, counts):
+
+    """ Clusters whose spikes differ from those in a previous fingerprint
+
+    Inputs:
+    -------
+    previous_fingerprint : dict
+        As returned by load_fingerprint
+    fingerprints, counts : numpy.ndarray
+        Outputs of cluster_fingerprints for the current spike_clusters
+
+    Outputs:
+    --------
+    changed : numpy.ndarray (max(total_units, previous total_units) x 0), bool
+        True for new, removed and modified clusters
+
+    """
+
+    total_units = max(fingerprints.size, previous_fingerprint['fingerprints'].size)
+
+    old_fingerprints, old_counts = _pad(previous_fingerprint['fingerprints'], total_units, 0), \
+                                   _pad(previous_fingerprint['counts'], total_units, 0)
+    new_fingerprints, new_counts = _pad(fingerprints, total_units, 0), _pad(counts, total_units, 0)
+
+    return (old_fingerprints != new_fingerprints) | (old_counts != new_counts)
+
+
+def previous_epoch_units(previous_fingerprint, epoch_name, total_units):
+
+    """ Template and peak channel of each unit in one epoch of a previous run
+
+    Outputs:
+    --------
+    template_ids, peak_channels : numpy.ndarray (total_units x 0) or None
+        -1 for units without spikes in the epoch; None if the previous run
+        did not have this epoch
+
+    """
+
+    epoch_names = list(previous_fingerprint['epoch_names'])
+
+    if epoch_name not in epoch_names:
+        return None, None
+
+    epoch_idx = epoch_names.index(epoch_name)
+
+    return _pad(previous_fingerprint['template_ids'][epoch_idx], total_units, -1), \
+           _pad(previous_fingerprint['peak_channels'][epoch_idx], total_units, -1)
+
+
+def _pad(values, size, fill):
+
+    padded = np.full((size,), fill, dtype=values.dtype)
+    padded[:min(size, values.size)] = values[:size]
+
+    return padded
+
+
+def pc_params_signature(params):
+
+    """ The parameters that PC-based metrics depend on, as a JSON string """
+
+    return json.dumps({name: params.get(name) for name in PC_METRICS_PARAMS}, sort_keys=True)
+
+
+def is_compatible(previous_fingerprint, num_spikes, params):
+
+    """ True if rows of a previous run can be reused for this spike set and params """
+
+    return int(previous_fingerprint['num_spikes']) == num_spikes and \
+        str(previous_fingerprint['params']) == pc_params_signature(params)
+
+
+def fingerprint_file(metrics_file):
+
+    """ Name of the fingerprint file saved next to a metrics file """
+
+    return os.path.join(pathlib.Path(metrics_file).parent,
+                        pathlib.Path(metrics_file).stem + '_fingerprint.npz')
+
+
+def save_fingerprint(filename, fingerprint):
+
+    np.savez(filename, **fingerprint)
+
+
+def load_fingerprint(filename):
+
+    with np.load(filename) as data:
+        return {key: data[key] for key in data.files}
@@ -5,8 +5,9 @@ from collections import OrderedDict
 
 from phylib.stats import correlograms
 
+from ...common.cluster_index import ClusterIndex
 from ...common.epoch import Epoch
-from ...common.utils import printProgressBar
+from .amplitude_histograms import grouped_histograms
 
 def calculate_ibl_metrics(spike_times, spike_clusters, amplitudes, params, sample_rate, epochs = None):
 
@@ -81,34 +82,128 @@ def calculate_ibl_metrics(spike_times, spike_clusters, amplitudes, params, sampl
 
 
 
-def calculate_slidingRP(spike_times, spike_clusters, total_units, sample_rate):
+def calculate_slidingRP(spike_times, spike_clusters, total_units, sample_rate, bin_size=0.25, thresh=0.1, acceptThresh=0.1):
 
-    cluster_ids = np.unique(spike_clusters)
+    """ slidingRP_viol for all units at once
+
+    slidingRP_viol needs two things from each unit's autocorrelogram: the 
+    cumulative count at the testing bins (up to 10 ms), and the total count 
+    between lags of 0.5 and 1 s, from which the firing rate is estimated. 
+    Instead of a 1 s correlogram per unit, the spikes of all units are sorted 
+    once by (unit, sample). The autocorrelograms of all units up to 10 ms are
+    then built in one pass, and the 0.5 - 1 s count is the difference of two 
+    numbers of spike pairs closer than a given lag, each found with one 
+    searchsorted over all spikes. The binning in samples is the same as in 
+    phylib.stats.correlograms, and the maximum acceptable contamination is 
+    evaluated for all units and testing bins in one call (_max_acceptable_cont).
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    total_units : Int
+        Total number of units
+    sample_rate : Float
+        Sample rate used for the correlogram bins
+
+    Outputs:
+    --------
+    SRP_pass : numpy.ndarray (total_units x 0)
+        1 if the unit passed, 0 if it did not (or has no spikes)
+
+    """
 
     SRP_pass = np.zeros((total_units,))
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    spike_times = np.asarray(np.squeeze(spike_times), dtype=np.float64)
+    spike_clusters = np.squeeze(spike_clusters).astype('int64')
 
-        printProgressBar(idx+1, len(cluster_ids))
+    if spike_times.size == 0:
+        return SRP_pass
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        SRP_pass[cluster_id] = slidingRP_viol(ts = spike_times[for_this_cluster], sample_rate = sample_rate) 
+    bTestIdx, bTest = _sliding_rp_test_bins(bin_size)
 
-    return SRP_pass
+    # bins of phylib.stats.correlograms with window_size = 2 s
+    bin_size_s = np.clip(bin_size / 1000, 1e-5, 1e5)
+    binsize = int(sample_rate * bin_size_s)  # in samples
+    num_bins_2s = int(.5 * np.clip(2, 1e-5, 1e5) / bin_size_s) + 1
+    num_bins_1s = int(num_bins_2s / 2)
 
+    spike_samples = (spike_times * sample_rate).astype(np.int64)
 
-def calculate_noise_cutoff(spike_amps, spike_clusters, total_units):
+    # sort by unit, then time; offsetting each unit's samples by more than the
+    # longest lag keeps every search inside one unit
+    order = np.lexsort((spike_samples, spike_clusters))
+    sorted_clusters = spike_clusters[order]
+    sorted_samples = spike_samples[order] - np.min(spike_samples)
+    unit_span = np.max(sorted_samples) + num_bins_2s * binsize + 1
+    keys = sorted_clusters * unit_span + sorted_samples
 
-    cluster_ids = np.unique(spike_clusters)
+    # autocorrelograms of all units up to the last testing bin: compare each
+    # spike with the next one, the one after... of the same unit (as in 
+    # correlograms) until no spike has a partner within the window
+    num_short_bins = np.max(bTestIdx) + 1
+    acg = np.zeros((total_units * num_short_bins,), dtype='int64')
 
-    nc_pass = np.zeros((total_units,))
+    active = np.arange(keys.size - 1)
+    shift = 1
+
+    while active.size > 0:
+        spike_diff_b = (keys[active + shift] - keys[active]) // binsize
+        in_window = spike_diff_b < num_short_bins
+        active = active[in_window]
+        acg += np.bincount(sorted_clusters[active] * num_short_bins + spike_diff_b[in_window], minlength=acg.size)
+        shift += 1
+        active = active[active + shift < keys.size]
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    # cumulative autocorrelogram at each testing bin
+    res = np.cumsum(np.reshape(acg, (total_units, num_short_bins)), 1)[:, bTestIdx]
 
-        printProgressBar(idx+1, len(cluster_ids))
+    # firing rate from the autocorrelogram between 0.5 and 1 s: number of 
+    # spike pairs in that range of lags, counted with two searches
+    later_spikes = np.arange(1, keys.size + 1)
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        nc_pass[cluster_id] = noise_cutoff(amps = spike_amps[for_this_cluster])[0] 
+    def pairs_closer_than(lag):
+        counts = np.searchsorted(keys, keys + lag, side='left') - later_spikes
+        return np.bincount(sorted_clusters, weights=counts, minlength=total_units)
+
+    late_counts = pairs_closer_than(num_bins_2s * binsize) - pairs_closer_than(num_bins_1s * binsize)
+
+    spike_counts = np.bincount(sorted_clusters, minlength=total_units)
+    cluster_ids = np.flatnonzero(spike_counts)
+    starts = np.concatenate(([0], np.cumsum(spike_counts[cluster_ids])[:-1]))
+
+    sorted_times = spike_times[order]
+    recDur = np.zeros((total_units,))
+    recDur[cluster_ids] = np.maximum.reduceat(sorted_times, starts) - np.minimum.reduceat(sorted_times, starts)
+
+    cluster_ids = cluster_ids[recDur[cluster_ids] > 0]  # only for units with samples
+    
+    fr = late_counts[cluster_ids] / spike_counts[cluster_ids] / bin_size * 1000 / num_bins_1s
+
+    # maximum allowed number of spikes per testing bin
+    m = _max_acceptable_cont(fr[:, np.newaxis], np.asarray(bTest)[np.newaxis, :], recDur[cluster_ids, np.newaxis], 
+                             fr[:, np.newaxis] * acceptThresh, thresh)
+
+    SRP_pass[cluster_ids] = np.any(np.less_equal(res[cluster_ids], m), 1)
+
+    return SRP_pass
+
+
+def calculate_noise_cutoff(spike_amps, spike_clusters, total_units, cluster_index=None):
+
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
+
+    cluster_ids = cluster_index.cluster_ids
+
+    nc_pass = np.zeros((total_units,))
+
+    nc_pass[cluster_ids] = noise_cutoff_batch(cluster_index.sort(spike_amps),
+                                              cluster_index.offsets[cluster_ids],
+                                              cluster_index.offsets[cluster_ids + 1])[0]
 
     return nc_pass
 
@@ -116,14 +211,31 @@ def _max_acceptable_cont(FR, RP, rec_duration, acceptableCont, thresh):
     """
     Function to compute the maximum acceptable refractory period contamination
         called during slidingRP_viol
+
+    Inputs may be arrays (broadcast together), so all testing bins of all 
+    units are evaluated with one call to the Poisson quantile function
     """
 
     time_for_viol = RP * 2 * FR * rec_duration
     expected_count_for_acceptable_limit = acceptableCont * time_for_viol
     max_acceptable = stats.poisson.ppf(thresh, expected_count_for_acceptable_limit)
-    if max_acceptable == 0 and stats.poisson.pmf(0, expected_count_for_acceptable_limit) > 0:
-        max_acceptable = -1
-    return max_acceptable
+    none_acceptable = (max_acceptable == 0) & (stats.poisson.pmf(0, expected_count_for_acceptable_limit) > 0)
+    return np.where(none_acceptable, -1, max_acceptable)
+
+
+def _sliding_rp_test_bins(bin_size):
+    """
+    Indices and upper edges (in seconds) of the autocorrelogram bins at which 
+        slidingRP_viol tests for contamination
+    """
+
+    b = np.arange(0, 10.25, bin_size) / 1000 + 1e-6  # bins in seconds
+    bTestIdx = [5, 6, 7, 8, 10, 12, 14, 16, 18, 20, 24, 28, 32, 36, 40]
+    # with binSize = 0.25, these correspond to refractory periods of 
+    # [1.25, 1.5, 1.75,2, 2.5, 3., 3.5, 4, 4.5, 5, 6, 7, 8, 9, 10]
+    bTest = [b[i] for i in bTestIdx]
+
+    return bTestIdx, bTest
 
 
 def slidingRP_viol(ts, bin_size=0.25, thresh=0.1, acceptThresh=0.1, sample_rate=30000):
@@ -175,11 +287,7 @@ def slidingRP_viol(ts, bin_size=0.25, thresh=0.1, acceptThresh=0.1, sample_rate=
                                                 acceptThresh=0.1)
     """
 
-    b = np.arange(0, 10.25, bin_size) / 1000 + 1e-6  # bins in seconds
-    bTestIdx = [5, 6, 7, 8, 10, 12, 14, 16, 18, 20, 24, 28, 32, 36, 40]
-    # with binSize = 0.25, these correspond to refractory periods of 
-    # [1.25, 1.5, 1.75,2, 2.5, 3., 3.5, 4, 4.5, 5, 6, 7, 8, 9, 10]
-    bTest = [b[i] for i in bTestIdx]
+    bTestIdx, bTest = _sliding_rp_test_bins(bin_size)
 
     if len(ts) > 0 and ts[-1] > ts[0]:  # only do this for units with samples
         recDur = (ts[-1] - ts[0])
@@ -202,9 +310,8 @@ def slidingRP_viol(ts, bin_size=0.25, thresh=0.1, acceptThresh=0.1, sample_rate=
         # compute fr based on the  mean of bin_count_normalized from 1 to 2 s
         # instead of as before (len(ts)/recDur) for a better estimate
         fr = np.sum(bin_count_normalized[num_bins_1s:num_bins_2s]) / num_bins_1s
-        mfunc = np.vectorize(_max_acceptable_cont)
         # compute the maximum allowed number of spikes per testing bin
-        m = mfunc(fr, bTest, recDur, fr * acceptThresh, thresh)
+        m = _max_acceptable_cont(fr, np.asarray(bTest), recDur, fr * acceptThresh, thresh)
         # did the unit pass (resulting number of spikes less than maximum
         # allowed spikes) at any of the testing bins?
         didpass = int(np.any(np.less_equal(res, m)))
@@ -252,13 +359,58 @@ def noise_cutoff(amps, quantile_length=.25, n_bins=100, nc_threshold=5, percent_
         >>> amps = spks_b['amps'][unit_idxs]
         >>> cutoff = bb.metrics.noise_cutoff(amps, quantile_length=.25, n_bins=100)
     """
+    if amps.size > 1:  # ensure there are amplitudes available to analyze
+        bins_list = np.linspace(0, np.max(amps), n_bins)  # list of bins to compute the amplitude histogram
+        n, bins = np.histogram(amps, bins=bins_list)  # construct amplitude histogram
+    else:
+        n = None
+
+    return _noise_cutoff_from_histogram(n, quantile_length, nc_threshold, percent_threshold)
+
+
+def noise_cutoff_batch(sorted_amps, starts, ends, quantile_length=.25, n_bins=100, nc_threshold=5, percent_threshold=0.10):
+    """
+    noise_cutoff for many groups of amplitudes at once
+
+    The amplitude histograms of all groups are built together 
+    (grouped_histograms, with the same bins as noise_cutoff), and the cutoff of
+    each group is found from its histogram.
+
+    Parameters
+    ----------
+    sorted_amps : ndarray_like
+        The amplitudes of all groups, e.g. in the cluster order of a ClusterIndex
+    starts, ends : ndarray_like
+        Range of sorted_amps in each group
+    Returns
+    -------
+    nc_pass, cutoff, first_low_quantile : ndarray
+        The outputs of noise_cutoff for each group
+    """
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
+
+    counts, edges = grouped_histograms(sorted_amps, starts, ends, n_bins - 1, from_zero=True)
+
+    results = [_noise_cutoff_from_histogram(n if end - start > 1 else None, quantile_length, nc_threshold, percent_threshold)
+               for n, start, end in zip(counts, starts, ends)]
+
+    nc_pass, cutoff, first_low_quantile = [np.array(values) for values in zip(*results)] if results else \
+        (np.zeros((0,), dtype=bool), np.zeros((0,)), np.zeros((0,)))
+
+    return nc_pass, cutoff, first_low_quantile
+
+
+def _noise_cutoff_from_histogram(n, quantile_length, nc_threshold, percent_threshold):
+    """
+    Noise cutoff from the amplitude histogram n computed in noise_cutoff (None
+        if there are too few amplitudes)
+    """
     cutoff = np.float64(np.nan)
     first_low_quantile = np.float64(np.nan)
     fail_criteria = np.ones(1).astype(bool)[0]
 
-    if amps.size > 1:  # ensure there are amplitudes available to analyze
-        bins_list = np.linspace(0, np.max(amps), n_bins)  # list of bins to compute the amplitude histogram
-        n, bins = np.histogram(amps, bins=bins_list)  # construct amplitude histogram
+    if n is not None:
         idx_peak = np.argmax(n)  # peak of amplitude distribution
         # don't count zeros #len(n) - idx_peak, compute the length of the top half of the distribution -- ignoring zero bins
         length_top_half = len(np.where(n[idx_peak:-1] > 0)[0])
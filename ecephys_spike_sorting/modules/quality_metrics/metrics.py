@@ -3,25 +3,42 @@ import pandas as pd
 import psutil
 from collections import OrderedDict
 
+import mmap
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 from sklearn.neighbors import NearestNeighbors
-from sklearn.metrics import silhouette_score
 
-from scipy.spatial.distance import cdist
+from scipy.linalg import solve_triangular
 from scipy.stats import chi2
 from scipy.ndimage.filters import gaussian_filter1d
 from scipy import special
 
-from ...common.epoch import Epoch
-from ...common.utils import printProgressBar, get_spike_depths
+from ...common.cluster_index import ClusterIndex
+from ...common.epoch import Epoch, get_sliding_windows
+from ...common.instrumentation import span
+from ...common.utils import printProgressBar, get_spike_depths_from_pcs, select_spikes
+from .amplitude_histograms import grouped_histograms
+from .fingerprint import cluster_fingerprints, find_changed_clusters, is_compatible, pc_params_signature, previous_epoch_units
+from .nn_index import NeighborhoodIndexCache
 
 
-def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, params, epochs = None):
+def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, params, epochs = None,
+                      previous_metrics = None, previous_fingerprint = None, return_fingerprint = False):
 
     """ Calculate metrics for all units on one probe
 
+    After manual curation, most clusters keep exactly the same spikes. If the
+    metrics and fingerprint (see fingerprint.py) of an earlier run are given,
+    the PC-based metrics (isolation distance, L-ratio, d-prime and the 
+    nearest-neighbor metrics) are only recalculated for clusters that are new
+    or changed, and for the clusters that have one of those as a neighbor 
+    before or after curation; the other rows are copied from previous_metrics.
+    The remaining metrics are calculated for all spikes at once and are always
+    recalculated.
+
     Inputs:
     ------
     spike_times : numpy.ndarray (num_spikes x 0)
@@ -47,6 +64,12 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
         'tbin_sec' : time bin for ccg for contam_rate
     epochs : list of Epoch objects
         contains information on Epoch start and stop times
+    previous_metrics : pandas.DataFrame (optional)
+        Metrics from an earlier run on the same spikes
+    previous_fingerprint : dict (optional)
+        Fingerprint returned with previous_metrics
+    return_fingerprint : Bool (optional)
+        If True, also return the fingerprint of this run
 
     
     Outputs:
@@ -54,6 +77,9 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
     metrics : pandas.DataFrame
         one column for each metric
         one row per unit per epoch
+    fingerprint (optional) : dict
+        Spike membership of each cluster, and peak channel and template of
+        each unit in each epoch; save with fingerprint.save_fingerprint
 
     """
 
@@ -83,72 +109,156 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
     
     total_epochs = len(epochs)
 
-    for epoch in epochs:
+    pc_metric_names = ['isolation_distance', 'l_ratio', 'd_prime', 'nn_hit_rate', 'nn_miss_rate']
 
-        in_epoch = (spike_times >= epoch.start_time) * (spike_times <= epoch.end_time)
+    changed_clusters = None
 
-        print("Calculating isi violations")
-        isi_viol, num_viol = calculate_isi_violations(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['isi_threshold'], params['min_isi'])
-        
-        print("Calculating contamination rate")
-        contam_rate = calculate_contam_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['tbin_sec'], params['isi_threshold'])
+    if include_pcs and (return_fingerprint or previous_fingerprint is not None):
+        with span('cluster_fingerprints'):
+            fingerprints, fingerprint_counts = cluster_fingerprints(spike_clusters, total_units)
+        epoch_template_ids = np.full((total_epochs, total_units), -1, dtype='int64')
+        epoch_peak_channels = np.full((total_epochs, total_units), -1, dtype='int64')
+
+        if previous_fingerprint is not None and previous_metrics is not None:
+            if is_compatible(previous_fingerprint, spike_clusters.size, params):
+                changed_clusters = find_changed_clusters(previous_fingerprint, fingerprints, fingerprint_counts)
+                print(repr(np.sum(changed_clusters)) + ' clusters changed since the previous run')
+            else:
+                print('Spikes or PC metric parameters differ from the previous run; recalculating all units')
+
+    for epoch_idx, epoch in enumerate(epochs):
 
-        print("Calculating presence ratio")
-        presence_ratio = calculate_presence_ratio(spike_times[in_epoch], spike_clusters[in_epoch], total_units)
+        in_epoch = (spike_times >= epoch.start_time) * (spike_times <= epoch.end_time)
 
-        print("Calculating firing rate")
-        firing_rate = calculate_firing_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units)
+        # group the spikes in this epoch by cluster once; every per-unit loop
+        # below takes its spikes from this index instead of building a new
+        # spike_clusters == cluster_id mask over all spikes
+        cluster_index = ClusterIndex(spike_clusters[in_epoch], total_units)
+
+        with span('spike_train_metrics', epoch=epoch.name):
+            print("Calculating isi violations, presence ratio and firing rate")
+            isi_viol, num_viol, presence_ratio, firing_rate = calculate_spike_train_metrics(spike_times[in_epoch],
+                                                                                           spike_clusters[in_epoch],
+                                                                                           total_units,
+                                                                                           params['isi_threshold'],
+                                                                                           params['min_isi'],
+                                                                                           cluster_index=cluster_index)
+        
+        with span('contamination_rate', epoch=epoch.name):
+            print("Calculating contamination rate")
+            contam_rate = calculate_contam_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['tbin_sec'], params['isi_threshold'], cluster_index)
         
-        print("Calculating amplitude cutoff")
-        amplitude_cutoff = calculate_amplitude_cutoff(spike_clusters[in_epoch], amplitudes[in_epoch], total_units)
+        with span('amplitude_cutoff', epoch=epoch.name):
+            print("Calculating amplitude cutoff")
+            amplitude_cutoff = calculate_amplitude_cutoff(spike_clusters[in_epoch], amplitudes[in_epoch], total_units, cluster_index)
         
         if include_pcs:
             
             # determine template this is the best match for each cluster id
             # initialize template ids
             template_ids = template_ids + total_units + 10  # unassinged template_ids out of range
-            curr_spike_clusters = spike_clusters[in_epoch]
-            curr_spike_templates = spike_templates[in_epoch]
-            curr_cluster_ids = np.unique(curr_spike_clusters)
+            curr_spike_templates = cluster_index.sort(spike_templates[in_epoch])
+            curr_cluster_ids = cluster_index.cluster_ids
             for cid in curr_cluster_ids:
-                cluster_templates = curr_spike_templates[np.where(curr_spike_clusters==cid)]
+                cluster_templates = cluster_index.unit(curr_spike_templates, cid)
                 template_ids[cid] = np.argmax(np.bincount(cluster_templates)) 
 
-            print("Calculating PC-based metrics")
-            isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate = calculate_pc_metrics(spike_clusters[in_epoch],
-                                                                                                spike_templates[in_epoch],
-                                                                                                total_units,
-                                                                                                curr_cluster_ids,
-                                                                                                template_ids,
-                                                                                                pc_features[in_epoch,:,:],
-                                                                                                pc_feature_ind,
-                                                                                                channel_pos,
-                                                                                                params['max_radius_um'],
-                                                                                                params['max_spikes_for_unit'],
-                                                                                                params['max_spikes_for_nn'],
-                                                                                                params['n_neighbors'])
+            # pc_features for this epoch: a view when the epoch's spikes are
+            # contiguous (sorted spike times), so a memmapped pc_features is
+            # not read into memory here
+            epoch_pc_features = select_spikes(pc_features, in_epoch)
+
+            units_to_calculate = curr_cluster_ids
+            previous_template_ids, previous_peak_channels = None, None
+
+            if changed_clusters is not None:
+                previous_template_ids, previous_peak_channels = previous_epoch_units(previous_fingerprint, epoch.name, changed_clusters.size)
+                previous_rows = previous_metrics[previous_metrics['epoch_name'] == epoch.name].set_index('cluster_id')
+
+            if previous_template_ids is not None:
+                # unchanged units have the same spikes, so the same template
+                # and peak channel as before
+                changed = changed_clusters[:total_units][curr_cluster_ids]
+                peak_channels = previous_peak_channels[:total_units].astype('uint16')
+                peak_channels = get_unit_peak_channels(curr_cluster_ids[changed], total_units, template_ids, epoch_pc_features,
+                                                       pc_feature_ind, cluster_index, peak_channels)
+
+                # units that use a changed unit's spikes now, or used them before
+                changed_ids = np.flatnonzero(changed_clusters)
+                now_present = changed_ids[changed_ids < total_units]
+                now_present = now_present[cluster_index.counts[now_present] > 0]
+                before_present = changed_ids[previous_template_ids[changed_ids] >= 0]
+                unchanged_ids = curr_cluster_ids[~changed]
+
+                units_to_calculate = np.union1d(curr_cluster_ids[changed], 
+                                      np.union1d(find_neighboring_units(unchanged_ids, now_present, template_ids, peak_channels, 
+                                                                        pc_feature_ind, channel_pos, params['max_radius_um']),
+                                                 find_neighboring_units(unchanged_ids, before_present, previous_template_ids, previous_peak_channels, 
+                                                                        pc_feature_ind, channel_pos, params['max_radius_um'])))
+
+                # and any unit that has no row to copy
+                units_to_calculate = np.union1d(units_to_calculate, np.setdiff1d(curr_cluster_ids, previous_rows.index.values))
+                print('Calculating PC-based metrics for ' + repr(units_to_calculate.size) + ' of ' + repr(curr_cluster_ids.size) + ' units')
+            else:
+                peak_channels = get_unit_peak_channels(curr_cluster_ids, total_units, template_ids, epoch_pc_features,
+                                                       pc_feature_ind, cluster_index)
+
+            if return_fingerprint:
+                epoch_template_ids[epoch_idx, curr_cluster_ids] = template_ids[curr_cluster_ids]
+                epoch_peak_channels[epoch_idx, curr_cluster_ids] = peak_channels[curr_cluster_ids]
+
+            with span('pc_metrics', epoch=epoch.name, num_units=len(units_to_calculate)):
+                print("Calculating PC-based metrics")
+                isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate = calculate_pc_metrics(spike_clusters[in_epoch],
+                                                                                                    spike_templates[in_epoch],
+                                                                                                    total_units,
+                                                                                                    units_to_calculate,
+                                                                                                    template_ids,
+                                                                                                    epoch_pc_features,
+                                                                                                    pc_feature_ind,
+                                                                                                    channel_pos,
+                                                                                                    params['max_radius_um'],
+                                                                                                    params['max_spikes_for_unit'],
+                                                                                                    params['max_spikes_for_nn'],
+                                                                                                    params['n_neighbors'],
+                                                                                                    cluster_index,
+                                                                                                    params.get('n_jobs', 1),
+                                                                                                    params.get('random_seed'),
+                                                                                                    params.get('batch_pc_neighborhoods', False),
+                                                                                                    'float32' if params.get('mahalanobis_float32', False) else None,
+                                                                                                    nn_cache_size = params.get('nn_cache_size', 0),
+                                                                                                    nn_eps = params.get('nn_approx_eps', 0),
+                                                                                                    peak_channels = peak_channels)
+
+                if previous_template_ids is not None:
+                    # copy the rows of units that were not recalculated
+                    copied = np.setdiff1d(curr_cluster_ids, units_to_calculate)
+                    for name, values in zip(pc_metric_names, (isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate)):
+                        values[copied] = previous_rows.loc[copied, name].values
   
-            print("Calculating silhouette score")
-            nSpikes = spike_times[in_epoch].size
-            the_silhouette_score = calculate_silhouette_score(spike_clusters[in_epoch], 
-                                                       spike_templates[in_epoch],
-                                                       total_units,                                                      
-                                                       pc_features[in_epoch,:,:],
-                                                       pc_feature_ind,
-                                                       min(nSpikes, params['n_silhouette']))
-
-
-            print("Calculating drift metrics")
-            max_drift, cumulative_drift = calculate_drift_metrics(spike_times[in_epoch],
-                                                       spike_clusters[in_epoch], 
-                                                       spike_templates,
-                                                       template_ids,
-                                                       total_units,
-                                                       pc_features[in_epoch,:,:],
-                                                       pc_feature_ind,
-                                                       channel_pos,
-                                                       params['drift_metrics_interval_s'],
-                                                       params['drift_metrics_min_spikes_per_interval'])
+            with span('silhouette_score', epoch=epoch.name):
+                print("Calculating silhouette score")
+                nSpikes = spike_times[in_epoch].size
+                the_silhouette_score = calculate_silhouette_score(spike_clusters[in_epoch], 
+                                                           spike_templates[in_epoch],
+                                                           total_units,                                                      
+                                                           epoch_pc_features,
+                                                           pc_feature_ind,
+                                                           min(nSpikes, params['n_silhouette']))
+
+
+            with span('drift_metrics', epoch=epoch.name):
+                print("Calculating drift metrics")
+                max_drift, cumulative_drift = calculate_drift_metrics(spike_times[in_epoch],
+                                                           spike_clusters[in_epoch], 
+                                                           spike_templates,
+                                                           template_ids,
+                                                           total_units,
+                                                           epoch_pc_features,
+                                                           pc_feature_ind,
+                                                           channel_pos,
+                                                           params['drift_metrics_interval_s'],
+                                                           params['drift_metrics_min_spikes_per_interval'])
         else:
             # fill in empty arrays for dataframe            
             isolation_distance = np.zeros((total_units,))
@@ -183,95 +293,356 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
                                 ('epoch_name' , epoch_name),
                                 )))))
 
+    if return_fingerprint:
+        fingerprint = None
+        if include_pcs:
+            fingerprint = {'num_spikes' : spike_clusters.size,
+                           'params' : pc_params_signature(params),
+                           'fingerprints' : fingerprints,
+                           'counts' : fingerprint_counts,
+                           'epoch_names' : np.array([epoch.name for epoch in epochs]),
+                           'template_ids' : epoch_template_ids,
+                           'peak_channels' : epoch_peak_channels}
+        return metrics, fingerprint
+
     return metrics 
 
-# ===============================================================
+def calculate_windowed_metrics(spike_times, spike_clusters, total_units, params, window_length, step, start_time=None, end_time=None, amplitudes=None):
 
-# HELPER FUNCTIONS TO LOOP THROUGH CLUSTERS:
+    """ Calculate spike-train metrics in sliding windows, for stability tracking
 
-# ===============================================================
+    Each window gives the same firing_rate, presence_ratio, isi_viol and 
+    num_viol as calculate_metrics with an Epoch covering that window, without
+    repeating the per-epoch masks and per-unit work:
 
-def calculate_isi_violations(spike_times, spike_clusters, total_units, isi_threshold, min_isi):
+    - spikes are sorted by time once, and the first and last spike of every 
+      window are found with searchsorted
+    - each unit's (time-sorted) spike train is taken from one ClusterIndex, 
+      and the number of spikes of each unit before every window boundary is
+      found with one bincount over the segments between boundaries
+    - spike counts, non-duplicate spike counts and ISI violations are prefix 
+      sums over the unit spike trains, so each (unit, window) value is a 
+      difference of two entries, shared by all overlapping windows
 
-    cluster_ids = np.unique(spike_clusters)
+    Only the presence ratio, whose bins depend on each window's first and last
+    spike, is counted per window, from that window's contiguous slice of spikes.
 
-    viol_rates = np.zeros((total_units,))
-    
-    num_viol =np.zeros((total_units,))
+    If amplitudes are given, the amplitude cutoff of every (unit, window) is
+    also calculated, from the same cluster-sorted spikes: each is a range of 
+    the sorted amplitudes, and all are histogrammed together 
+    (amplitude_cutoff_batch).
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    total_units : Int
+        Total number of units
+    params : dict of parameters
+        'isi_threshold' : minimum time for isi violations
+        'min_isi' : threshold for duplicate spikes
+    window_length : float
+        Length of each window in seconds
+    step : float
+        Time between window starts in seconds
+    start_time : float (optional)
+        Start of the first window; defaults to the first spike
+    end_time : float (optional)
+        No windows start after end_time; defaults to the last spike
+    amplitudes : numpy.ndarray (num_spikes x 0) (optional)
+        Amplitude value for each spike time
 
-        printProgressBar(idx+1, len(cluster_ids))
+    Outputs:
+    --------
+    metrics : pandas.DataFrame
+        one row per unit per window, with the window's name, start and end
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        viol_rates[cluster_id], num_viol[cluster_id] = isi_violations(spike_times[for_this_cluster], 
-                                                               min_time = np.min(spike_times), 
-                                                               max_time = np.max(spike_times), 
-                                                               isi_threshold=isi_threshold, 
-                                                               min_isi = min_isi)
+    """
 
-    return viol_rates, num_viol
+    isi_threshold = params['isi_threshold']
+    min_isi = params['min_isi']
+    num_bins = 100
+
+    spike_times = np.squeeze(spike_times)
+    spike_clusters = np.squeeze(spike_clusters)
+
+    # time order (Kilosort output is normally sorted already)
+    time_order = np.argsort(spike_times, kind='stable')
+    times = spike_times[time_order]
+    clusters = spike_clusters[time_order]
+
+    if start_time is None:
+        start_time = times[0]
+    if end_time is None:
+        end_time = times[-1]
+
+    windows = get_sliding_windows(start_time, end_time, window_length, step)
+    num_windows = len(windows)
+
+    # spikes in each window, as in calculate_metrics: start <= t <= end
+    first_spike = np.searchsorted(times, [w.start_time for w in windows], side='left')
+    last_spike = np.searchsorted(times, [w.end_time for w in windows], side='right')
+
+    # number of spikes from each unit before every window boundary
+    boundaries, boundary_inds = np.unique(np.concatenate((first_spike, last_spike)), return_inverse=True)
+    segments = np.searchsorted(boundaries, np.arange(times.size), side='right')
+    segment_counts = np.bincount(clusters * (boundaries.size + 1) + segments,
+                                 minlength=total_units * (boundaries.size + 1))
+    counts_before = np.cumsum(np.reshape(segment_counts, (total_units, boundaries.size + 1)), 1)
+
+    # each unit's spike train in time order, and the range of each window 
+    # within it: positions lo to hi (exclusive) of the cluster-sorted arrays
+    cluster_index = ClusterIndex(clusters, total_units)
+    sorted_times = cluster_index.sort(times)
+    labels = cluster_index.labels()
+
+    unit_offsets = cluster_index.offsets[:-1, np.newaxis]
+    lo = unit_offsets + counts_before[:, boundary_inds[:num_windows]]
+    hi = unit_offsets + counts_before[:, boundary_inds[num_windows:]]
+
+    # prefix sums over the unit spike trains; a spike is a duplicate if it is 
+    # within min_isi of the previous spike of the same unit
+    same_unit = labels[1:] == labels[:-1]
+    keep = np.ones((sorted_times.size,), dtype='bool')
+    keep[1:] = ~(same_unit & (np.diff(sorted_times) <= min_isi))
+
+    # isi violations between each kept spike and the previous kept spike
+    kept = np.flatnonzero(keep)
+    is_violation = np.zeros((sorted_times.size,), dtype='bool')
+    is_violation[kept[1:]] = (labels[kept[1:]] == labels[kept[:-1]]) & \
+                             (np.diff(sorted_times[kept]) < isi_threshold)
+
+    cum_kept = np.concatenate(([0], np.cumsum(keep)))
+    cum_violations = np.concatenate(([0], np.cumsum(is_violation)))
+
+    num_spikes = hi - lo
+    has_spikes = num_spikes > 0
+    first = np.where(has_spikes, lo, 0)
+
+    # the first spike of a window is never a duplicate within the window
+    first_dropped = has_spikes & ~keep[first]
+    num_kept = cum_kept[hi] - cum_kept[lo] + first_dropped
+
+    # violations with both spikes in the window; if the first spike was 
+    # dropped globally, the next kept spike's ISI is measured from it instead
+    num_viol = np.where(has_spikes, cum_violations[hi] - cum_violations[np.minimum(lo + 1, hi)], 0)
+    next_kept = kept[np.minimum(np.searchsorted(kept, first, side='right'), kept.size - 1)]
+    fix = first_dropped & (next_kept > first) & (next_kept < hi)
+    num_viol[fix] += (sorted_times[next_kept[fix]] - sorted_times[first[fix]] < isi_threshold).astype('int64') - \
+                     is_violation[next_kept[fix]]
+
+    # durations from the first and last spike in each window
+    in_window = last_spike > first_spike
+    min_time = np.where(in_window, times[np.minimum(first_spike, times.size - 1)], np.nan)
+    max_time = np.where(in_window, times[np.maximum(last_spike - 1, 0)], np.nan)
+    duration = max_time - min_time
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        firing_rate = np.where(has_spikes, num_spikes / duration, 0)
+        violation_time = 2*num_kept*(isi_threshold - min_isi)
+        total_rate = num_kept / duration
+        c = num_viol/(violation_time*total_rate)
+    isi_viol = np.ones(c.shape)
+    valid = c < 0.25    # valid solution to quadratic eq. for fpRate
+    isi_viol[valid] = (1 - np.sqrt(1-4*c[valid]))/2
+    isi_viol[~has_spikes] = 0
+
+    # presence ratio, from each window's own bins
+    presence_ratio = np.zeros((total_units, num_windows))
+
+    for idx in range(num_windows):
+
+        printProgressBar(idx+1, num_windows)
+
+        if not in_window[idx]:
+            continue
 
-def calculate_presence_ratio(spike_times, spike_clusters, total_units):
+        window_times = times[first_spike[idx]:last_spike[idx]]
+        window_clusters = clusters[first_spike[idx]:last_spike[idx]]
 
-    cluster_ids = np.unique(spike_clusters)
+        # np.histogram bins are half-open, except the last one
+        edges = np.linspace(min_time[idx], max_time[idx], num_bins)
+        bins = np.searchsorted(edges, window_times, side='right') - 1
+        bins[window_times == edges[-1]] = num_bins - 2
+        valid = (bins >= 0) & (bins < num_bins - 1)
+        occupied = np.unique(window_clusters[valid] * (num_bins - 1) + bins[valid])
+        presence_ratio[:, idx] = np.bincount(occupied // (num_bins - 1), minlength=total_units) / num_bins
 
-    ratios = np.zeros((total_units,))
+    cluster_ids = np.tile(np.arange(total_units), num_windows)
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    columns = [('cluster_id', cluster_ids),
+               ('firing_rate' , firing_rate.T.flatten()),
+               ('presence_ratio' , presence_ratio.T.flatten()),
+               ('isi_viol' , isi_viol.T.flatten()),
+               ('num_viol', num_viol.T.flatten().astype('float64'))]
 
-        printProgressBar(idx + 1, len(cluster_ids))
+    if amplitudes is not None:
+        sorted_amplitudes = cluster_index.sort(np.squeeze(amplitudes)[time_order])
+        amplitude_cutoffs = np.zeros((total_units, num_windows))
+        amplitude_cutoffs[has_spikes] = amplitude_cutoff_batch(sorted_amplitudes, lo[has_spikes], hi[has_spikes])
+        columns.append(('amplitude_cutoff', amplitude_cutoffs.T.flatten()))
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        ratios[cluster_id] = presence_ratio(spike_times[for_this_cluster], 
-                                                       min_time = np.min(spike_times), 
-                                                       max_time = np.max(spike_times))
+    columns += [('window_start', np.repeat([w.start_time for w in windows], total_units)),
+                ('window_end', np.repeat([w.end_time for w in windows], total_units)),
+                ('epoch_name' , np.repeat([w.name for w in windows], total_units))]
 
-    return ratios
+    metrics = pd.DataFrame(data= OrderedDict(columns))
+
+    return metrics
+
+# ===============================================================
+
+# HELPER FUNCTIONS TO LOOP THROUGH CLUSTERS:
+
+# ===============================================================
+
+def calculate_spike_train_metrics(spike_times, spike_clusters, total_units, isi_threshold=0.0015, min_isi=0, num_bins=100, cluster_index=None):
 
+    """ Calculate ISI violations, presence ratio and firing rate for all units at once
 
+    Batch version of isi_violations, presence_ratio and firing_rate. Works on
+    the cluster-sorted spike times: grouped diffs for the ISIs (including the
+    removal of duplicate spikes closer than min_isi), np.bincount for the
+    per-unit counts, and a unit x time-bin histogram for the presence ratio.
+    Gives the same values as calling the single-unit functions with the
+    epoch's first and last spike as min_time and max_time.
 
-def calculate_firing_rate(spike_times, spike_clusters, total_units):
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    total_units : Int
+        Number of entries in the output arrays
+    isi_threshold : float
+        Threshold for isi violation
+    min_isi : float
+        Threshold for duplicate spikes
+    num_bins : Int
+        Number of bin edges used for the presence ratio
+    cluster_index : ClusterIndex (optional)
+        Index of spike_clusters; built if not given
+
+    Outputs:
+    --------
+    viol_rates : numpy.ndarray (total_units x 0)
+    num_viol : numpy.ndarray (total_units x 0)
+    ratios : numpy.ndarray (total_units x 0)
+    firing_rates : numpy.ndarray (total_units x 0)
+
+    """
 
-    cluster_ids = np.unique(spike_clusters)
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
 
+    viol_rates = np.zeros((total_units,))
+    num_viol = np.zeros((total_units,))
+    ratios = np.zeros((total_units,))
     firing_rates = np.zeros((total_units,))
 
+    if cluster_index.num_spikes == 0:
+        return viol_rates, num_viol, ratios, firing_rates
+
+    cluster_ids = cluster_index.cluster_ids
+    sorted_times = cluster_index.sort(np.squeeze(spike_times))
+    labels = cluster_index.labels()
+
     min_time = np.min(spike_times)
     max_time = np.max(spike_times)
+    duration = max_time - min_time
+
+    # firing rate
+    firing_rates[cluster_ids] = cluster_index.counts[cluster_ids] / duration
+
+    # presence ratio: histogram of each unit's spikes over the same bin edges
+    # np.histogram bins are half-open, except the last one
+    edges = np.linspace(min_time, max_time, num_bins)
+    bins = np.searchsorted(edges, sorted_times, side='right') - 1
+    bins[sorted_times == edges[-1]] = num_bins - 2
+    valid = (bins >= 0) & (bins < num_bins - 1)
+    h = np.bincount(labels[valid] * (num_bins - 1) + bins[valid],
+                    minlength=total_units * (num_bins - 1))
+    h = np.reshape(h, (total_units, num_bins - 1))
+    ratios[cluster_ids] = np.sum(h[cluster_ids, :] > 0, 1) / num_bins
+
+    # isi violations: drop duplicate spikes, then count short ISIs within each unit
+    same_unit = labels[1:] == labels[:-1]
+    keep = np.ones((sorted_times.size,), dtype='bool')
+    keep[1:] = ~(same_unit & (np.diff(sorted_times) <= min_isi))
+    kept_times = sorted_times[keep]
+    kept_labels = labels[keep]
+
+    isis = np.diff(kept_times)
+    is_violation = (kept_labels[1:] == kept_labels[:-1]) & (isis < isi_threshold)
+    violations = np.bincount(kept_labels[1:][is_violation], minlength=total_units)[cluster_ids]
+    num_spikes = np.bincount(kept_labels, minlength=total_units)[cluster_ids]
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    violation_time = 2*num_spikes*(isi_threshold - min_isi)
+    total_rate = num_spikes / duration
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = violations/(violation_time*total_rate)
+    fpRate = np.ones(c.shape)
+    valid = c < 0.25    # valid solution to quadratic eq. for fpRate
+    fpRate[valid] = (1 - np.sqrt(1-4*c[valid]))/2
 
-        printProgressBar(idx + 1, len(cluster_ids))
+    viol_rates[cluster_ids] = fpRate
+    num_viol[cluster_ids] = violations
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        firing_rates[cluster_id] = firing_rate(spike_times[for_this_cluster], 
-                                        min_time = np.min(spike_times),
-                                        max_time = np.max(spike_times))
+    return viol_rates, num_viol, ratios, firing_rates
 
-    return firing_rates
 
+def calculate_isi_violations(spike_times, spike_clusters, total_units, isi_threshold, min_isi, cluster_index=None):
 
-def calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units):
+    viol_rates, num_viol, _, _ = calculate_spike_train_metrics(spike_times, spike_clusters, total_units,
+                                                               isi_threshold, min_isi,
+                                                               cluster_index=cluster_index)
 
-    cluster_ids = np.unique(spike_clusters)
+    return viol_rates, num_viol
 
-    amplitude_cutoffs = np.zeros((total_units,))
+def calculate_presence_ratio(spike_times, spike_clusters, total_units, cluster_index=None):
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    _, _, ratios, _ = calculate_spike_train_metrics(spike_times, spike_clusters, total_units,
+                                                    cluster_index=cluster_index)
+
+    return ratios
+
+
+
+def calculate_firing_rate(spike_times, spike_clusters, total_units, cluster_index=None):
+
+    _, _, _, firing_rates = calculate_spike_train_metrics(spike_times, spike_clusters, total_units,
+                                                          cluster_index=cluster_index)
+
+    return firing_rates
 
-        printProgressBar(idx + 1, len(cluster_ids))
 
+def calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units, cluster_index=None):
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        amplitude_cutoffs[cluster_id] = amplitude_cutoff(amplitudes[for_this_cluster])
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
+
+    cluster_ids = cluster_index.cluster_ids
+    sorted_amplitudes = cluster_index.sort(amplitudes)
+
+    amplitude_cutoffs = np.zeros((total_units,))
+
+    amplitude_cutoffs[cluster_ids] = amplitude_cutoff_batch(sorted_amplitudes, 
+                                                            cluster_index.offsets[cluster_ids], 
+                                                            cluster_index.offsets[cluster_ids + 1])
 
     return amplitude_cutoffs
 
 
-def calculate_contam_rate(spike_times, spike_clusters, total_units, tbin_sec, refPer_sec):
+def calculate_contam_rate(spike_times, spike_clusters, total_units, tbin_sec, refPer_sec, cluster_index=None):
+
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
 
-    cluster_ids = np.unique(spike_clusters)
+    cluster_ids = cluster_index.cluster_ids
+    sorted_times = cluster_index.sort(spike_times)
 
     contam_rate = np.ones((total_units,))
 
@@ -279,7 +650,7 @@ def calculate_contam_rate(spike_times, spike_clusters, total_units, tbin_sec, re
 
         printProgressBar(idx + 1, len(cluster_ids))
 
-        curr_st_sec = spike_times[spike_clusters == cluster_id]
+        curr_st_sec = cluster_index.unit(sorted_times, cluster_id)
         
         if len(curr_st_sec) > 10: 
             contam_rate[cluster_id] = contamination_rate(curr_st_sec, tbin_sec, refPer_sec)           
@@ -298,44 +669,428 @@ def calculate_pc_metrics(spike_clusters,
                          max_radius_um, 
                          max_spikes_for_cluster, 
                          max_spikes_for_nn, 
-                         n_neighbors):
+                         n_neighbors,
+                         cluster_index=None,
+                         n_jobs=1,
+                         seed=None,
+                         batch_neighborhoods=False,
+                         dtype=None,
+                         nn_cache_size=0,
+                         nn_eps=0,
+                         peak_channels=None):
+
+    """ Calculate isolation distance, L-ratio, d-prime and nearest-neighbor metrics for all units
+
+    Each unit is compared with the neighboring units that have PCs on its peak
+    channel. Units are independent of each other, so with n_jobs > 1 they are
+    spread across worker processes; the workers read pc_features from shared
+    memory (or re-open the memmapped file) rather than receiving a copy.
+
+    If seed is given, the random subsample of spikes for each unit is drawn from
+    a stream seeded by (seed, cluster_id), so the result does not depend on the
+    number of workers. Without a seed, the serial calculation draws from the
+    global numpy random state as before.
+
+    With batch_neighborhoods, units with the same peak channel that are small
+    enough to be used without subsampling (at most max_spikes_for_cluster 
+    spikes) are processed together: they compare against exactly the same set
+    of spikes, so that set is gathered once and the Mahalanobis metrics for all
+    of them are calculated in one call. dtype (e.g. 'float32') sets the 
+    precision of the Mahalanobis calculation.
+
+    With nn_cache_size > 0, a KD-tree is built once for each channel 
+    neighborhood and its nearest-neighbor search is shared by the units that 
+    use it (see NeighborhoodIndexCache; nn_eps > 0 makes the search 
+    approximate). With nn_eps = 0 the metrics are unchanged. Units are then 
+    processed in order of peak channel, so that a neighborhood's units follow
+    each other in the cache.
+
+    peak_channels (from get_unit_peak_channels) must cover all units with
+    spikes, not only cluster_ids, since those units are used as neighbors. If
+    it is not given, cluster_ids must include every unit with spikes.
+
+    """
 
 # OLDER calculatioon assuming linear array and using a number of channels instead of max_radius
 #    assert(num_channels_to_compare % 2 == 1)
 #    half_spread = int((num_channels_to_compare - 1) / 2)
 
 
-    peak_channels = np.zeros((total_units,), dtype='uint16')
     isolation_distances = np.zeros((total_units,))
     l_ratios = np.zeros((total_units,))
     d_primes = np.zeros((total_units,))
     nn_hit_rates = np.zeros((total_units,))
     nn_miss_rates = np.zeros((total_units,))
     
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters, total_units)
+
+    if peak_channels is None:
+        peak_channels = get_unit_peak_channels(cluster_ids, total_units, template_ids, pc_features, pc_feature_ind, cluster_index)
+
+    if n_jobs > 1 and seed is None:
+        # workers need their own streams; take the seed from the global state
+        seed = np.random.randint(np.iinfo(np.int32).max)
+
+    unit_args = dict(spike_clusters = spike_clusters,
+                     spike_templates = spike_templates,
+                     template_ids = template_ids,
+                     peak_channels = peak_channels,
+                     pc_feature_ind = pc_feature_ind,
+                     channel_pos = channel_pos,
+                     max_radius_um = max_radius_um,
+                     max_spikes_for_cluster = max_spikes_for_cluster,
+                     max_spikes_for_nn = max_spikes_for_nn,
+                     n_neighbors = n_neighbors,
+                     cluster_index = cluster_index,
+                     seed = seed,
+                     dtype = dtype,
+                     nn_cache = NeighborhoodIndexCache(nn_cache_size, nn_eps) if nn_cache_size > 0 else None)
+
+    if batch_neighborhoods:
+        batches = group_units_by_neighborhood(cluster_ids, peak_channels, cluster_index.counts, max_spikes_for_cluster)
+    else:
+        batches = [[cluster_id] for cluster_id in cluster_ids]
+
+    if nn_cache_size > 0:
+        batches.sort(key = lambda batch: peak_channels[batch[0]])
+
+    if n_jobs > 1 and len(batches) > 1:
+        results = _parallel_pc_metrics(batches, pc_features, unit_args, n_jobs)
+    else:
+        results = _serial_pc_metrics(batches, pc_features, unit_args)
+
+    for cluster_id, unit_metrics in results:
+        isolation_distances[cluster_id], l_ratios[cluster_id], d_primes[cluster_id], \
+            nn_hit_rates[cluster_id], nn_miss_rates[cluster_id] = unit_metrics
+
+    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates 
+
+
+def get_unit_peak_channels(cluster_ids, total_units, template_ids, pc_features, pc_feature_ind, cluster_index, peak_channels=None):
+
+    """ Channel with the largest mean first PC for each unit
+
+    Inputs:
+    -------
+    cluster_ids : numpy.ndarray
+        Units for which to find the peak channel
+    template_ids : numpy.ndarray (total_units x 0)
+        Majority template for each unit
+    cluster_index : ClusterIndex
+        Index of spike_clusters
+    peak_channels : numpy.ndarray (total_units x 0) (optional)
+        Known peak channels of the other units, updated in place
+
+    Outputs:
+    --------
+    peak_channels : numpy.ndarray (total_units x 0)
+
+    """
+
+    if peak_channels is None:
+        peak_channels = np.zeros((total_units,), dtype='uint16')
 
 # pc_feature_ind is NOT updated by phy during manual clustering
 
     for idx, cluster_id in enumerate(cluster_ids):
             
         # individual pcs are stored for each spike, independent of cluster id
-        for_unit = np.squeeze(spike_clusters == cluster_id)
+        for_unit = cluster_index.indices(cluster_id)
         pc_max = np.argmax(np.mean(pc_features[for_unit, 0, :],0))
         
         # pc_feature_ind are stored according to template, using the 
         # most common template for spikes in this cluster in this epoch
         peak_channels[cluster_id] = pc_feature_ind[template_ids[cluster_id], pc_max]
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    return peak_channels
 
-        
-        printProgressBar(idx + 1, len(cluster_ids))
 
-            
-        peak_channel = peak_channels[cluster_id]
-        
-        # calculate distances from all channels to peak channel
-        chan_dist = np.sqrt(np.square(channel_pos[:,0] - channel_pos[peak_channel,0]) + \
-                            np.square(channel_pos[:,1] - channel_pos[peak_channel,1]) )
+def find_neighboring_units(unit_ids, other_ids, template_ids, peak_channels, pc_feature_ind, channel_pos, max_radius_um):
+
+    """ Units whose PC metrics use the spikes of any of other_ids
+
+    Applies the rule of get_neighborhood_pcs: unit j is a neighbor of unit i if
+    the template of j has PCs on the peak channel of i, and the peak channel of
+    j is within max_radius_um of that of i.
+
+    Inputs:
+    -------
+    unit_ids : numpy.ndarray
+        Units to check
+    other_ids : numpy.ndarray
+        Units to look for in their neighborhoods
+    template_ids : numpy.ndarray (total_units x 0)
+        Majority template for each unit
+    peak_channels : numpy.ndarray (total_units x 0)
+        Peak channel of each unit
+
+    Outputs:
+    --------
+    neighbors : numpy.ndarray
+        The units of unit_ids with at least one of other_ids as a neighbor
+
+    """
+
+    unit_ids = np.asarray(unit_ids, dtype='int64')
+    other_ids = np.asarray(other_ids, dtype='int64')
+
+    if unit_ids.size == 0 or other_ids.size == 0:
+        return np.zeros((0,), dtype='int64')
+
+    unit_peaks = peak_channels[unit_ids]
+    other_peaks = peak_channels[other_ids]
+
+    has_pcs = np.any(pc_feature_ind[template_ids[other_ids]][np.newaxis, :, :] == unit_peaks[:, np.newaxis, np.newaxis], 2)
+
+    chan_dist = np.sqrt(np.sum(np.square(channel_pos[unit_peaks, np.newaxis, :2] - channel_pos[np.newaxis, other_peaks, :2]), 2))
+
+    return unit_ids[np.any(has_pcs & (chan_dist < max_radius_um), 1)]
+
+
+def group_units_by_neighborhood(cluster_ids, peak_channels, spike_counts, max_spikes_for_cluster):
+
+    """ Group units whose PC metrics use exactly the same set of spikes
+
+    Units with the same peak channel compare against the same neighboring 
+    units and channels. If a unit has more than max_spikes_for_cluster spikes,
+    it (and its neighbors) are subsampled relative to its own spike count, so 
+    only units without subsampling can share a set of spikes.
+
+    Outputs:
+    --------
+    batches : list of lists
+        Cluster IDs to process together; other units are in batches of one
+
+    """
+
+    batches = []
+    by_channel = {}
+
+    for cluster_id in cluster_ids:
+        if spike_counts[cluster_id] > max_spikes_for_cluster:
+            batches.append([cluster_id])
+        else:
+            by_channel.setdefault(peak_channels[cluster_id], []).append(cluster_id)
+
+    return batches + list(by_channel.values())
+
+
+def _serial_pc_metrics(batches, pc_features, unit_args):
+
+    for idx, batch in enumerate(batches):
+
+        printProgressBar(idx + 1, len(batches))
+
+        yield from calculate_batch_pc_metrics(batch, pc_features, **unit_args)
+
+
+def _parallel_pc_metrics(batches, pc_features, unit_args, n_jobs):
+
+    pc_spec, shm = _share_array(pc_features)
+
+    try:
+        with ProcessPoolExecutor(max_workers = min(n_jobs, len(batches)),
+                                 initializer = _init_pc_worker,
+                                 initargs = (pc_spec, unit_args)) as executor:
+
+            chunksize = max(1, len(batches) // (n_jobs * 8))
+
+            for idx, results in enumerate(executor.map(_pc_worker_batch, batches, chunksize = chunksize)):
+
+                printProgressBar(idx + 1, len(batches))
+
+                yield from results
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+
+# state of each PC metrics worker process, set by _init_pc_worker
+_pc_worker = {}
+
+
+def _init_pc_worker(pc_spec, unit_args):
+
+    _pc_worker['pc_features'], _pc_worker['shm'] = _attach_array(pc_spec)
+    _pc_worker['unit_args'] = unit_args
+
+
+def _pc_worker_batch(batch):
+
+    return calculate_batch_pc_metrics(batch, _pc_worker['pc_features'], **_pc_worker['unit_args'])
+
+
+def _share_array(array):
+
+    """ Describe an array so that worker processes can map it without a copy
+
+    A memmapped array is re-opened from its file by each worker; anything else
+    is copied once into a shared memory block.
+
+    Outputs:
+    --------
+    spec : tuple
+        (kind, file or shared memory name, dtype, shape, offset) for _attach_array
+    shm : SharedMemory or None
+        Shared memory block to close and unlink when the workers are done
+
+    """
+
+    if isinstance(array, np.memmap) and array._mmap is not None and array.flags['C_CONTIGUOUS']:
+        # file offset of this (possibly sliced) view; numpy maps the file from
+        # the allocation boundary below the array offset
+        map_start = np.frombuffer(array._mmap, dtype = 'uint8').ctypes.data
+        file_start = array.offset - array.offset % mmap.ALLOCATIONGRANULARITY
+        offset = file_start + array.ctypes.data - map_start
+        return ('memmap', array.filename, array.dtype.str, array.shape, offset), None
+
+    shm = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype = array.dtype, buffer = shm.buf)
+    shared[...] = array
+
+    return ('shm', shm.name, array.dtype.str, array.shape, 0), shm
+
+
+def _attach_array(spec):
+
+    """ Read-only view of an array described by _share_array """
+
+    kind, name, dtype, shape, offset = spec
+
+    if kind == 'memmap':
+        return np.memmap(name, dtype = dtype, mode = 'r', shape = shape, offset = offset), None
+
+    shm = shared_memory.SharedMemory(name = name)
+    array = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+    array.flags.writeable = False
+
+    return array, shm
+
+
+def calculate_unit_pc_metrics(cluster_id,
+                              pc_features,
+                              spike_clusters,
+                              spike_templates,
+                              template_ids,
+                              peak_channels,
+                              pc_feature_ind,
+                              channel_pos,
+                              max_radius_um,
+                              max_spikes_for_cluster,
+                              max_spikes_for_nn,
+                              n_neighbors,
+                              cluster_index,
+                              seed=None,
+                              dtype=None):
+
+    """ Calculate the PC-based metrics for one unit
+
+    Inputs:
+    -------
+    cluster_id : Int
+        Unit for which the metrics are calculated
+    pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
+        Pre-computed PCs for blocks of channels around each spike
+    peak_channels : numpy.ndarray (total_units x 0)
+        Peak channel of each unit
+    cluster_index : ClusterIndex
+        Index of spike_clusters
+    seed : Int (optional)
+        If given, spikes are subsampled with a generator seeded by (seed, cluster_id)
+    dtype : numpy dtype (optional)
+        Precision of the Mahalanobis metrics
+
+    Outputs:
+    --------
+    isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate
+
+    """
+
+    return calculate_batch_pc_metrics([cluster_id], pc_features, spike_clusters, spike_templates, 
+                                      template_ids, peak_channels, pc_feature_ind, channel_pos, 
+                                      max_radius_um, max_spikes_for_cluster, max_spikes_for_nn, 
+                                      n_neighbors, cluster_index, seed, dtype)[0][1]
+
+
+def calculate_batch_pc_metrics(cluster_ids,
+                               pc_features,
+                               spike_clusters,
+                               spike_templates,
+                               template_ids,
+                               peak_channels,
+                               pc_feature_ind,
+                               channel_pos,
+                               max_radius_um,
+                               max_spikes_for_cluster,
+                               max_spikes_for_nn,
+                               n_neighbors,
+                               cluster_index,
+                               seed=None,
+                               dtype=None,
+                               nn_cache=None):
+
+    """ Calculate the PC-based metrics for units that share one set of spikes
+
+    The set of spikes is gathered for cluster_ids[0]; the other units must be
+    in the same batch from group_units_by_neighborhood. If nn_cache (a
+    NeighborhoodIndexCache) is given, nearest-neighbor searches are shared 
+    between units with the same set of spikes.
+
+    Outputs:
+    --------
+    results : list of (cluster_id, (isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate))
+
+    """
+
+    all_pcs, all_labels, neighborhood_key = get_neighborhood_pcs(cluster_ids[0], pc_features, spike_clusters, spike_templates, 
+                                               template_ids, peak_channels, pc_feature_ind, channel_pos, 
+                                               max_radius_um, max_spikes_for_cluster, cluster_index, seed)
+
+    unit_metrics = pc_metrics_from_neighborhood(all_pcs, all_labels, cluster_ids, max_spikes_for_nn, n_neighbors, 
+                                                dtype, nn_cache, neighborhood_key)
+
+    return list(zip(cluster_ids, unit_metrics))
+
+
+def get_neighborhood_pcs(cluster_id,
+                         pc_features,
+                         spike_clusters,
+                         spike_templates,
+                         template_ids,
+                         peak_channels,
+                         pc_feature_ind,
+                         channel_pos,
+                         max_radius_um,
+                         max_spikes_for_cluster,
+                         cluster_index,
+                         seed=None):
+
+    """ PCs of one unit and its neighbors, on the channels within max_radius_um of its peak channel
+
+    Outputs:
+    --------
+    all_pcs : numpy.ndarray (num_spikes x PCs) or None
+        None if there are no neighboring units to compare with
+    all_labels : numpy.ndarray (num_spikes x 0) or None
+        Cluster ID for each row of all_pcs
+    neighborhood_key : Int or None
+        Peak channel if the same spikes are used by every unit on that channel
+        (no subsampling), otherwise None
+
+    """
+
+    if seed is None:
+        rng = None
+    else:
+        rng = np.random.default_rng([seed, cluster_id])
+
+    peak_channel = peak_channels[cluster_id]
+    
+    # calculate distances from all channels to peak channel
+    chan_dist = np.sqrt(np.square(channel_pos[:,0] - channel_pos[peak_channel,0]) + \
+                        np.square(channel_pos[:,1] - channel_pos[peak_channel,1]) )
 
 # OLDER calculatioon assuming linear array
 #        half_spread_down = peak_channel \
@@ -346,59 +1101,60 @@ def calculate_pc_metrics(spike_clusters,
 #            if peak_channel + half_spread > np.max(pc_feature_ind) \
 #            else half_spread
 
-        # which templates have pcs on the peak channel of the current unit?
-        # channel index -- which of the channel swithin the set for a single template -- i snot used
-        templates_for_channel, channel_index = np.unravel_index(np.where(pc_feature_ind.flatten() == peak_channel)[0], pc_feature_ind.shape)
+    # which templates have pcs on the peak channel of the current unit?
+    # channel index -- which of the channel swithin the set for a single template -- i snot used
+    templates_for_channel, channel_index = np.unravel_index(np.where(pc_feature_ind.flatten() == peak_channel)[0], pc_feature_ind.shape)
 
 
-        # which units have these templates?       
-        units_for_channel = np.zeros((0,),dtype='uint16')
-        for j in templates_for_channel:
-            units_for_channel = np.append(units_for_channel, np.where(template_ids==j))
-                  
-               
+    # which units have these templates?       
+    units_for_channel = np.zeros((0,),dtype='uint16')
+    for j in templates_for_channel:
+        units_for_channel = np.append(units_for_channel, np.where(template_ids==j))
+              
+           
 # OLDER calculatioon assuming linear array        
 #        units_in_range = (peak_channels[units_for_channel] >= peak_channel - half_spread_down) * \
 #                       (peak_channels[units_for_channel] <= peak_channel + half_spread_up)
-                        
-        
-        # of those units that have pc overlap, which have their peak channel 
-        # within range of the current unit?              
-        units_in_range = np.where( chan_dist[peak_channels[units_for_channel]] < max_radius_um )[0]
-           
-            
-        # If there is at least one neighbor unit in range, compare pcs across 
-        # units for channels that overlap AND lie within maximum radius
-        
-        if len(units_in_range) > 1 :
-
-            units_for_channel = np.asarray(units_for_channel[units_in_range])
                     
     
+    # of those units that have pc overlap, which have their peak channel 
+    # within range of the current unit?              
+    units_in_range = np.where( chan_dist[peak_channels[units_for_channel]] < max_radius_um )[0]
+       
+        
+    # If there is at least one neighbor unit in range, compare pcs across 
+    # units for channels that overlap AND lie within maximum radius
+    
+    if len(units_in_range) > 1 :
+
+        units_for_channel = np.asarray(units_for_channel[units_in_range])
+                
+
 # OLDER calculatioon assuming linear array
 #           channels_to_use = np.arange(peak_channel - half_spread_down, peak_channel + half_spread_up + 1)
+        
+        channels_to_use = np.where(chan_dist < max_radius_um)[0]
+
+
+        spike_counts = cluster_index.counts[units_for_channel].astype('int')
             
-            channels_to_use = np.where(chan_dist < max_radius_um)[0]
+        this_unit_idx = np.where(units_for_channel == cluster_id)[0]
 
-    
-            spike_counts = np.zeros(units_for_channel.shape, dtype = 'int')
-    
-            for idx2, cluster_id2 in enumerate(units_for_channel):
-                spike_counts[idx2] = np.sum(spike_clusters == cluster_id2)
-                
-            this_unit_idx = np.where(units_for_channel == cluster_id)[0]
-    
-            # calculate how many spikes from this unit will be used
-            if spike_counts[this_unit_idx] > max_spikes_for_cluster:
-                relative_counts = spike_counts / spike_counts[this_unit_idx] * max_spikes_for_cluster
-            else:
-                relative_counts = spike_counts
+        # calculate how many spikes from this unit will be used
+        if spike_counts[this_unit_idx] > max_spikes_for_cluster:
+            relative_counts = spike_counts / spike_counts[this_unit_idx] * max_spikes_for_cluster
+            neighborhood_key = None
+        else:
+            relative_counts = spike_counts
+            # all spikes of the neighboring units are used, so the set only
+            # depends on the peak channel
+            neighborhood_key = int(peak_channel)
+        
+        all_pcs = np.zeros((0, pc_features.shape[1], channels_to_use.size))     #dtype = default, double
+        all_labels = np.zeros((0,), dtype = 'int')
             
-            all_pcs = np.zeros((0, pc_features.shape[1], channels_to_use.size))     #dtype = default, double
-            all_labels = np.zeros((0,), dtype = 'int')
-                
-            for idx2, cluster_id2 in enumerate(units_for_channel):
-    
+        for idx2, cluster_id2 in enumerate(units_for_channel):
+
 # if any manual curation as been done, the cluster ids are no longer identical to the template ids
 # That means we can't use a universal channelmask. Rather, we have to check for each spike what
 # channels are there (recorded in pc_feature_ind) and take those that are included in 
@@ -418,49 +1174,77 @@ def calculate_pc_metrics(spike_clusters,
 #                    
 #                    all_pcs = np.concatenate((all_pcs, pcs),0)
 #                    all_labels = np.concatenate((all_labels, labels),0)
-                
-                subsample = int(relative_counts[idx2]) # how many spikes to use from this unit
-                index_mask = make_index_mask(spike_clusters, cluster_id2, min_num = 0, max_num = subsample)
-                
-                pcs = get_unit_pcs(pc_features, index_mask, spike_templates, channels_to_use, pc_feature_ind)
-                labels = np.ones((pcs.shape[0],), dtype = 'int') * cluster_id2
+            
+            subsample = int(relative_counts[idx2]) # how many spikes to use from this unit
+            index_mask = make_index_mask(spike_clusters, cluster_id2, min_num = 0, max_num = subsample, cluster_index = cluster_index, rng = rng)
+            
+            pcs = get_unit_pcs(pc_features, index_mask, spike_templates, channels_to_use, pc_feature_ind)
+            labels = np.ones((pcs.shape[0],), dtype = 'int') * cluster_id2
 
-                all_pcs = np.concatenate((all_pcs, pcs),0)
-                all_labels = np.concatenate((all_labels, labels),0) 
-                
-            all_pcs = np.reshape(all_pcs, (all_pcs.shape[0], pc_features.shape[1]*channels_to_use.size))
+            all_pcs = np.concatenate((all_pcs, pcs),0)
+            all_labels = np.concatenate((all_labels, labels),0) 
             
-            num_pcs = all_pcs.shape[0];
+        all_pcs = np.reshape(all_pcs, (all_pcs.shape[0], pc_features.shape[1]*channels_to_use.size))
+        
+        return all_pcs, all_labels, neighborhood_key
+    
+    else:
+        # no near neighbor units to compare
+        return None, None, None
+
+
+def pc_metrics_from_neighborhood(all_pcs, all_labels, unit_ids, max_spikes_for_nn, n_neighbors, dtype=None, nn_cache=None, neighborhood_key=None):
+
+    """ Isolation distance, L-ratio, d-prime and nearest-neighbor metrics for units in one set of spikes
+
+    With nn_cache, the nearest-neighbor metrics come from one search over the
+    set of spikes (see nearest_neighbors_metrics_batch), kept under 
+    neighborhood_key for later units with the same set.
+
+    Outputs:
+    --------
+    unit_metrics : list of (isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate)
+        One entry per unit; (nan, 0, nan, nan, nan) if there are too few spikes
+
+    """
+
+    unit_metrics = [(np.nan, 0, np.nan, np.nan, np.nan)] * len(unit_ids)
+
+    if all_pcs is None:
+        return unit_metrics
+
+    num_pcs = all_pcs.shape[0];
 #            num_pcs_str = 'cluster_id: ' + repr(cluster_id) + '; num pcs: ' + repr(num_pcs)
 #            print(num_pcs_str)
-            
-            pcs_for_this_unit = all_pcs[all_labels == cluster_id,:].shape[0]   
-            pcs_for_other_units = all_pcs[all_labels != cluster_id, :].shape[0]
-        
-        else:
-            # no near neighbor units to compare
-            num_pcs = 0
-            pcs_for_this_unit = 0
-            pcs_for_other_units = 0
-        
-        
+
+    to_calculate = []
+
+    for idx, unit_id in enumerate(unit_ids):
+
+        pcs_for_this_unit = np.sum(all_labels == unit_id)
+        pcs_for_other_units = num_pcs - pcs_for_this_unit
+
         if num_pcs > 10 and pcs_for_this_unit > 5 and pcs_for_other_units > 5 :
+            to_calculate.append(idx)
 
-            isolation_distances[cluster_id], l_ratios[cluster_id] = mahalanobis_metrics(all_pcs, all_labels, cluster_id)
+    isolation_distances, l_ratios = mahalanobis_metrics_batch(all_pcs, all_labels, [unit_ids[idx] for idx in to_calculate], dtype)
 
-            d_primes[cluster_id] = lda_metrics(all_pcs, all_labels, cluster_id)
+    if nn_cache is not None and len(to_calculate) > 0:
+        nn_hit_rates, nn_miss_rates = nearest_neighbors_metrics_batch(all_pcs, all_labels, [unit_ids[idx] for idx in to_calculate], 
+                                                                      max_spikes_for_nn, n_neighbors, nn_cache, neighborhood_key)
 
-            nn_hit_rates[cluster_id], nn_miss_rates[cluster_id] = nearest_neighbors_metrics(all_pcs, all_labels, cluster_id, max_spikes_for_nn, n_neighbors)
+    for batch_idx, idx in enumerate(to_calculate):
 
+        d_prime = lda_metrics(all_pcs, all_labels, unit_ids[idx])
+
+        if nn_cache is not None:
+            nn_hit_rate, nn_miss_rate = nn_hit_rates[batch_idx], nn_miss_rates[batch_idx]
         else:
+            nn_hit_rate, nn_miss_rate = nearest_neighbors_metrics(all_pcs, all_labels, unit_ids[idx], max_spikes_for_nn, n_neighbors)
 
-            isolation_distances[cluster_id] = np.nan
-            d_primes[cluster_id] = np.nan
-            nn_hit_rates[cluster_id] = np.nan
-            nn_miss_rates[cluster_id] = np.nan
+        unit_metrics[idx] = (isolation_distances[batch_idx], l_ratios[batch_idx], d_prime, nn_hit_rate, nn_miss_rate)
 
-
-    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates 
+    return unit_metrics
 
 
 def calculate_silhouette_score(spike_clusters,
@@ -468,50 +1252,119 @@ def calculate_silhouette_score(spike_clusters,
                                  total_units,                                
                                  pc_features, 
                                  pc_feature_ind,
-                                 total_spikes):
+                                 total_spikes,
+                                 max_block_elements=10000000):
+
+    """ Silhouette score of each unit against its nearest other unit
+
+    A random sample of total_spikes spikes is placed in a common feature space
+    (all PCs on all channels). For every pair of units (i, j), the silhouette
+    score of the sampled spikes from i and j is calculated; each unit gets the 
+    minimum over all pairs that include it.
+
+    Instead of calling sklearn.metrics.silhouette_score for every pair, the 
+    distances between sampled spikes are calculated once, in blocks of rows, 
+    and reduced to the sum of distances from each spike to each unit. The 
+    pairwise scores follow from these sums, so memory use is set by
+    max_block_elements rather than by total_spikes squared.
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    spike_templates : numpy.ndarray (num_spikes x 0)
+        Template IDs for each spike
+    total_units : Int
+        Total number of units
+    pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
+        Pre-computed PCs for blocks of channels around each spike
+    pc_feature_ind : numpy.ndarray (num_units x num_channels)
+        Channel indices of PCs for each unit
+    total_spikes : Int
+        Number of spikes to sample
+    max_block_elements : Int (optional)
+        Maximum size of each block of the spike distance matrix
+
+    Outputs:
+    --------
+    silhouette_score : numpy.ndarray (total_units x 0)
+        Minimum pairwise silhouette score for each unit
+
+    """
     
     # total_spikes = number of spikes to sample, given in the metrics params
 
     random_spike_inds = np.random.permutation(spike_clusters.size)
     random_spike_inds = random_spike_inds[:total_spikes]
     num_pc_features = pc_features.shape[1]
+    max_ind = np.max(pc_feature_ind)
 
-    # initialize array to hold pcs: number of spikes X number of channeles x number of pc features
-    all_pcs = np.zeros((total_spikes, np.max(pc_feature_ind) * num_pc_features + 1))
-
-    for idx, i in enumerate(random_spike_inds):
-        
-        # unit_id = spike_clusters[i]
-        
-        # look up channel using the template id for this spike
-        template_id = spike_templates[i]       
-        channels = pc_feature_ind[template_id,:]
-        
-        # fill pcs into the correct channels for this spike
-        for j in range(0,num_pc_features):
-            all_pcs[idx, channels + np.max(pc_feature_ind) * j] = pc_features[i,j,:]
-
-    cluster_labels = spike_clusters[random_spike_inds]
+    # the score does not depend on the order of the spikes: read them in file
+    # order, then group them by cluster
+    spike_inds = np.sort(random_spike_inds)
+    cluster_labels = np.squeeze(spike_clusters)[spike_inds]
+    by_cluster = np.argsort(cluster_labels, kind='stable')
+    cluster_labels = cluster_labels[by_cluster]
+    spike_pcs = pc_features[spike_inds][by_cluster]
+    spike_inds = spike_inds[by_cluster]
 
-    cluster_ids = np.unique(cluster_labels)
+    # initialize array to hold pcs: number of spikes X number of channeles x number of pc features
+    all_pcs = np.zeros((total_spikes, max_ind * num_pc_features + 1))
+
+    # fill pcs into the correct channels for each spike, using the channels
+    # of its template
+    channels = pc_feature_ind[np.squeeze(spike_templates)[spike_inds], :]
+    columns = channels[:, np.newaxis, :] + max_ind * np.arange(num_pc_features)[np.newaxis, :, np.newaxis]
+    all_pcs[np.arange(total_spikes)[:, np.newaxis, np.newaxis], columns] = spike_pcs
+
+    cluster_ids, cluster_starts, cluster_counts = np.unique(cluster_labels, return_index=True, return_counts=True)
+    label_inds = np.repeat(np.arange(cluster_ids.size), cluster_counts)
+
+    # sum over spikes in unit i of their silhouette value against unit j
+    silhouette_sums = np.zeros((cluster_ids.size, cluster_ids.size))
+
+    sq_norms = np.sum(all_pcs**2, 1)
+    block_size = max(1, int(max_block_elements // max(1, total_spikes)))
+    num_blocks = int(np.ceil(total_spikes / block_size))
+
+    for block_idx, block_start in enumerate(range(0, total_spikes, block_size)):
+
+        printProgressBar(block_idx+1, num_blocks)
+
+        block_end = min(block_start + block_size, total_spikes)
+        rows = np.arange(block_end - block_start)
+        block_labels = label_inds[block_start:block_end]
+
+        # euclidean distances from the spikes in this block to all spikes
+        dist = np.dot(all_pcs[block_start:block_end], all_pcs.T)
+        dist *= -2
+        dist += sq_norms[block_start:block_end, np.newaxis]
+        dist += sq_norms[np.newaxis, :]
+        np.maximum(dist, 0, out=dist)
+        dist[rows, rows + block_start] = 0
+        np.sqrt(dist, out=dist)
+
+        # mean distance to each unit; for the spike's own unit, leave out the 
+        # spike itself (undefined for single-spike units)
+        mean_dist = np.add.reduceat(dist, cluster_starts, axis=1) / cluster_counts
+        own_counts = cluster_counts[block_labels]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            intra = mean_dist[rows, block_labels] * own_counts / (own_counts - 1)
+            sil = (mean_dist - intra[:, np.newaxis]) / np.maximum(mean_dist, intra[:, np.newaxis])
+        sil = np.nan_to_num(sil)
+
+        # rows are sorted by unit, so sum them per unit in one reduction
+        unit_starts = np.flatnonzero(np.diff(block_labels, prepend=-1))
+        silhouette_sums[block_labels[unit_starts]] += np.add.reduceat(sil, unit_starts, axis=0)
+
+    # score for each pair = mean silhouette value over the spikes of both units
+    pair_counts = cluster_counts[:, np.newaxis] + cluster_counts[np.newaxis, :]
+    pair_scores = (silhouette_sums + silhouette_sums.T) / pair_counts
+    pair_scores[np.tril(np.ones(pair_scores.shape, dtype=bool)) | (pair_counts <= 2)] = np.nan
 
     SS = np.empty((total_units, total_units))
     SS[:] = np.nan
-
-    for idx1, i in enumerate(cluster_ids):
-
-        printProgressBar(idx1+1, len(cluster_ids))
-        
-        for idx2, j in enumerate(cluster_ids):
-            
-            if j > i:
-                # positions of cluster labels = i or j
-                inds = np.in1d(cluster_labels, np.array([i,j]))
-                X = all_pcs[inds,:]
-                labels = cluster_labels[inds]
-                
-                if len(labels) > 2:
-                    SS[i,j] = silhouette_score(X, labels)
+    SS[np.ix_(cluster_ids, cluster_ids)] = pair_scores
 
     with warnings.catch_warnings():
       warnings.simplefilter("ignore")
@@ -530,7 +1383,53 @@ def calculate_drift_metrics(spike_times,
                             pc_feature_ind,
                             channel_pos,
                             interval_length,
-                            min_spikes_per_interval):
+                            min_spikes_per_interval,
+                            return_median_depths=False):
+
+    """ Drift of each unit's depth over the recording
+
+    Spikes are binned into intervals of interval_length seconds. The median
+    depth of each unit in each interval (with at least min_spikes_per_interval
+    spikes) is found for all units at once: every spike gets a (unit, interval)
+    key, and one lexsort by key and depth puts each group's median at a known
+    position.
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    spike_templates : numpy.ndarray (num_spikes x 0)
+        Template IDs for each spike
+    unit_template_ids : numpy.ndarray (total_units x 0)
+        Majority template for each unit
+    total_units : Int
+        Total number of units
+    pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
+        Pre-computed PCs for blocks of channels around each spike
+    pc_feature_ind : numpy.ndarray (num_units x num_channels)
+        Channel indices of PCs for each unit
+    channel_pos : numpy.ndarray (num_channels x 2)
+        X and Z coordinates of each channel
+    interval_length : Float
+        Length of each interval in seconds
+    min_spikes_per_interval : Int
+        Minimum number of spikes for an interval to have a median depth
+    return_median_depths : Bool (optional)
+        If True, also return the median depth of each unit in each interval
+
+    Outputs:
+    --------
+    max_drift : numpy.ndarray (total_units x 0)
+        Range of median depths for each unit
+    cumulative_drift : numpy.ndarray (total_units x 0)
+        Sum of changes in median depth between intervals for each unit
+    median_depths (optional) : numpy.ndarray (total_units x num_intervals)
+        Median depth of each unit in each interval; NaN for intervals with too
+        few spikes
+
+    """
 
     max_drift = np.zeros((total_units,))
     cumulative_drift = np.zeros((total_units,))
@@ -558,53 +1457,86 @@ def calculate_drift_metrics(spike_times,
     m_spike_clusters = spike_clusters[match_maj]
     m_spike_times = spike_times[match_maj]
     
-    # same for pc_features, but we only need the first pc for each
-    # this operation makes a copy of pc_features so original is not altered
-    m_pc_features_sq = np.squeeze(pc_features[match_maj,0,:]);
-    # set negative pc_features to zero before taking square
-    m_pc_features_sq[m_pc_features_sq < 0] = 0
-    # elementwise square
-    m_pc_features_sq = pow(m_pc_features_sq, 2) 
-    
-#    currmem = psutil.Process().memory_info().rss / (1024 * 1024)
-#    print("psutil memory info after copies: " + repr(currmem))
-    
-#    send only
-    
-    depths = get_spike_depths(m_spike_clusters, unit_template_ids, m_pc_features_sq, pc_feature_ind, channel_pos)
+    # depths need only the first pc for each spike; these are read from
+    # pc_features in chunks (which may be memmapped), so the original is not 
+    # altered and no copy of the full pc_features[match_maj,0,:] is made
+    depths = get_spike_depths_from_pcs(pc_features, spike_clusters, unit_template_ids, pc_feature_ind, channel_pos, match_maj)
     
     interval_starts = np.arange(np.min(spike_times), np.max(spike_times), interval_length)
     interval_ends = interval_starts + interval_length
+    num_intervals = interval_starts.size
 
-    cluster_ids = np.unique(m_spike_clusters)
+    # interval for each spike: the last start before the spike, as long as 
+    # the spike is also before that interval's end (spikes exactly on an 
+    # interval boundary are not counted)
+    spike_intervals = np.searchsorted(interval_starts, m_spike_times, side='left') - 1
+    in_interval = spike_intervals >= 0
+    in_interval[in_interval] = m_spike_times[in_interval] < interval_ends[spike_intervals[in_interval]]
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    keys = m_spike_clusters[in_interval].astype('int64') * num_intervals + spike_intervals[in_interval]
 
-        printProgressBar(idx+1, len(cluster_ids))
+    medians, counts = grouped_median(keys, depths[in_interval], total_units * num_intervals)
 
-        in_cluster = m_spike_clusters == cluster_id
-        times_for_cluster = m_spike_times[in_cluster]
-        depths_for_cluster = depths[in_cluster]
+    median_depths = np.reshape(medians, (total_units, num_intervals))
+    median_depths[np.reshape(counts, (total_units, num_intervals)) < min_spikes_per_interval] = np.nan
 
-        median_depths = []
+    cluster_ids = np.unique(m_spike_clusters)
+    unit_depths = median_depths[cluster_ids, :]
 
-        for t1, t2 in zip(interval_starts, interval_ends):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        max_drift[cluster_ids] = np.around(np.nanmax(unit_depths, 1) - np.nanmin(unit_depths, 1),2)
+    cumulative_drift[cluster_ids] = np.around(np.nansum(np.abs(np.diff(unit_depths, axis=1)), 1),2)
 
-            in_range = (times_for_cluster > t1) * (times_for_cluster < t2)
-            
-            if np.sum(in_range) >= min_spikes_per_interval:
-                median_depths.append(np.median(depths_for_cluster[in_range]))
-            else:
-                median_depths.append(np.nan)
-            
-        median_depths = np.array(median_depths)
-            
-        max_drift[cluster_id] = np.around(np.nanmax(median_depths) - np.nanmin(median_depths),2)
-        cumulative_drift[cluster_id] = np.around(np.nansum(np.abs(np.diff(median_depths))),2)
+    if return_median_depths:
+        return max_drift, cumulative_drift, median_depths
 
     return max_drift, cumulative_drift
 
 
+def grouped_median(keys, values, num_groups):
+
+    """ Median of values for each group key, computed with one lexsort
+
+    Inputs:
+    -------
+    keys : numpy.ndarray (N x 0)
+        Integer group key (0 to num_groups - 1) for each value
+    values : numpy.ndarray (N x 0)
+        Values to take medians of
+    num_groups : Int
+        Total number of groups
+
+    Outputs:
+    --------
+    medians : numpy.ndarray (num_groups x 0)
+        Median for each group; NaN for empty groups
+    counts : numpy.ndarray (num_groups x 0)
+        Number of values in each group
+
+    """
+
+    order = np.lexsort((values, keys))
+    sorted_values = values[order]
+
+    counts = np.bincount(keys, minlength=num_groups)
+    starts = np.cumsum(counts) - counts
+
+    medians = np.full((num_groups,), np.nan)
+    has_values = counts > 0
+
+    # same as np.median: the middle value, or the mean of the two middle values
+    lower = sorted_values[starts[has_values] + (counts[has_values] - 1) // 2]
+    upper = sorted_values[starts[has_values] + counts[has_values] // 2]
+    medians[has_values] = np.mean(np.stack((lower, upper)), 0)
+
+    # as with np.median, any NaN in a group makes its median NaN
+    has_nan = np.bincount(keys, weights=np.isnan(values), minlength=num_groups) > 0
+    medians[has_nan] = np.nan
+
+    return medians, counts
+
+
 # ==========================================================
 
 # IMPLEMENTATION OF ACTUAL METRICS:
@@ -751,7 +1683,49 @@ def amplitude_cutoff(amplitudes, num_histogram_bins = 500, histogram_smoothing_v
     return fraction_missing
 
 
-def mahalanobis_metrics(all_pcs, all_labels, this_unit_id):
+def amplitude_cutoff_batch(sorted_amplitudes, starts, ends, num_histogram_bins = 500, histogram_smoothing_value = 3):
+
+    """ amplitude_cutoff for many groups of amplitudes at once
+
+    The histograms of all groups are built together (grouped_histograms) and 
+    smoothed along the bin axis in one call, and the tails above G are summed
+    for all groups at once; the result for each group is the same as
+    amplitude_cutoff on its amplitudes, up to the rounding of that sum.
+
+    Input:
+    ------
+    sorted_amplitudes : numpy.ndarray
+        Amplitudes of all groups, e.g. in the cluster order of a ClusterIndex
+    starts, ends : numpy.ndarray (num_groups x 0)
+        Range of sorted_amplitudes in each (non-empty) group
+
+    Output:
+    -------
+    fraction_missing : numpy.ndarray (num_groups x 0)
+
+    """
+
+    counts, edges = grouped_histograms(sorted_amplitudes, starts, ends, num_histogram_bins)
+
+    # np.histogram(..., density=True)
+    h = counts / np.diff(edges, axis=1) / np.sum(counts, 1, keepdims=True)
+
+    pdf = gaussian_filter1d(h, histogram_smoothing_value, axis=1)
+    support = edges[:, :-1]
+
+    peak_index = np.argmax(pdf, 1)
+    distance_to_first = np.abs(pdf - pdf[:, :1])
+    distance_to_first[np.arange(pdf.shape[1])[np.newaxis, :] < peak_index[:, np.newaxis]] = np.inf
+    G = np.argmin(distance_to_first, 1)
+
+    bin_size = np.mean(np.diff(support, axis=1), 1)
+    tail = np.arange(pdf.shape[1])[np.newaxis, :] >= G[:, np.newaxis]
+    fraction_missing = np.sum(np.where(tail, pdf, 0), 1) * bin_size
+
+    return np.minimum(fraction_missing, 0.5)
+
+
+def mahalanobis_metrics(all_pcs, all_labels, this_unit_id, dtype=None):
 
     """ Calculates isolation distance and L-ratio (metrics computed from Mahalanobis distance)
 
@@ -765,6 +1739,8 @@ def mahalanobis_metrics(all_pcs, all_labels, this_unit_id):
         1D array of cluster labels for all spikes
     this_unit_id : Int
         number corresponding to unit for which these metrics will be calculated
+    dtype : numpy dtype (optional)
+        Precision of the calculation, e.g. 'float32'; defaults to float64
 
     Outputs:
     --------
@@ -774,44 +1750,74 @@ def mahalanobis_metrics(all_pcs, all_labels, this_unit_id):
         L-ratio for this unit
 
     """
-    
-    pcs_for_this_unit = all_pcs[all_labels == this_unit_id,:]
-     
-    pcs_for_other_units = all_pcs[all_labels != this_unit_id, :]   
-    
-    mean_value = np.expand_dims(np.mean(pcs_for_this_unit,0),0)
-    
-    try:
-        VI = np.linalg.inv(np.cov(pcs_for_this_unit.T))
-    except np.linalg.linalg.LinAlgError: # case of singular matrix
-        return np.nan, np.nan
 
-    mahalanobis_other = np.sort(cdist(mean_value,
-                       pcs_for_other_units,
-                       'mahalanobis', VI = VI)[0])
-    
+    isolation_distances, l_ratios = mahalanobis_metrics_batch(all_pcs, all_labels, [this_unit_id], dtype)
 
-    
-##    mahalanobis_self = np.sort(cdist(mean_value,
-#                             pcs_for_this_unit,
-#                             'mahalanobis', VI = VI)[0])
-    
-    n = np.min([pcs_for_this_unit.shape[0], pcs_for_other_units.shape[0]]) # number of spikes
+    return isolation_distances[0], l_ratios[0]
 
-    if n >= 2:
-        
-        dof = pcs_for_this_unit.shape[1] # number of features
-        
-        l_ratio = np.sum(1 - chi2.cdf(pow(mahalanobis_other,2), dof)) / mahalanobis_other.shape[0]
-        isolation_distance = pow(mahalanobis_other[n-1],2)
 
-    else:
-        l_ratio = np.nan 
-        isolation_distance = np.nan 
-    
-    return isolation_distance, l_ratio
+def mahalanobis_metrics_batch(all_pcs, all_labels, unit_ids, dtype=None):
+
+    """ Isolation distance and L-ratio for several units that share the same set of spikes
+
+    Instead of inverting each unit's covariance matrix and calling cdist, the
+    covariance is factored as L * L.T (Cholesky), and the squared Mahalanobis
+    distance of each spike is the squared norm of L^-1 * (x - mean), from one
+    triangular solve. A covariance matrix that is not positive definite gives
+    NaN, as a singular matrix did before.
+
+    Inputs:
+    -------
+    all_pcs : numpy.ndarray (num_spikes x PCs)
+        2D array of PCs for all spikes
+    all_labels : numpy.ndarray (num_spikes x 0)
+        1D array of cluster labels for all spikes
+    unit_ids : list or numpy.ndarray
+        Units for which these metrics will be calculated
+    dtype : numpy dtype (optional)
+        Precision of the calculation, e.g. 'float32'; defaults to float64
+
+    Outputs:
+    --------
+    isolation_distances : numpy.ndarray (num units x 0)
+    l_ratios : numpy.ndarray (num units x 0)
+
+    """
+
+    dtype = np.dtype('float64' if dtype is None else dtype)
+    all_pcs = all_pcs.astype(dtype, copy = False)
+
+    isolation_distances = np.full((len(unit_ids),), np.nan)
+    l_ratios = np.full((len(unit_ids),), np.nan)
+
+    for idx, unit_id in enumerate(unit_ids):
+
+        this_unit = all_labels == unit_id
+
+        pcs_for_this_unit = all_pcs[this_unit,:]
+        pcs_for_other_units = all_pcs[~this_unit,:]
+
+        n = np.min([pcs_for_this_unit.shape[0], pcs_for_other_units.shape[0]]) # number of spikes
+
+        if n < 2:
+            continue
+
+        mean_value = np.mean(pcs_for_this_unit, 0)
+
+        try:
+            L = np.linalg.cholesky(np.cov(pcs_for_this_unit.T, dtype = dtype))
+        except np.linalg.LinAlgError: # case of singular matrix
+            continue
+
+        whitened = solve_triangular(L, (pcs_for_other_units - mean_value).T, lower = True, check_finite = False)
+        mahalanobis_other_sq = np.sort(np.sum(whitened**2, 0))
+
+        dof = pcs_for_this_unit.shape[1] # number of features
 
+        l_ratios[idx] = np.sum(chi2.sf(mahalanobis_other_sq, dof)) / mahalanobis_other_sq.shape[0]
+        isolation_distances[idx] = mahalanobis_other_sq[n-1]
 
+    return isolation_distances, l_ratios
 
 
 def lda_metrics(all_pcs, all_labels, this_unit_id):
@@ -911,13 +1917,86 @@ def nearest_neighbors_metrics(all_pcs, all_labels, this_unit_id, max_spikes_for_
     
     return hit_rate, miss_rate
 
+def nearest_neighbors_metrics_batch(all_pcs, all_labels, unit_ids, max_spikes_for_nn, n_neighbors, nn_cache, neighborhood_key=None):
+
+    """ nn_hit_rate and nn_miss_rate for several units from one nearest-neighbor search
+
+    Same metrics as nearest_neighbors_metrics, but the search is done once over
+    all spikes (through nn_cache) and each unit reads its rates from the 
+    neighbor labels. If there are more than max_spikes_for_nn spikes, 
+    nearest_neighbors_metrics subsamples a different ordering of the spikes 
+    for each unit (its own spikes first), so the search is then done for each
+    unit separately, on that same subsample, and not kept in the cache. With 
+    exact search the results are those of nearest_neighbors_metrics.
+
+    Inputs:
+    -------
+    all_pcs : numpy.ndarray (num_spikes x PCs)
+        2D array of PCs for all spikes
+    all_labels : numpy.ndarray (num_spikes x 0)
+        1D array of cluster labels for all spikes
+    unit_ids : list or numpy.ndarray
+        Units for which these metrics will be calculated
+    max_spikes_for_nn : Int
+        number of spikes to use (calculation can be very slow when this number is >20000)
+    n_neighbors : Int
+        number of neighbors to use
+    nn_cache : NeighborhoodIndexCache
+        Cache of nearest-neighbor searches
+    neighborhood_key : hashable (optional)
+        Key of this set of spikes in nn_cache; None if it is not shared
+
+    Outputs:
+    --------
+    hit_rates : numpy.ndarray (num units x 0)
+    miss_rates : numpy.ndarray (num units x 0)
+
+    """
+
+    total_spikes = all_pcs.shape[0]
+    ratio = max_spikes_for_nn / total_spikes
+
+    hit_rates = np.zeros((len(unit_ids),))
+    miss_rates = np.zeros((len(unit_ids),))
+
+    if ratio < 1:
+        # same subsample as nearest_neighbors_metrics: this unit's spikes first
+        for idx, unit_id in enumerate(unit_ids):
+
+            this_unit = all_labels == unit_id
+
+            X = np.concatenate((all_pcs[this_unit,:], all_pcs[np.invert(this_unit),:]),0)
+            inds = np.arange(0,X.shape[0]-1,1/ratio).astype('int')
+            n = int(np.sum(this_unit) * ratio)
+
+            indices = nn_cache.neighbors(None, X[inds,:], n_neighbors)
+
+            hit_rates[idx] = np.mean(indices[:n,1:] < n)
+            miss_rates[idx] = np.mean(indices[n:,1:] < n)
+
+        return hit_rates, miss_rates
+
+    indices = nn_cache.neighbors(neighborhood_key, all_pcs, n_neighbors)
+
+    # first neighbor of each spike is the spike itself
+    neighbor_labels = all_labels[indices[:,1:]]
+
+    for idx, unit_id in enumerate(unit_ids):
+
+        this_unit = all_labels == unit_id
+
+        hit_rates[idx] = np.mean(neighbor_labels[this_unit,:] == unit_id)
+        miss_rates[idx] = np.mean(neighbor_labels[~this_unit,:] == unit_id)
+
+    return hit_rates, miss_rates
+
 # ==========================================================
 
 # HELPER FUNCTIONS:
 
 # ==========================================================
 
-def make_index_mask(spike_clusters, unit_id, min_num, max_num):
+def make_index_mask(spike_clusters, unit_id, min_num, max_num, cluster_index=None, rng=None):
 
     """ Create a mask for the spike index dimensions of the pc_features array  
 
@@ -931,14 +2010,29 @@ def make_index_mask(spike_clusters, unit_id, min_num, max_num):
         Minimum number of spikes to return; if there are not enough spikes for this unit, return all False
     max_num : Int
         Maximum number of spikes to return; if too many spikes for this unit, return a random subsample
+    cluster_index : ClusterIndex (optional)
+        Index of spike_clusters; if given, the selected spikes are returned as
+        sorted integer indices instead of a full-length boolean mask
+    rng : numpy.random.Generator (optional)
+        Source of the random subsample; defaults to the global numpy random state
 
     Output:
     -------
-    index_mask : numpy.ndarray (boolean)
+    index_mask : numpy.ndarray (boolean, or int if cluster_index is given)
         Mask of spike indices for pc_features array
 
     """
     
+    permutation = np.random.permutation if rng is None else rng.permutation
+
+    if cluster_index is not None:
+        # same random draw as the boolean version, without touching all spikes
+        inds = cluster_index.indices(unit_id)
+        if len(inds) < min_num:
+            return np.zeros((0,), dtype='int64')
+        order = permutation(inds.size)
+        return np.sort(inds[order[:max_num]])
+
     index_mask = spike_clusters == unit_id
         
     inds = np.where(index_mask)[0]
@@ -947,7 +2041,7 @@ def make_index_mask(spike_clusters, unit_id, min_num, max_num):
         index_mask = np.zeros((spike_clusters.size,), dtype='bool')
     else:
         index_mask = np.zeros((spike_clusters.size,), dtype='bool')
-        order = np.random.permutation(inds.size)
+        order = permutation(inds.size)
         index_mask[inds[order[:max_num]]] = True
         
     return index_mask
@@ -1014,8 +2108,8 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
     -------
     these_pc_features : numpy.ndarray (float)
         Array of pre-computed PC features (num_spikes x num_PCs x num_channels)
-    index_mask : numpy.ndarray (boolean)
-        Mask for spike index dimension of pc_features array
+    index_mask : numpy.ndarray (boolean or int)
+        Mask (or sorted indices) for spike index dimension of pc_features array
     channel_mask : numpy.ndarray (boolean)
         Mask for channel index dimension of pc_features array
 
@@ -1026,6 +2120,13 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
 
     """
 
+    # work with indices so that only this unit's spikes are examined
+    if index_mask.dtype == bool:
+        spike_inds = np.flatnonzero(index_mask)
+    else:
+        spike_inds = index_mask
+    unit_templates = np.squeeze(spike_templates)[spike_inds]
+
     # start with an empty 3D array
     [nspike,npcs,nchan] = these_pc_features.shape
     
@@ -1035,11 +2136,11 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
     
     # get list of templates included in this cluster
     # for data with no curation, there will just be one value   
-    template_ids = np.unique(spike_templates[index_mask])
+    template_ids = np.unique(unit_templates)
     
     # for each template id, create a channel mask (if possible) and extract templates
     for tid in template_ids:
-        curr_idx = index_mask & (spike_templates == tid)
+        curr_idx = spike_inds[unit_templates == tid]
         try:
             channel_mask = make_channel_mask(tid, pc_feature_ind, channels_to_use)            
         except IndexError:
@@ -1054,7 +2155,7 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
     return unit_PCs
 
 
-def ccg(st1, st2, nbins, tbin, auto):
+def ccg(st1, st2, nbins, tbin, auto, max_pairs_per_block=1000000):
     
     """ calculate crosscorrelogram between two sets of spike times (st1, st2)
         in seconds, with bin width tbin, time lags = plus/minus nbins.
@@ -1064,6 +2165,7 @@ def ccg(st1, st2, nbins, tbin, auto):
     st2 : spike times for set #2 in sec
     nbins : ccg will be calculated for 2*nbins + 1, 
     tbin : bin width in seconds
+    max_pairs_per_block : number of spike pairs to bin at a time (bounds memory use)
     
     output:
         
@@ -1081,35 +2183,37 @@ def ccg(st1, st2, nbins, tbin, auto):
     
     T = max(np.max(st1),np.max(st2)) - min(np.min(st1),np.min(st2))
     
-    # traverse both spike trains together, keeping track of the spikes in the first
-    # spike train that are within dt of the second spike train
-    ilow = 0
-    ihigh = 0
-    j = 0
-    
     n_st2 = len(st2)
     n_st1 = len(st1)
     
     K = np.zeros((2*nbins+1,))
     
-    while j < n_st2:                      # walk over all spikes in 2nd spike train
-        while (ihigh < n_st1) and (st1[ihigh] < st2[j]+dt):            
-            ihigh = ihigh + 1             # increase upper bound until its outisde the dt range
-        while (ilow < n_st1) and (st1[ilow] <= st2[j]-dt):
-            ilow = ilow + 1                # increase lower bound until it is inside the dt range
-        if ilow > n_st1:
-            break
-        if st1[ilow] > st2[j] + dt:
-            # if the lower bound is actually outside of the dt range, means
-            # there were no spikes in range of the ccg
-            # just move on to next spike st2
-            j = j + 1
-            continue
-        for k in range(ilow,ihigh):
-            # for all spikes within the plus/minus dt range
-            ibin = int(np.round((st2[j]-st1[k])/tbin))    # calculate which bin
-            K[ibin + nbins] = K[ibin + nbins] + 1    # increment corresponding bin in correlogram
-        j = j + 1   # go to next spike in st2
+    # for each spike in the 2nd spike train, the spikes in the first spike
+    # train that are within dt: st2[j] - dt < st1[k] < st2[j] + dt
+    # (same bounds as the original walk over both trains)
+    ilow = np.searchsorted(st1, st2 - dt, side='right')
+    ihigh = np.searchsorted(st1, st2 + dt, side='left')
+    pair_counts = np.maximum(ihigh - ilow, 0)
+    cum_counts = np.cumsum(pair_counts)
+    
+    # bin the lag differences in blocks of spikes from st2, so that at most
+    # ~max_pairs_per_block differences are held in memory at once
+    j = 0
+    while j < n_st2:
+        done = cum_counts[j-1] if j > 0 else 0
+        j_end = max(np.searchsorted(cum_counts, done + max_pairs_per_block, side='right'), j + 1)
+        
+        counts = pair_counts[j:j_end]
+        total = cum_counts[j_end-1] - done
+        
+        if total > 0:
+            first_pair = np.cumsum(counts) - counts
+            j_ind = np.repeat(np.arange(j, j_end), counts)
+            k_ind = np.repeat(ilow[j:j_end] - first_pair, counts) + np.arange(total)
+            ibin = np.round((st2[j_ind]-st1[k_ind])/tbin).astype('int64')    # calculate which bin
+            K = K + np.bincount(ibin + nbins, minlength=2*nbins+1)    # increment corresponding bins in correlogram
+        
+        j = j_end
         
     if auto:
         # print('nspikes, zero bin: ' + repr(n_st1) + ', ' + repr(K[nbins]))
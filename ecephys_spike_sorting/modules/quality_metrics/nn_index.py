@@ -0,0 +1,120 @@
+from collections import OrderedDict
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class NeighborhoodIndexCache():
+
+    """
+    KD-trees over the spikes of channel neighborhoods, with LRU eviction
+
+    Units that share a peak channel (and are used without subsampling) are
+    compared against the same set of spikes, so the nearest-neighbor index
+    over that set only has to be built once. For each neighborhood one KD-tree
+    (scipy cKDTree) is built over its spikes and queried for all of them at
+    once; the tree and the neighbor indices are kept so that every unit in the
+    neighborhood reads its hit and miss rates from the same result.
+
+    At most max_neighborhoods trees are kept; the least recently used one is
+    dropped when a new neighborhood is added.
+
+    Exact search (eps = 0) returns the same neighbors as the ball tree of
+    nearest_neighbors_metrics (up to the order of points at exactly equal
+    distances). Approximate mode (eps > 0) passes eps to the KD-tree query:
+    the k-th neighbor returned is guaranteed to be no further than (1 + eps)
+    times the distance to the true k-th nearest neighbor. Neighbors can
+    therefore only be swapped for points at most a factor (1 + eps) further
+    away, which changes nn_hit_rate and nn_miss_rate only for spikes near the
+    boundary between units. Use it for quick-look QC.
+
+    """
+
+    def __init__(self, max_neighborhoods=16, eps=0):
+
+        """
+        max_neighborhoods : int
+            Number of neighborhoods whose trees are kept
+        eps : float
+            Approximation factor for the KD-tree search (0 for exact search)
+        """
+
+        self.max_neighborhoods = max_neighborhoods
+        self.eps = eps
+        self.hits = 0
+        self.misses = 0
+
+        self._neighborhoods = OrderedDict()
+
+    def tree(self, key, points):
+
+        """ KD-tree over points, built once for each key
+
+        Inputs:
+        -------
+        key : hashable or None
+            Identifies the set of points (e.g. peak channel); None if the set
+            is not shared, in which case the tree is not kept
+        points : numpy.ndarray (num_points x num_features)
+            Points in the tree
+
+        Outputs:
+        --------
+        tree : scipy.spatial.cKDTree
+
+        """
+
+        return self._entry(key, points)['tree']
+
+    def neighbors(self, key, points, n_neighbors):
+
+        """ Indices of the n_neighbors nearest points to every point
+
+        The first neighbor of each point is normally the point itself.
+
+        Inputs:
+        -------
+        key : hashable or None
+            Identifies the set of points (e.g. peak channel); None if the set
+            is not shared, in which case the result is not kept
+        points : numpy.ndarray (num_points x num_features)
+            Points to search
+        n_neighbors : int
+            Number of neighbors to return for each point
+
+        Outputs:
+        --------
+        indices : numpy.ndarray (num_points x n_neighbors)
+
+        """
+
+        entry = self._entry(key, points)
+
+        if n_neighbors not in entry['indices']:
+            k = min(n_neighbors, points.shape[0])
+            distances, indices = entry['tree'].query(points, k = k, eps = self.eps)
+            entry['indices'][n_neighbors] = np.reshape(indices, (points.shape[0], -1))
+
+        return entry['indices'][n_neighbors]
+
+    def clear(self):
+
+        self._neighborhoods.clear()
+
+    def _entry(self, key, points):
+
+        if key is not None and key in self._neighborhoods:
+            self._neighborhoods.move_to_end(key)
+            self.hits += 1
+            return self._neighborhoods[key]
+
+        self.misses += 1
+
+        entry = {'tree' : cKDTree(points), 'indices' : {}}
+
+        if key is not None and self.max_neighborhoods > 0:
+            self._neighborhoods[key] = entry
+            while len(self._neighborhoods) > self.max_neighborhoods:
+                self._neighborhoods.popitem(last = False)
+
+        return entry
@@ -100,6 +100,9 @@ def createInputJson(
     ks_nNeighbors_sites_fix=0,
     ks4_duplicate_spike_ms=0.25,
     ks4_min_template_size_um=10,
+    chrome_trace_file=None,
+    metrics_format="csv",
+    c_waves_engine="external",
 ):
 
     # hard coded paths to code on your computer and system
@@ -262,13 +265,16 @@ def createInputJson(
         "waveform_metrics": {
             "waveform_metrics_file": os.path.join(
                 kilosort_output_directory, "waveform_metrics.csv"
-            )
+            ),
+            "metrics_format": metrics_format,
         },
         "cluster_metrics": {
             "cluster_metrics_file": os.path.join(
                 kilosort_output_directory, "metrics.csv"
-            )
+            ),
+            "metrics_format": metrics_format,
         },
+        "instrumentation_params": {"chrome_trace_file": chrome_trace_file},
         "ephys_params": {
             "probe_type": probe_type,
             "sample_rate": sample_rate,
@@ -401,6 +407,7 @@ def createInputJson(
             "align_avg_waveform": False,
             "remove_duplicates": True,
             "cWaves_path": cWaves_path,
+            "c_waves_engine": c_waves_engine,
             "within_unit_overlap_window": 0.00017,
             "between_unit_overlap_window": 0.00041,
             "between_unit_dist_um": 66,
@@ -419,6 +426,7 @@ def createInputJson(
             "site_range": wm_site_range,
             "cWaves_path": cWaves_path,
             "use_C_Waves": True,
+            "c_waves_engine": c_waves_engine,
             "snr_radius": c_waves_radius_sites,
             "snr_radius_um": c_Waves_snr_um,
             "nAP": nAP,
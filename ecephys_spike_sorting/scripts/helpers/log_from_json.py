@@ -7,6 +7,8 @@ from pathlib import Path
 from tkinter import Tk
 from tkinter import filedialog
 
+from ecephys_spike_sorting.common.instrumentation import flatten_spans
+
 # Fill in a predefined row of a log table
 # Entries are:
 # session name (run_probe); number of clusters, number of spikes,
@@ -68,6 +70,47 @@ def addEntry(modules, jsondir, session_id, logFullPath):
     with open(logFullPath, 'a') as log:
         log.write(log_entry_str + '\n')
 
+    addSpanEntries(modules, jsondir, session_id, spanLogPath(logFullPath))
+
+
+# Stage timing log, next to the main log: one row per span recorded in the
+# module output jsons (modules run before spans were added have none)
+#
+def spanLogPath(logFullPath):
+    logStem, logExt = os.path.splitext(logFullPath)
+    return logStem + '_spans' + logExt
+
+
+def addSpanEntries(modules, jsondir, session_id, spanLogFullPath):
+
+    sep = ','
+    rows = []
+
+    for module in modules:
+        jsonFile = os.path.join(jsondir, session_id + '-' + module + '-output.json')
+        if not os.path.isfile(jsonFile):
+            continue
+        with open(jsonFile) as currJson:
+            modData = json.load(currJson)
+        if 'spans' not in modData:
+            continue
+        for path, span in flatten_spans(modData['spans']):
+            values = [session_id, module, path, span['start'], span['duration'],
+                      span['peak_rss_delta'], span['read_bytes'], span['write_bytes']]
+            rows.append(sep.join(['None' if v is None else
+                                  ('{:.3f}'.format(v) if isinstance(v, float) else str(v))
+                                  for v in values]))
+
+    if len(rows) == 0:
+        return
+
+    if not os.path.isfile(spanLogFullPath):
+        with open(spanLogFullPath, 'w') as log:
+            log.write('session_id,module,span,start_s,duration_s,peak_rss_delta_bytes,read_bytes,write_bytes\n')
+
+    with open(spanLogFullPath, 'a') as log:
+        log.write('\n'.join(rows) + '\n')
+
 
 # write header to file
 def writeHeader(logFullPath):
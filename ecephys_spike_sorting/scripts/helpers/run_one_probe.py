@@ -1,7 +1,11 @@
+import importlib
 import os
 import shutil
 import subprocess
 import sys
+import warnings
+
+from ecephys_spike_sorting.common.dataset_context import DatasetContext
 
 try:
     import log_from_json
@@ -11,6 +15,16 @@ except ModuleNotFoundError:
 # Given json files for CatGT and modules, all processing unique to this
 # recording session and probe
 
+# modules that read the sorted Kilosort output and can share it in one process;
+# the helpers (CatGT, Kilosort, TPrime, ...) always run in their own process, as
+# they load MATLAB or GPU state that should not stay in the pipeline process
+IN_PROCESS_MODULES = (
+    "kilosort_postprocessing",
+    "noise_templates",
+    "mean_waveforms",
+    "quality_metrics",
+)
+
 
 def runOne(
     session_id,
@@ -22,7 +36,18 @@ def runOne(
     modules,
     module_input_json,
     logFullPath,
+    in_process=False,
 ):
+    """
+    Run CatGT and a list of modules for one probe
+
+    With in_process=True the modules in IN_PROCESS_MODULES are run in this
+    process instead of each in a new python process, sharing one
+    DatasetContext, so Kilosort outputs loaded by one module (e.g.
+    kilosort_postprocessing) are reused by the next ones. Other modules still
+    run in their own process. The output json files are the same either way.
+
+    """
 
     if run_CatGT:
         command = (
@@ -48,22 +73,66 @@ def runOne(
         except FileNotFoundError:
             print("Could not copy module input json file to data directory")
 
-    for module in modules:
-        output_json = os.path.join(
-            json_directory, session_id + "-" + module + "-output.json"
-        )
-        command = (
-            sys.executable
-            + " -W ignore -m ecephys_spike_sorting.modules."
-            + module
-            + " --input_json "
-            + module_input_json
-            + " --output_json "
-            + output_json
-        )
-        print(command)
-        subprocess.check_call(command.split(" "))
+    with DatasetContext() as context:
+        for module in modules:
+            output_json = os.path.join(
+                json_directory, session_id + "-" + module + "-output.json"
+            )
+            if in_process and module in IN_PROCESS_MODULES:
+                # drop data read from files rewritten by the previous modules
+                # without going through the shared datasets
+                context.refresh()
+                runModule(module, module_input_json, output_json)
+            else:
+                command = (
+                    sys.executable
+                    + " -W ignore -m ecephys_spike_sorting.modules."
+                    + module
+                    + " --input_json "
+                    + module_input_json
+                    + " --output_json "
+                    + output_json
+                )
+                print(command)
+                subprocess.check_call(command.split(" "))
 
     log_from_json.addEntry(
         modules, json_directory, session_id, logFullPath
     )  # -*- coding: utf-8 -*-
+
+
+def runModule(module, input_json, output_json):
+    """
+    Run the main() of a module in this process, as python -W ignore -m would
+
+    Inputs:
+    -------
+    module : String
+        Name of the module in ecephys_spike_sorting.modules
+    input_json : String
+        Path to the module input json file
+    output_json : String
+        Path of the output json file written by the module
+
+    """
+
+    module_main = importlib.import_module(
+        "ecephys_spike_sorting.modules." + module + ".__main__"
+    )
+
+    print("running " + module + " in process, output json: " + output_json)
+
+    argv = sys.argv
+    sys.argv = [
+        module_main.__file__,
+        "--input_json",
+        input_json,
+        "--output_json",
+        output_json,
+    ]
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            module_main.main()
+    finally:
+        sys.argv = argv
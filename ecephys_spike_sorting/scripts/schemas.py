@@ -137,6 +137,11 @@ class SglxMultiRunPipelineParams(Schema):
     run_quality_metrics = Boolean(
         required=False, description="Run Quality Metrics module", missing=True
     )
+    run_in_process = Boolean(
+        required=False,
+        description="Run the post-sorting modules (kilosort_postprocessing, noise_templates, mean_waveforms, quality_metrics) in this process, sharing loaded Kilosort outputs; by default, and for the other modules always, each module runs in its own process",
+        missing=False,
+    )
     startsecs = Float(
         required=False,
         description="Start time for input stream in seconds",
@@ -532,6 +532,7 @@ def main(args: dict = None):
                 modules,
                 module_input_json[i],
                 logFullPath,
+                in_process=params["run_in_process"],
             )
 
         if runTPrime:
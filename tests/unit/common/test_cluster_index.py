@@ -0,0 +1,21 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.cluster_index import ClusterIndex
+
+def test_cluster_index():
+
+	spike_clusters = np.array([3, 0, 3, 1, 3, 0, 5])
+	values = np.arange(spike_clusters.size) * 10
+
+	index = ClusterIndex(spike_clusters)
+	sorted_values = index.sort(values)
+
+	assert(np.array_equal(index.cluster_ids, np.unique(spike_clusters)))
+
+	for cluster_id in range(index.total_units):
+		expected = values[spike_clusters == cluster_id]
+		assert(np.array_equal(index.unit(sorted_values, cluster_id), expected))
+		assert(np.array_equal(index.take(cluster_id, values), expected))
+
+	assert(np.array_equal(index.labels(), np.sort(spike_clusters)))
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.dataset_context import DatasetContext, get_context, kilosort_dataset
+
+def test_dataset_context(tmpdir):
+
+	folder = str(tmpdir)
+
+	np.save(os.path.join(folder, 'spike_times.npy'), np.array([[10], [20], [30]], dtype='uint64'))
+	np.save(os.path.join(folder, 'spike_clusters.npy'), np.array([0, 2, 2], dtype='uint32'))
+	np.save(os.path.join(folder, 'amplitudes.npy'), np.array([[1.0], [2.0], [3.0]]))
+
+	# without an active context, every module gets its own dataset
+	assert(kilosort_dataset(folder, 10.0) is not kilosort_dataset(folder, 10.0))
+
+	with DatasetContext() as context:
+		assert(get_context() is context)
+
+		dataset = kilosort_dataset(folder, 10.0)
+		assert(kilosort_dataset(folder, 10.0) is dataset)
+		assert(kilosort_dataset(folder, 20.0) is not dataset)
+
+		assert(np.array_equal(dataset.cluster_ids, [0, 2]))
+		assert(np.array_equal(dataset.spike_times_seconds, [1.0, 2.0, 3.0]))
+		amplitudes = dataset.amplitudes
+
+		# saving through the dataset keeps the new data, and drops what depends on it
+		dataset.save('spike_clusters.npy', np.array([1, 1, 1], dtype='uint32'))
+		assert(np.array_equal(dataset.cluster_ids, [1]))
+		assert(np.array_equal(np.load(os.path.join(folder, 'spike_clusters.npy')), [1, 1, 1]))
+
+		# files rewritten by other code are read again after refresh
+		np.save(os.path.join(folder, 'spike_times.npy'), np.array([[10], [20]], dtype='uint64'))
+		assert(dataset.spike_times_seconds.size == 3)
+		context.refresh()
+		assert(np.array_equal(dataset.spike_times_seconds, [1.0, 2.0]))
+		assert(dataset.amplitudes is amplitudes)
+
+	assert(get_context() is None)
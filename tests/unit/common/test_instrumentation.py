@@ -0,0 +1,70 @@
+import json
+import os
+
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.instrumentation import Tracer, flatten_spans, get_tracer, span, trace_module
+
+def test_tracer_spans(tmpdir_factory):
+
+	# without an active tracer, span does nothing
+	with span('untraced') as current:
+		assert(current is None)
+
+	with Tracer('module') as tracer:
+		assert(get_tracer() is tracer)
+		with span('load', num_files=np.int64(3)):
+			data = np.ones((1000, 100))
+		with span('compute'):
+			with span('step', epoch='complete_session'):
+				total = np.sum(data)
+
+	assert(get_tracer() is None)
+
+	spans = tracer.to_dict()
+	paths = [path for path, _ in flatten_spans(spans)]
+
+	assert(paths == ['module', 'module/load', 'module/compute', 'module/compute/step'])
+	assert(spans['children'][0]['attributes']['num_files'] == 3)
+
+	for path, s in flatten_spans(spans):
+		assert(s['duration'] >= 0)
+		assert(s['peak_rss_delta'] >= 0)
+
+	compute = spans['children'][1]
+	assert(compute['duration'] >= compute['children'][0]['duration'])
+	assert(compute['start'] >= spans['children'][0]['start'])
+
+	# the trace file collects events from successive runs
+	trace_file = os.path.join(str(tmpdir_factory.mktemp('trace')), 'trace.json')
+	tracer.write_chrome_trace(trace_file)
+	tracer.write_chrome_trace(trace_file)
+
+	with open(trace_file) as f:
+		events = json.load(f)['traceEvents']
+
+	complete = [event for event in events if event['ph'] == 'X']
+	assert(len(complete) == 8)
+	assert(complete[3]['name'] == 'step' and complete[3]['args']['epoch'] == 'complete_session')
+
+
+def test_trace_module(tmpdir_factory):
+
+	trace_file = os.path.join(str(tmpdir_factory.mktemp('trace')), 'trace.json')
+
+	@trace_module('test_module')
+	def run(args):
+		with span('stage'):
+			pass
+		return {'execution_time': 0.0}
+
+	output = run({'instrumentation_params': {'chrome_trace_file': trace_file}})
+
+	assert(output['spans']['name'] == 'test_module')
+	assert(output['spans']['children'][0]['name'] == 'stage')
+	assert(os.path.exists(trace_file))
+
+	# no trace file without instrumentation_params
+	output = run({})
+	assert('spans' in output)
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+import numpy as np
+import pandas as pd
+
+from ecephys_spike_sorting.common.metrics_io import find_metrics_file, merge_metrics, metrics_path, read_metrics, replace_metrics_rows, \
+	versioned_path, write_metrics
+
+def make_metrics():
+
+	quality = pd.DataFrame({'cluster_id' : np.array([2, 0, 1], dtype='int64'),
+	                        'firing_rate' : [1.5, 2.0, np.nan],
+	                        'epoch_name' : ['0', '0', '0']})
+
+	waveforms = pd.DataFrame({'cluster_id' : np.array([0, 1, 2, 3], dtype='int64'),
+	                          'epoch_name' : ['complete_session'] * 4,
+	                          'snr' : [3.0, 4.0, 5.0, 6.0]})
+
+	return quality, waveforms
+
+
+def test_merge_metrics():
+
+	quality, waveforms = make_metrics()
+
+	merged = merge_metrics(quality, waveforms.set_index('cluster_id'), suffixes=('_quality_metrics', '_waveform_metrics'))
+
+	assert(np.array_equal(merged['cluster_id'].values, [2, 0, 1]))
+	assert(np.array_equal(merged['snr'].values, [5.0, 3.0, 4.0]))
+	assert(list(merged.columns) == ['cluster_id', 'firing_rate', 'epoch_name_quality_metrics', 'epoch_name_waveform_metrics', 'snr'])
+
+
+def test_replace_metrics_rows():
+
+	metrics = pd.DataFrame({'cluster_id' : np.array([0, 1, 2, 0, 1, 2], dtype='int64'),
+	                        'epoch_name' : ['0', '0', '0', '1', '1', '1'],
+	                        'snr' : [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]})
+
+	# unit 1 recalculated, unit 2 left without spikes
+	new_metrics = pd.DataFrame({'cluster_id' : np.array([1, 1], dtype='int64'),
+	                            'epoch_name' : ['0', '1'],
+	                            'snr' : [20.0, 50.0]})
+
+	replaced = replace_metrics_rows(metrics, new_metrics, [1, 2])
+
+	assert(replaced['cluster_id'].tolist() == [0, 1, 0, 1])
+	assert(replaced['epoch_name'].tolist() == ['0', '0', '1', '1'])
+	assert(replaced['snr'].tolist() == [1.0, 20.0, 4.0, 50.0])
+
+
+@pytest.mark.parametrize('metrics_format', ['csv', 'parquet', 'feather'])
+def test_metrics_round_trip(tmpdir_factory, metrics_format):
+
+	if metrics_format != 'csv':
+		pytest.importorskip('pyarrow')
+
+	output_dir = str(tmpdir_factory.mktemp('metrics'))
+	filename = os.path.join(output_dir, 'metrics.csv')
+
+	quality, waveforms = make_metrics()
+
+	path = write_metrics(quality, filename, metrics_format)
+
+	assert(path == metrics_path(filename, metrics_format))
+	assert(find_metrics_file(filename) == path)
+	assert(find_metrics_file(versioned_path(filename, 1)) is None)
+
+	metrics = read_metrics(path)
+
+	assert(metrics['cluster_id'].dtype == np.int64)
+	assert(metrics['epoch_name'].tolist() == ['0', '0', '0'])
+	pd.testing.assert_frame_equal(metrics, quality)
@@ -0,0 +1,46 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.snippets import gather_read_samples, gather_snippets, plan_snippet_reads
+
+def test_plan_snippet_reads():
+
+	starts = np.array([500, 0, 12, 100, 30, 512])
+
+	order, bounds, read_starts, read_ends = plan_snippet_reads(starts, 10, 5, 1000)
+
+	assert(np.all(starts[order] == np.sort(starts)))
+
+	# 0 and 12 are merged (gap of 2 samples), as are 500 and 512; 30 is 8 samples after the end of 12
+	assert(np.all(read_starts == [0, 30, 100, 500]))
+	assert(np.all(read_ends == [22, 40, 110, 522]))
+	assert(np.all(np.diff(bounds) == [2, 1, 1, 2]))
+
+	# long ranges are split
+	order, bounds, read_starts, read_ends = plan_snippet_reads(np.arange(0, 100, 5), 10, 5, 30)
+	assert(np.all(read_ends - read_starts <= 30))
+	assert(bounds[-1] == 20)
+
+
+def test_gather_snippets():
+
+	raw_data = np.random.randint(-1000, 1000, size=(5000, 8)).astype('int16')
+
+	starts = np.random.randint(0, 5000 - 20, size=200)
+	channels = np.array([1, 4, 5])
+
+	snippets = gather_snippets(raw_data, starts, 20, 0.5, channels, max_gap=10, max_read_samples=200, num_threads=3)
+
+	assert(snippets.data.dtype == np.int16)
+	assert(snippets.shape == (200, 3, 20))
+
+	for i, start in enumerate(starts):
+		assert(np.all(snippets.data[i] == raw_data[start:start + 20, channels].T))
+
+	assert(np.allclose(snippets.scaled(), snippets.data * 0.5))
+	assert(np.allclose(np.asarray(snippets[:2]), snippets.data[:2] * 0.5))
+
+	assert(gather_read_samples(raw_data, starts, 20) <= 5000)
+
+	with pytest.raises(ValueError):
+		gather_snippets(raw_data, np.array([4990]), 20)
@@ -46,3 +46,121 @@ def test_find_range():
 	output = utils.find_range(data, 20, 30)
 
 	assert(np.array_equal(output, np.arange(20,31)))
+
+def test_kilosort_dataset(tmpdir):
+
+	folder = str(tmpdir)
+
+	templates = np.zeros((4, 30, 6))
+	templates[:, 10:, :] = np.random.rand(4, 20, 6)
+
+	np.save(os.path.join(folder, 'spike_times.npy'), np.array([[10], [20], [30]], dtype='uint64'))
+	np.save(os.path.join(folder, 'spike_clusters.npy'), np.array([0, 2, 2], dtype='uint32'))
+	np.save(os.path.join(folder, 'spike_templates.npy'), np.array([[0], [2], [2]], dtype='uint32'))
+	np.save(os.path.join(folder, 'amplitudes.npy'), np.array([[1.0], [2.0], [3.0]]))
+	np.save(os.path.join(folder, 'templates.npy'), templates)
+	np.save(os.path.join(folder, 'whitening_mat_inv.npy'), np.eye(6) * 2)
+	np.save(os.path.join(folder, 'channel_map.npy'), np.arange(6))
+	np.save(os.path.join(folder, 'channel_positions.npy'), np.zeros((6, 2)))
+
+	with open(os.path.join(folder, 'cluster_Amplitude.tsv'), 'w') as f:
+		f.write('cluster_id\tAmplitude\n0\t5.0\n1\t0.0\n2\t7.0\n')
+
+	dataset = utils.KilosortDataset(folder, 10.0)
+
+	assert(np.array_equal(dataset.spike_times_seconds, [1.0, 2.0, 3.0]))
+
+	# only the spike times have been read
+	assert('templates' not in vars(dataset))
+
+	assert(np.array_equal(dataset.cluster_amplitude, [5.0, 0.0, 7.0, 0.0]))
+	assert('templates' not in vars(dataset))
+
+	assert(np.allclose(dataset.unwhitened_templates, templates[:, 10:, :] * 2))
+
+	outputs = utils.load_kilosort_data(folder, 10.0)
+
+	assert(np.array_equal(outputs[0], dataset.spike_times_seconds))
+	assert(np.allclose(outputs[4], dataset.unwhitened_templates))
+	assert(np.array_equal(outputs[7], [0, 2]))
+
+def test_load_unwhitened_templates(tmpdir):
+
+	folder = str(tmpdir)
+
+	templates = np.random.rand(3, 10, 4)
+	w_inv = np.random.rand(4, 4)
+
+	np.save(os.path.join(folder, 'templates.npy'), templates)
+	np.save(os.path.join(folder, 'whitening_mat_inv.npy'), w_inv)
+
+	output = utils.load_unwhitened_templates(folder)
+
+	assert(np.allclose(output, np.array([np.dot(t, w_inv) for t in templates])))
+	assert(os.path.isfile(os.path.join(folder, utils.UNWHITENED_TEMPLATES_FILE)))
+
+	# mark the cache, to see when it is used
+	np.save(os.path.join(folder, utils.UNWHITENED_TEMPLATES_FILE), np.zeros(output.shape))
+
+	assert(np.all(utils.load_unwhitened_templates(folder) == 0))
+
+	# same contents with a new modification time: still valid
+	stat = os.stat(os.path.join(folder, 'templates.npy'))
+	os.utime(os.path.join(folder, 'templates.npy'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+	assert(np.all(utils.load_unwhitened_templates(folder) == 0))
+
+	# new templates: recomputed
+	np.save(os.path.join(folder, 'templates.npy'), templates * 2)
+
+	assert(np.allclose(utils.load_unwhitened_templates(folder), output * 2))
+	assert(np.allclose(utils.load_unwhitened_templates(folder, dtype='float32'), output * 2))
+
+def test_select_spikes():
+
+	data = np.arange(50).reshape((10, 5))
+
+	contiguous = np.arange(10) >= 4
+	output = utils.select_spikes(data, contiguous)
+
+	assert(np.shares_memory(output, data))
+	assert(np.array_equal(output, data[contiguous]))
+
+	scattered = np.arange(10) % 3 == 0
+	output = utils.select_spikes(data, scattered, chunk_size=2)
+
+	assert(np.array_equal(output, data[scattered]))
+
+def test_select_spikes_to_file(tmpdir):
+
+	data = np.arange(50).reshape((10, 5))
+	scattered = np.arange(10) % 3 == 0
+
+	output = utils.select_spikes_to_file(data, scattered, str(tmpdir), 'features.npy', chunk_size=2)
+
+	assert(np.array_equal(output, data[scattered]))
+
+	utils.save(str(tmpdir), 'features.npy', output)
+
+	assert(np.array_equal(np.load(os.path.join(str(tmpdir), 'features.npy')), data[scattered]))
+	assert(not os.path.exists(os.path.join(str(tmpdir), 'features.npy.tmp')))
+
+def test_cluster_table():
+
+	templates = np.zeros((3, 10, 4))
+	templates[0, 5, 1] = 1.0
+	templates[1, 5, 3] = -2.0
+	templates[2, 5, 0] = 3.0
+
+	channel_map = np.array([10, 11, 12, 13])
+
+	# cluster 0 is mostly template 1; cluster 2 has no spikes; cluster 3 ties
+	# between templates 0 and 2 and takes the lower ID
+	spike_clusters = np.array([0, 0, 0, 1, 3, 3])
+	spike_templates = np.array([1, 1, 2, 2, 2, 0])
+
+	clus_table = utils.cluster_table(spike_clusters, spike_templates, templates, channel_map)
+
+	assert(clus_table.dtype == np.uint32)
+	assert(np.all(clus_table[:, 0] == [3, 1, 0, 2]))
+	assert(np.all(clus_table[:, 1] == [13, 10, 0, 11]))
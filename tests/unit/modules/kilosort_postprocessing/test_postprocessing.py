@@ -0,0 +1,174 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.modules.kilosort_postprocessing.postprocessing import remove_double_counted_spikes, \
+	find_neighboring_units, find_within_unit_overlap, find_all_within_unit_overlaps, find_between_unit_overlap
+
+def remove_double_counted_spikes_loop(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos,
+									  templates, pc_features, template_features, cluster_amplitude, sample_rate, params):
+
+	# original implementation of remove_double_counted_spikes, which compares every pair of units
+
+	peak_chan_idx = np.squeeze(np.argmax(np.max(templates, 1) - np.min(templates, 1), 1))
+	peak_channels = np.squeeze(np.squeeze(channel_map)[peak_chan_idx])
+
+	num_clusters = peak_channels.size
+	sorted_unit_list = np.arange(num_clusters)[np.argsort(peak_channels)]
+
+	overlap_matrix = np.zeros((num_clusters, num_clusters), dtype='int')
+
+	within_unit_overlap_samples = int(params['within_unit_overlap_window'] * sample_rate)
+	between_unit_overlap_samples = int(params['between_unit_overlap_window'] * sample_rate)
+
+	spikes_to_remove = np.zeros((0,), dtype='int')
+
+	for idx1, unit_id1 in enumerate(sorted_unit_list):
+		for_unit1 = np.where(spike_clusters == unit_id1)[0]
+		to_remove = find_within_unit_overlap(spike_times[for_unit1], within_unit_overlap_samples)
+		overlap_matrix[idx1, idx1] = len(to_remove)
+		spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove]))
+
+	spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = \
+		[np.delete(x, spikes_to_remove, 0) for x in (spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features)]
+
+	spikes_to_remove = np.zeros((0,), dtype='int')
+
+	for idx1, unit_id1 in enumerate(sorted_unit_list):
+		for_unit1 = np.where(spike_clusters == unit_id1)[0]
+		for idx2, unit_id2 in enumerate(sorted_unit_list):
+			deltaX = np.squeeze(channel_pos[peak_chan_idx[unit_id2], 0] - channel_pos[peak_chan_idx[unit_id1], 0])
+			deltaZ = np.squeeze(channel_pos[peak_chan_idx[unit_id2], 1] - channel_pos[peak_chan_idx[unit_id1], 1])
+			dist = pow((pow(deltaX, 2) + pow(deltaZ, 2)), 0.5)
+			if idx2 > idx1 and dist < params['between_unit_dist_um']:
+				for_unit2 = np.where(spike_clusters == unit_id2)[0]
+				to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2],
+					cluster_amplitude[unit_id1], cluster_amplitude[unit_id2], between_unit_overlap_samples, params['deletion_mode'])
+				overlap_matrix[idx1, idx2] = overlap_matrix[idx1, idx2] + len(to_remove1)
+				overlap_matrix[idx2, idx1] = overlap_matrix[idx2, idx1] + len(to_remove2)
+				spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove1], for_unit2[to_remove2]))
+
+	spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = \
+		[np.delete(x, np.unique(spikes_to_remove), 0) for x in (spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features)]
+
+	overlap_summary = np.zeros((num_clusters, 5), dtype=int)
+	for idx1, unit_id1 in enumerate(sorted_unit_list):
+		overlap_summary[idx1, 0] = unit_id1
+		overlap_summary[idx1, 1] = np.sum(spike_clusters == unit_id1)
+		overlap_summary[idx1, 2] = overlap_matrix[idx1, idx1]
+		overlap_summary[idx1, 3] = np.sum(overlap_matrix[idx1, :]) - overlap_matrix[idx1, idx1]
+		overlap_summary[idx1, 4] = sorted_unit_list[np.argmax(overlap_matrix[idx1, :])]
+	overlap_summary = overlap_summary[np.argsort(overlap_summary[:, 0]), :]
+
+	return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, overlap_matrix, overlap_summary
+
+def make_sorting_outputs(rng, num_units=12, num_channels=16, num_samples=30):
+
+	# units on a 2-column probe (sites 32 um apart in x, 20 um in z), several on the same
+	# peak channel, with spikes copied at a fixed lag into nearby units and within units
+	channel_pos = np.stack((32.0 * (np.arange(num_channels) % 2), 20.0 * (np.arange(num_channels) // 2)), 1)
+	channel_map = np.arange(num_channels)
+
+	peak_channels = rng.randint(0, num_channels, num_units)
+	peak_channels[1] = peak_channels[0]
+
+	templates = rng.randn(num_units, num_samples, num_channels) * 0.1
+	templates[np.arange(num_units), num_samples // 2, peak_channels] = -5.0
+
+	times = [np.sort(rng.choice(900000, rng.randint(200, 600), replace=False)) for unit in range(num_units)]
+	for unit in range(1, num_units):
+		source = rng.randint(0, unit)
+		copied = rng.choice(times[source], rng.randint(0, 60), replace=False)
+		times[unit] = np.concatenate((times[unit], copied + rng.choice([2, 3], copied.size, p=[0.1, 0.9])))
+	for unit in range(num_units):
+		copied = rng.choice(times[unit], rng.randint(0, 20), replace=False)
+		times[unit] = np.concatenate((times[unit], copied + rng.randint(1, 4, copied.size)))
+
+	spike_clusters = np.concatenate([np.full(t.size, unit) for unit, t in enumerate(times)])
+	spike_times = np.concatenate(times)
+	order = np.argsort(spike_times, kind='stable')
+	spike_times = spike_times[order].astype('uint64')
+	spike_clusters = spike_clusters[order]
+
+	num_spikes = spike_times.size
+	spike_templates = spike_clusters.copy()
+	amplitudes = rng.rand(num_spikes) * 20
+	pc_features = rng.randn(num_spikes, 3, 4).astype('float32')
+	template_features = rng.randn(num_spikes, 5).astype('float32')
+	cluster_amplitude = rng.rand(num_units) * 100
+
+	return spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, \
+		pc_features, template_features, cluster_amplitude
+
+def test_find_neighboring_units():
+
+	rng = np.random.RandomState(0)
+
+	# sites on a grid, so many pairs are exactly 20, 32 or 40 um apart
+	positions = np.stack((32.0 * rng.randint(0, 2, 40), 20.0 * rng.randint(0, 10, 40)), 1)
+
+	for max_distance in [0, 20, 32, 37.8, 40, 100, 1000]:
+		expected = [(i, j) for i in range(len(positions)) for j in range(i + 1, len(positions))
+					if pow(pow(positions[j, 0] - positions[i, 0], 2) + pow(positions[j, 1] - positions[i, 1], 2), 0.5) < max_distance]
+		pairs = find_neighboring_units(positions, max_distance)
+		assert(pairs.shape == (len(expected), 2))
+		assert([tuple(pair) for pair in pairs] == expected)
+
+def test_find_all_within_unit_overlaps():
+
+	rng = np.random.RandomState(0)
+
+	# clusters 0-9 (3 and 7 without spikes) and 10-11 beyond num_clusters, with
+	# duplicated spikes and ties, in random order
+	num_clusters = 10
+	spike_clusters = rng.choice([0, 1, 2, 4, 5, 6, 8, 9, 10, 11], 3000)
+	spike_times = rng.randint(0, 60000, 3000)
+	spike_times[:200] = spike_times[200:400] + rng.randint(0, 3, 200)
+	spike_clusters[:200] = spike_clusters[200:400]
+	order = rng.permutation(spike_times.size)
+	spike_times = spike_times[order].astype('uint64')
+	spike_clusters = spike_clusters[order]
+
+	for overlap_window in [0, 1, 5, 30]:
+
+		expected = np.zeros((0,), dtype='int')
+		expected_per_unit = np.zeros((num_clusters,), dtype='int')
+
+		for unit_id in range(num_clusters):
+			for_unit = np.where(spike_clusters == unit_id)[0]
+			for_unit = for_unit[np.argsort(spike_times[for_unit], kind='stable')]
+			to_remove = find_within_unit_overlap(spike_times[for_unit], overlap_window)
+			expected_per_unit[unit_id] = len(to_remove)
+			expected = np.concatenate((expected, for_unit[to_remove]))
+
+		spikes_to_remove, removed_per_unit = find_all_within_unit_overlaps(spike_times, spike_clusters,
+																			num_clusters, overlap_window)
+
+		assert(np.array_equal(spikes_to_remove, np.sort(expected)))
+		assert(np.array_equal(removed_per_unit, expected_per_unit))
+		assert(removed_per_unit[3] == 0 and removed_per_unit[7] == 0)
+
+def test_remove_double_counted_spikes():
+
+	rng = np.random.RandomState(0)
+
+	spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, \
+		pc_features, template_features, cluster_amplitude = make_sorting_outputs(rng)
+
+	pc_feature_ind = np.zeros((templates.shape[0], 4), dtype='int')
+
+	# 20 and 40 um are exact distances between sites, which are not within between_unit_dist_um
+	for deletion_mode in ['lowAmpCluster', 'deleteFirst']:
+		for between_unit_dist_um in [0, 20, 33, 40, 100]:
+
+			params = {'within_unit_overlap_window': 0.000166, 'between_unit_overlap_window': 0.000166,
+					  'between_unit_dist_um': between_unit_dist_um, 'deletion_mode': deletion_mode, 'include_pcs': True}
+
+			expected = remove_double_counted_spikes_loop(spike_times, spike_clusters, spike_templates, amplitudes,
+				channel_map, channel_pos, templates, pc_features, template_features, cluster_amplitude, 30000.0, params)
+
+			result = remove_double_counted_spikes(spike_times.copy(), spike_clusters.copy(), spike_templates.copy(),
+				amplitudes.copy(), channel_map, channel_pos, templates, pc_features.copy(), pc_feature_ind,
+				template_features.copy(), cluster_amplitude, 30000.0, params)
+
+			for a, b in zip(result, expected):
+				assert(np.array_equal(a, b))
@@ -1,8 +1,14 @@
 import pytest
 import numpy as np
+import pandas as pd
 import os
 
+from ecephys_spike_sorting.modules.mean_waveforms.__main__ import calculate_mean_waveforms
+from ecephys_spike_sorting.modules.mean_waveforms._schemas import MeanWaveformSchema
 from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms
+from ecephys_spike_sorting.modules.mean_waveforms.c_waves import c_waves_mean_waveforms
+from ecephys_spike_sorting.modules.mean_waveforms.stream_waveforms import gather_mean_waveforms, stream_mean_waveforms
+from ecephys_spike_sorting.modules.mean_waveforms import waveform_metrics
 import ecephys_spike_sorting.common.utils as utils
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
@@ -29,4 +35,197 @@ def test_extract_waveforms():
     
     data, spike_counts, coords, labels = extract_waveforms(data, spike_times, spike_clusters, cluster_ids, cluster_quality, bit_volts, sample_rate, params)
 
-    print(labels)
\ No newline at end of file
+    print(labels)
+
+def test_stream_mean_waveforms():
+
+    samples_per_spike = 10
+    pre_samples = 3
+    total_units = 3
+    total_epochs = 2
+
+    raw_data = np.random.randint(-100, 100, size=(1000, 4)).astype('int16')
+
+    # includes snippets at both ends of the data, which are left out
+    times = np.array([1, 50, 52, 400, 401, 640, 995, 50, 700])
+    clusters = np.array([0, 0, 1, 1, 1, 2, 2, 0, 0])
+    epoch_indices = np.array([0, 0, 0, 0, 0, 0, 0, 1, 1])
+
+    mean_waveforms, valid_count = stream_mean_waveforms(raw_data, times, clusters, epoch_indices,
+                                                        total_units, total_epochs, pre_samples,
+                                                        samples_per_spike, 0.5, 100)
+
+    for unit in range(total_units):
+        for epoch in range(total_epochs):
+            snippets = [raw_data[t - pre_samples:t - pre_samples + samples_per_spike, :].T * 0.5
+                        for t, c, e in zip(times, clusters, epoch_indices)
+                        if c == unit and e == epoch and t >= pre_samples and t - pre_samples + samples_per_spike <= 1000]
+            assert(valid_count[unit, epoch] == len(snippets))
+            if len(snippets) > 0:
+                assert(np.allclose(mean_waveforms[unit, epoch, 0], np.mean(snippets, 0)))
+                assert(np.allclose(mean_waveforms[unit, epoch, 1], np.std(snippets, 0)))
+
+    # one of the two snippets of cluster 2 is inside the data; it has no spikes in epoch 1
+    assert(valid_count[2, 0] == 1)
+    assert(np.all(mean_waveforms[2, 1] == 0))
+
+def test_gather_mean_waveforms():
+
+    raw_data = np.random.randint(-100, 100, size=(20000, 4)).astype('int16')
+
+    times = np.random.randint(0, 20000, size=300)
+    clusters = np.random.randint(0, 5, size=300)
+    epoch_indices = np.random.randint(0, 2, size=300)
+
+    streamed, streamed_count = stream_mean_waveforms(raw_data, times, clusters, epoch_indices,
+                                                     5, 2, 20, 82, 0.195, 1000)
+    gathered, gathered_count = gather_mean_waveforms(raw_data, times, clusters, epoch_indices,
+                                                     5, 2, 20, 82, 0.195, 2)
+
+    assert(np.all(streamed_count == gathered_count))
+    assert(np.allclose(streamed, gathered, equal_nan=True))
+
+def test_c_waves_mean_waveforms():
+
+    raw_data = np.random.randint(-100, 100, size=(30000, 8)).astype('int16')
+
+    spike_times = np.sort(np.random.randint(0, 30000, size=500))
+    spike_clusters = np.random.randint(0, 3, size=500)
+    peak_channels = np.array([0, 4, 7])
+
+    mean_waveforms, cluster_snr = c_waves_mean_waveforms(raw_data, spike_times, spike_clusters, 0.5, 30, 10, 50,
+                                                         peak_channels, snr_radius=2)
+
+    for unit in range(3):
+
+        # every count / 50-th spike of the unit, in time order
+        times = spike_times[spike_clusters == unit]
+        times = times[np.arange(50) * times.size // 50] - 10
+        times = times[(times >= 0) & (times + 30 <= 30000)]
+
+        snippets = np.array([raw_data[t:t + 30, :].T * 0.5 for t in times])
+        mean = np.mean(snippets, 0)
+
+        assert(cluster_snr[unit, 1] == times.size)
+        assert(np.allclose(mean_waveforms[unit], mean, atol=1e-4))
+
+        disk = np.arange(max(peak_channels[unit] - 2, 0), min(peak_channels[unit] + 3, 8))
+        residuals = snippets[:, disk, :15] - mean[disk, :15]
+        variance = np.sum(residuals ** 2) / (residuals.size - disk.size * 15)
+
+        snr = np.ptp(mean[peak_channels[unit]]) / (2 * np.sqrt(variance))
+        assert(np.isclose(cluster_snr[unit, 0], snr, rtol=1e-4))
+
+
+def test_waveform_metrics_batch():
+
+    num_units, num_channels, num_samples = 5, 32, 200
+    timestamps = np.linspace(0, num_samples / 30000.0, num_samples)
+
+    site_x = np.tile([16.0, 48.0], num_channels // 2)
+    site_y = np.repeat(np.arange(num_channels // 2) * 20.0, 2)
+
+    # a trough and later peak, decaying and delayed away from the peak channel
+    peak_channels = np.array([3, 10, 16, 25, 30])
+    samples = np.arange(num_samples)
+    waveforms = np.zeros((num_units, num_channels, num_samples))
+
+    for unit in range(num_units):
+        distance = np.abs(np.arange(num_channels) - peak_channels[unit])
+        trough = 50 + distance[:, np.newaxis] // 2 + unit
+        waveforms[unit] = np.exp(-distance[:, np.newaxis] / 4.0) * \
+            (-np.exp(-(samples - trough) ** 2 / 20.0) + 0.4 * np.exp(-(samples - trough - 20) ** 2 / 80.0))
+
+    waveforms += np.random.normal(scale=0.01, size=waveforms.shape)
+
+    features_1D = waveform_metrics.calculate_1D_features_batch(waveforms[np.arange(num_units), peak_channels],
+                                                               timestamps)
+    features_2D = waveform_metrics.calculate_2D_features_batch(waveforms, timestamps, peak_channels,
+                                                               site_x, site_y)
+
+    for unit in range(num_units):
+
+        waveform = waveforms[unit, peak_channels[unit]]
+
+        assert(np.isclose(features_1D['duration'][unit],
+                          waveform_metrics.calculate_waveform_duration(waveform, timestamps)))
+        assert(np.isclose(features_1D['halfwidth'][unit],
+                          waveform_metrics.calculate_waveform_halfwidth(waveform, timestamps)))
+        assert(np.isclose(features_1D['PT_ratio'][unit],
+                          waveform_metrics.calculate_waveform_PT_ratio(waveform)))
+        assert(np.isclose(features_1D['repolarization_slope'][unit],
+                          waveform_metrics.calculate_waveform_repolarization_slope(waveform, timestamps)))
+        assert(np.isclose(features_1D['recovery_slope'][unit],
+                          waveform_metrics.calculate_waveform_recovery_slope(waveform, timestamps)))
+
+        amplitude, spread, velocity_above, velocity_below = \
+            waveform_metrics.calculate_2D_features(waveforms[unit], timestamps, peak_channels[unit],
+                                                   site_x, site_y)
+
+        assert(np.isclose(features_2D['amplitude'][unit], amplitude))
+        assert(np.isclose(features_2D['spread'][unit], spread))
+        assert(np.isclose(features_2D['velocity_above'][unit], velocity_above, equal_nan=True))
+        assert(np.isclose(features_2D['velocity_below'][unit], velocity_below, equal_nan=True))
+
+
+def test_mean_waveforms_cluster_ids(tmpdir):
+
+    folder = str(tmpdir)
+    rng = np.random.RandomState(0)
+
+    num_samples, num_channels, num_units = 60000, 16, 6
+
+    raw_data = rng.randint(-50, 50, size=(num_samples, num_channels)).astype('int16')
+    raw_data.tofile(os.path.join(folder, 'continuous.dat'))
+
+    spike_times = np.sort(rng.randint(100, num_samples - 100, size=600)).astype('uint64')
+    spike_clusters = rng.randint(0, num_units, size=600).astype('uint32')
+    templates = rng.randn(num_units, 82, num_channels).astype('float32')
+
+    np.save(os.path.join(folder, 'spike_times.npy'), spike_times[:, np.newaxis])
+    np.save(os.path.join(folder, 'spike_clusters.npy'), spike_clusters)
+    np.save(os.path.join(folder, 'templates.npy'), templates)
+    np.save(os.path.join(folder, 'whitening_mat_inv.npy'), np.eye(num_channels))
+    np.save(os.path.join(folder, 'channel_map.npy'), np.arange(num_channels))
+    np.save(os.path.join(folder, 'channel_positions.npy'),
+            np.column_stack((np.tile([16.0, 48.0], num_channels // 2), np.repeat(np.arange(num_channels // 2) * 20.0, 2))))
+
+    # cluster metrics from the quality_metrics module, merged with the waveform metrics
+    pd.DataFrame({'cluster_id': np.arange(num_units), 'firing_rate': rng.rand(num_units),
+                  'epoch_name': ['complete_session'] * num_units}).to_csv(os.path.join(folder, 'metrics.csv'), index=False)
+
+    def run(cluster_ids=None):
+        args = MeanWaveformSchema().load({'input': {
+            'directories': {'kilosort_output_directory': folder},
+            'ephys_params': {'ap_band_file': os.path.join(folder, 'continuous.dat'), 'num_channels': num_channels,
+                             'sample_rate': 30000.0, 'bit_volts': 0.195, 'vertical_site_spacing': 20e-6},
+            'mean_waveform_params': {'use_C_Waves': False, 'spikes_per_epoch': 1000, 'cluster_ids': cluster_ids,
+                                     'mean_waveforms_file': os.path.join(folder, 'mean_waveforms.npy')},
+            'waveform_metrics': {'waveform_metrics_file': os.path.join(folder, 'waveform_metrics.csv')},
+            'cluster_metrics': {'cluster_metrics_file': os.path.join(folder, 'metrics.csv')}}, 'output': {}})
+        calculate_mean_waveforms(args['input'])
+        outputs = [np.load(os.path.join(folder, 'mean_waveforms.npy'))]
+        for name in ['waveform_metrics.csv', 'metrics.csv']:
+            with open(os.path.join(folder, name)) as f:
+                outputs.append(f.read())
+        return outputs
+
+    run()
+
+    saved = {name: open(os.path.join(folder, name)).read() for name in ['waveform_metrics.csv', 'metrics.csv']}
+    saved_waveforms = np.load(os.path.join(folder, 'mean_waveforms.npy'))
+
+    expected = run()
+
+    # put back the outputs of the first run, then re-extract only units 1 and 2
+    for name, text in saved.items():
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write(text)
+    np.save(os.path.join(folder, 'mean_waveforms.npy'), saved_waveforms)
+
+    output = run([1, 2])
+
+    assert(np.array_equal(output[0], expected[0]))
+    assert(np.all(np.any(output[0] != 0, axis=(1, 2))))
+    assert(output[1] == expected[1])
+    assert(output[2] == expected[2])
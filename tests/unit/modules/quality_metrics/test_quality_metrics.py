@@ -2,8 +2,18 @@ import pytest
 import numpy as np
 import os
 
-from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_metrics
+from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_metrics, calculate_windowed_metrics, \
+	calculate_spike_train_metrics, calculate_silhouette_score, calculate_drift_metrics, grouped_median, mahalanobis_metrics, \
+	amplitude_cutoff, amplitude_cutoff_batch, \
+	nearest_neighbors_metrics, nearest_neighbors_metrics_batch, calculate_pc_metrics, isi_violations, presence_ratio, firing_rate, ccg
+from ecephys_spike_sorting.modules.quality_metrics.nn_index import NeighborhoodIndexCache
+from ecephys_spike_sorting.modules.quality_metrics.ibl_metrics import calculate_slidingRP, slidingRP_viol, noise_cutoff, noise_cutoff_batch
+from ecephys_spike_sorting.modules.quality_metrics.fingerprint import cluster_fingerprints, find_changed_clusters
 import ecephys_spike_sorting.common.utils as utils
+from ecephys_spike_sorting.common.epoch import get_sliding_windows
+from sklearn.metrics import silhouette_score
+from scipy.spatial.distance import cdist
+from scipy.stats import chi2
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
 
@@ -31,6 +41,404 @@ def te_st_quality_metrics():
 
 	print(metrics)
 
+def test_spike_train_metrics():
+
+	rng = np.random.RandomState(0)
+	spike_times = np.round(np.sort(rng.uniform(0, 100, 5000)), 3)
+	spike_clusters = rng.randint(0, 8, 5000)
+	spike_clusters[spike_clusters == 2] = 3  # unit without spikes
+
+	isi_viol, num_viol, ratios, rates = calculate_spike_train_metrics(spike_times, spike_clusters, 8, 0.0015, 0.0005)
+
+	min_time = np.min(spike_times)
+	max_time = np.max(spike_times)
+
+	for cluster_id in range(8):
+		train = spike_times[spike_clusters == cluster_id]
+		if train.size == 0:
+			assert(isi_viol[cluster_id] == 0 and ratios[cluster_id] == 0 and rates[cluster_id] == 0)
+			continue
+		assert((isi_viol[cluster_id], num_viol[cluster_id]) == isi_violations(train, min_time, max_time, 0.0015, 0.0005))
+		assert(ratios[cluster_id] == presence_ratio(train, min_time, max_time))
+		assert(rates[cluster_id] == firing_rate(train, min_time, max_time))
+
+def make_spike_train(rate_hz, duration_s, refractory_s=0.0015, seed=0):
+
+	# Poisson spike train with a refractory period, rounded to 30 kHz samples
+	rng = np.random.RandomState(seed)
+	isis = refractory_s + rng.exponential(1 / rate_hz, int(rate_hz * duration_s * 1.1))
+	st = np.cumsum(isis)
+	st = st[st < duration_s]
+
+	return np.round(st * 30000) / 30000
+
+def ccg_loop(st1, st2, nbins, tbin, auto):
+
+	# original Kilosort2-style walk over both spike trains, as reference for metrics.ccg
+	st1 = np.sort(np.squeeze(st1))
+	st2 = np.sort(np.squeeze(st2))
+
+	dt = nbins*tbin
+
+	T = max(np.max(st1),np.max(st2)) - min(np.min(st1),np.min(st2))
+
+	ilow = 0
+	ihigh = 0
+	j = 0
+
+	n_st2 = len(st2)
+	n_st1 = len(st1)
+
+	K = np.zeros((2*nbins+1,))
+
+	while j < n_st2:
+		while (ihigh < n_st1) and (st1[ihigh] < st2[j]+dt):
+			ihigh = ihigh + 1
+		while (ilow < n_st1) and (st1[ilow] <= st2[j]-dt):
+			ilow = ilow + 1
+		if ilow > n_st1:
+			break
+		if st1[ilow] > st2[j] + dt:
+			j = j + 1
+			continue
+		for k in range(ilow,ihigh):
+			ibin = int(np.round((st2[j]-st1[k])/tbin))
+			K[ibin + nbins] = K[ibin + nbins] + 1
+		j = j + 1
+
+	if auto:
+		K[nbins] = K[nbins] - n_st1
+
+	irange1 = np.concatenate((np.arange(1, int(nbins/2)), np.arange(int(3/2*nbins), 2*nbins-1)),0)
+	irange2 = np.arange(nbins-50, nbins-10)
+	irange3 = np.arange(nbins+10, nbins+50)
+
+	mean_firing_rate = (n_st2)/T
+	Q00 = (sum(K[irange1])/(n_st1 * tbin * len(irange1)))/mean_firing_rate
+	Q01_neg = (sum(K[irange2])/(n_st1 * tbin * len(irange2)))/mean_firing_rate
+	Q01_pos = (sum(K[irange3])/(n_st1 * tbin * len(irange3)))/mean_firing_rate
+	Q01 = max(Q01_neg, Q01_pos)
+
+	Qi = np.zeros((11,))
+	for i in range(1,11):
+		irange = np.arange(nbins-i,nbins+i)
+		Qi[i] = (sum(K[irange])/(n_st1 * (2*i+1)*tbin))/mean_firing_rate
+
+	return K, Qi, Q00, Q01
+
+def test_ccg():
+
+	st1 = make_spike_train(20, 60, seed=1)
+	st2 = make_spike_train(30, 60, seed=2)
+
+	for a, b, auto in [(st1, st1, True), (st1, st2, False)]:
+		K1, Qi1, Q001, Q011 = ccg_loop(a, b, 500, 0.001, auto)
+		K2, Qi2, Q002, Q012, Ri = ccg(a, b, 500, 0.001, auto, max_pairs_per_block=1000)
+		assert(np.array_equal(K1, K2) and np.array_equal(Qi1, Qi2))
+		assert(Q001 == Q002 and Q011 == Q012)
+
+def make_pc_features(rng, num_units=6, num_spikes=3000, num_channels=16):
+
+	# units spread along a linear probe, with PCs on all channels and the largest first PC on their peak channel
+	spike_clusters = rng.randint(0, num_units, num_spikes)
+	peak_channels = np.linspace(2, num_channels - 3, num_units).astype('int')
+	pc_feature_ind = np.tile(np.arange(num_channels), (num_units, 1))
+	pc_features = rng.randn(num_spikes, 3, num_channels) + spike_clusters[:, np.newaxis, np.newaxis] * 0.5
+	pc_features[np.arange(num_spikes), 0, peak_channels[spike_clusters]] += 4
+	channel_pos = np.column_stack((np.zeros((num_channels,)), np.arange(num_channels) * 20.0))
+
+	return spike_clusters, pc_features.astype('float32'), pc_feature_ind, channel_pos
+
+def test_pc_metrics_n_jobs():
+
+	rng = np.random.RandomState(0)
+
+	spike_clusters, pc_features, pc_feature_ind, channel_pos = make_pc_features(rng)
+	cluster_ids = np.arange(6)
+
+	outputs = [calculate_pc_metrics(spike_clusters, spike_clusters, 6, cluster_ids, cluster_ids, pc_features,
+									pc_feature_ind, channel_pos, 100, 400, 1000, 4, n_jobs=n_jobs, seed=1)
+			   for n_jobs in (1, 2)]
+
+	for serial, parallel in zip(*outputs):
+		assert(np.array_equal(serial, parallel))
+	assert(np.all(outputs[0][0] > 0))
+
+def test_silhouette_score():
+
+	rng = np.random.RandomState(0)
+
+	num_spikes = 300
+	spike_clusters = rng.randint(0, 4, num_spikes)
+	spike_templates = spike_clusters
+	pc_feature_ind = np.array([[0, 1, 2], [1, 2, 3], [2, 3, 4], [3, 4, 5]])
+	pc_features = rng.randn(num_spikes, 2, 3) + spike_clusters[:, np.newaxis, np.newaxis]
+
+	# dense features and pairwise scores computed the slow way
+	all_pcs = np.zeros((num_spikes, 5 * 2 + 1))
+	for i in range(num_spikes):
+		for j in range(2):
+			all_pcs[i, pc_feature_ind[spike_templates[i]] + 5 * j] = pc_features[i, j, :]
+
+	expected = np.ones((4,)) * np.inf
+	for i in range(4):
+		for j in range(i + 1, 4):
+			inds = np.in1d(spike_clusters, [i, j])
+			score = silhouette_score(all_pcs[inds], spike_clusters[inds])
+			expected[i] = min(expected[i], score)
+			expected[j] = min(expected[j], score)
+
+	# small blocks, so that units are split across blocks
+	output = calculate_silhouette_score(spike_clusters, spike_templates, 4, pc_features, pc_feature_ind, num_spikes, 1000)
+
+	assert(np.allclose(output, expected))
+
+def test_grouped_median():
+
+	rng = np.random.RandomState(0)
+
+	keys = rng.randint(0, 20, 500)
+	keys[keys == 7] = 8  # one empty group
+	values = rng.randn(500)
+
+	medians, counts = grouped_median(keys, values, 20)
+
+	for key in range(20):
+		assert(counts[key] == np.sum(keys == key))
+		if counts[key] > 0:
+			assert(medians[key] == np.median(values[keys == key]))
+		else:
+			assert(np.isnan(medians[key]))
+
+def test_drift_metrics():
+
+	rng = np.random.RandomState(0)
+
+	spike_clusters, pc_features, pc_feature_ind, channel_pos = make_pc_features(rng, num_spikes=20000)
+	spike_times = np.sort(np.round(rng.rand(20000) * 600, 3))
+	spike_templates = spike_clusters.copy()
+	other_template = rng.rand(20000) < 0.1
+	spike_templates[other_template] = rng.randint(0, 6, np.sum(other_template))
+	spike_clusters[spike_clusters == 3] = 4  # unit without spikes
+	unit_template_ids = np.arange(6)
+
+	max_drift, cumulative_drift = calculate_drift_metrics(spike_times, spike_clusters, spike_templates, unit_template_ids, 6,
+														   pc_features, pc_feature_ind, channel_pos, 51, 10)
+
+	# reference: median depths of each unit, one interval at a time
+	match_maj = spike_templates == unit_template_ids[spike_clusters]
+	depths = utils.get_spike_depths_from_pcs(pc_features, spike_clusters, unit_template_ids, pc_feature_ind, channel_pos, match_maj)
+	m_spike_times = spike_times[match_maj]
+	m_spike_clusters = spike_clusters[match_maj]
+
+	interval_starts = np.arange(np.min(spike_times), np.max(spike_times), 51)
+
+	for cluster_id in range(6):
+		in_cluster = m_spike_clusters == cluster_id
+		if not np.any(in_cluster):
+			assert(max_drift[cluster_id] == 0 and cumulative_drift[cluster_id] == 0)
+			continue
+		median_depths = []
+		for t1 in interval_starts:
+			in_range = (m_spike_times[in_cluster] > t1) * (m_spike_times[in_cluster] < t1 + 51)
+			if np.sum(in_range) >= 10:
+				median_depths.append(np.median(depths[in_cluster][in_range]))
+			else:
+				median_depths.append(np.nan)
+		median_depths = np.array(median_depths)
+		assert(max_drift[cluster_id] == np.around(np.nanmax(median_depths) - np.nanmin(median_depths), 2))
+		assert(cumulative_drift[cluster_id] == np.around(np.nansum(np.abs(np.diff(median_depths))), 2))
+
+def test_windowed_metrics():
+
+	rng = np.random.RandomState(0)
+
+	spike_times = np.sort(np.round(rng.rand(20000) * 600 * 30000) / 30000)
+	spike_clusters = rng.randint(0, 10, 20000)
+	amplitudes = rng.rand(20000)
+
+	params = {'isi_threshold' : 0.0015, 'min_isi' : 0.000166, 'tbin_sec' : 0.001, 'include_pcs' : False}
+
+	# overlapping windows give the same values as the equivalent epochs
+	windows = get_sliding_windows(spike_times[0], spike_times[-1], 120, 45)
+
+	expected = calculate_metrics(spike_times, spike_clusters, spike_clusters, amplitudes, 
+		None, None, None, [], [], params, epochs=windows)
+	output = calculate_windowed_metrics(spike_times, spike_clusters, 10, params, 120, 45, amplitudes=amplitudes)
+
+	for column in ['cluster_id', 'firing_rate', 'presence_ratio', 'isi_viol', 'num_viol', 'amplitude_cutoff', 'epoch_name']:
+		assert(np.array_equal(output[column].values, expected[column].values))
+
+def test_mahalanobis_metrics():
+
+	rng = np.random.RandomState(0)
+
+	all_pcs = np.concatenate((rng.randn(200, 12), rng.randn(300, 12) * 2 + 3))
+	all_labels = np.repeat([4, 7], [200, 300])
+
+	# reference: explicit inverse and cdist
+	pcs_for_this_unit = all_pcs[:200]
+	VI = np.linalg.inv(np.cov(pcs_for_this_unit.T))
+	distances_sq = np.sort(cdist(np.mean(pcs_for_this_unit, 0, keepdims=True), all_pcs[200:], 'mahalanobis', VI=VI)[0])**2
+
+	expected_isolation_distance = distances_sq[199]
+	expected_l_ratio = np.sum(1 - chi2.cdf(distances_sq, 12)) / 300
+
+	isolation_distance, l_ratio = mahalanobis_metrics(all_pcs, all_labels, 4)
+
+	assert(np.isclose(isolation_distance, expected_isolation_distance))
+	assert(np.isclose(l_ratio, expected_l_ratio))
+
+	isolation_distance, l_ratio = mahalanobis_metrics(all_pcs, all_labels, 4, 'float32')
+
+	assert(np.isclose(isolation_distance, expected_isolation_distance, rtol=1e-4))
+	assert(np.isclose(l_ratio, expected_l_ratio, rtol=1e-4))
+
+def test_nearest_neighbors_metrics_batch():
+
+	rng = np.random.RandomState(0)
+
+	all_pcs = np.concatenate((rng.randn(200, 6), rng.randn(300, 6) + 1.5))
+	all_labels = np.repeat([4, 7], [200, 300])
+
+	nn_cache = NeighborhoodIndexCache(max_neighborhoods=1)
+
+	hit_rates, miss_rates = nearest_neighbors_metrics_batch(all_pcs, all_labels, [4, 7], 10000, 4, nn_cache, 12)
+
+	for idx, unit_id in enumerate([4, 7]):
+		hit_rate, miss_rate = nearest_neighbors_metrics(all_pcs, all_labels, unit_id, 10000, 4)
+		assert(np.isclose(hit_rates[idx], hit_rate))
+		assert(np.isclose(miss_rates[idx], miss_rate))
+
+	# same neighborhood is read from the cache; a new one evicts it
+	nearest_neighbors_metrics_batch(all_pcs, all_labels, [4], 10000, 4, nn_cache, 12)
+	nearest_neighbors_metrics_batch(all_pcs, all_labels, [4], 10000, 4, nn_cache, 13)
+	nearest_neighbors_metrics_batch(all_pcs, all_labels, [4], 10000, 4, nn_cache, 12)
+
+	assert(nn_cache.hits == 1)
+	assert(nn_cache.misses == 3)
+
+	# more spikes than max_spikes_for_nn: each unit uses its own subsample, as before
+	hit_rates, miss_rates = nearest_neighbors_metrics_batch(all_pcs, all_labels, [4, 7], 320, 4, nn_cache, 12)
+
+	for idx, unit_id in enumerate([4, 7]):
+		hit_rate, miss_rate = nearest_neighbors_metrics(all_pcs, all_labels, unit_id, 320, 4)
+		assert(hit_rates[idx] == hit_rate)
+		assert(miss_rates[idx] == miss_rate)
+
+def test_cluster_fingerprints():
+
+	spike_clusters = np.array([0, 2, 1, 2, 0, 3, 1, 2, 3, 0])
+
+	fingerprints, counts = cluster_fingerprints(spike_clusters, 4, chunk_size=3)
+
+	assert(np.array_equal(counts, [3, 2, 3, 2]))
+	assert(np.unique(fingerprints).size == 4)
+
+	# merge cluster 3 into 1 and add a new cluster 4
+	curated = spike_clusters.copy()
+	curated[curated == 3] = 1
+	curated[[1, 3]] = 4
+
+	new_fingerprints, new_counts = cluster_fingerprints(curated, 5)
+
+	assert(new_fingerprints[0] == fingerprints[0])
+
+	changed = find_changed_clusters({'fingerprints' : fingerprints, 'counts' : counts}, new_fingerprints, new_counts)
+
+	assert(np.array_equal(changed, [False, True, True, True, True]))
+
+def test_incremental_metrics():
+
+	rng = np.random.RandomState(0)
+
+	# 10 units along 40 channels, so that only adjacent units are neighbors
+	spike_clusters, pc_features, pc_feature_ind, channel_pos = make_pc_features(rng, num_units=10, num_spikes=10000, num_channels=40)
+	spike_templates = spike_clusters.copy()
+	spike_times = np.sort(np.round(rng.rand(10000) * 600, 3))
+	amplitudes = rng.rand(10000)
+
+	params = {'isi_threshold' : 0.0015, 'min_isi' : 0.000166, 'tbin_sec' : 0.001, 'include_pcs' : True,
+			  'max_radius_um' : 100, 'max_spikes_for_unit' : 500, 'max_spikes_for_nn' : 2000, 'n_neighbors' : 4,
+			  'n_silhouette' : 2000, 'drift_metrics_interval_s' : 51, 'drift_metrics_min_spikes_per_interval' : 10,
+			  'random_seed' : 1}
+
+	def run(clusters, previous_metrics=None, previous_fingerprint=None):
+		np.random.seed(0)
+		return calculate_metrics(spike_times, clusters, spike_templates, amplitudes, None, channel_pos, None, 
+								 pc_features, pc_feature_ind, params, previous_metrics=previous_metrics,
+								 previous_fingerprint=previous_fingerprint, return_fingerprint=True)
+
+	metrics, fingerprint = run(spike_clusters)
+
+	# curation: merge unit 8 into unit 9
+	curated = spike_clusters.copy()
+	curated[curated == 8] = 9
+
+	expected, expected_fingerprint = run(curated)
+
+	# unit 0 is far from the merged units, so its row is copied from the previous run
+	previous_metrics = metrics.copy()
+	previous_metrics.loc[previous_metrics['cluster_id'] == 0, 'nn_hit_rate'] = -1
+
+	output, output_fingerprint = run(curated, previous_metrics, fingerprint)
+
+	assert(output.loc[0, 'nn_hit_rate'] == -1)
+
+	output.loc[0, 'nn_hit_rate'] = expected.loc[0, 'nn_hit_rate']
+	assert(output.equals(expected))
+
+	for key in expected_fingerprint:
+		assert(np.array_equal(output_fingerprint[key], expected_fingerprint[key]))
+
+	# a run with different nearest-neighbor settings does not reuse the rows
+	params['nn_cache_size'] = 4
+	output, output_fingerprint = run(curated, previous_metrics, fingerprint)
+
+	assert(output.loc[0, 'nn_hit_rate'] == expected.loc[0, 'nn_hit_rate'])
+
+def test_slidingRP():
+
+	rng = np.random.RandomState(0)
+
+	trains = [make_spike_train(rate_hz, 300, refractory_s, seed) for seed, (rate_hz, refractory_s) in 
+			  enumerate([(20, 0.002), (20, 0.0), (5, 0.003), (0.2, 0.0)])]
+	trains[1] = np.sort(np.concatenate((trains[1], rng.uniform(0, 300, 2000))))
+
+	spike_times = np.concatenate(trains + [np.array([10.0])])
+	spike_clusters = np.repeat([0, 1, 2, 4, 6], [len(t) for t in trains] + [1])
+	order = np.argsort(spike_times, kind='stable')
+
+	SRP_pass = calculate_slidingRP(spike_times[order], spike_clusters[order], 7, 30000.0)
+
+	expected = np.zeros((7,))
+	for cluster_id, ts in zip([0, 1, 2, 4, 6], trains + [np.array([10.0])]):
+		expected[cluster_id] = slidingRP_viol(ts, sample_rate=30000.0)
+
+	assert(np.array_equal(SRP_pass, expected))
+	assert(np.sum(expected) > 0)
+
+def test_amplitude_cutoff_batch():
+
+	rng = np.random.RandomState(0)
+
+	groups = [rng.gamma(5, 4, 3000), rng.normal(50, 10, 800).clip(20), rng.rand(50), np.array([7.0, 7.0]), np.array([3.0])]
+
+	sorted_amplitudes = np.concatenate(groups)
+	ends = np.cumsum([len(g) for g in groups])
+	starts = ends - [len(g) for g in groups]
+
+	fraction_missing = amplitude_cutoff_batch(sorted_amplitudes, starts, ends)
+	nc_pass, cutoff, first_low_quantile = noise_cutoff_batch(sorted_amplitudes, starts[:3], ends[:3])
+
+	for idx, amplitudes in enumerate(groups):
+		assert(np.isclose(fraction_missing[idx], amplitude_cutoff(amplitudes), rtol=1e-12, atol=0))
+
+	for idx, amplitudes in enumerate(groups[:3]):
+		expected = noise_cutoff(amplitudes)
+		assert(nc_pass[idx] == expected[0])
+		assert(np.array_equal(cutoff[idx], expected[1], equal_nan=True))
+
 if __name__ == "__main__":
     #test_quality_metrics()
-    pass
\ No newline at end of file
+    pass